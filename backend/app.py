@@ -5,7 +5,11 @@ import cv2
 import numpy as np
 import json
 import base64
+from urllib.parse import unquote
 from datetime import datetime
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # 修改这一行导入
 from flask.json import provider
 import traceback
@@ -28,7 +32,12 @@ from db_config import SessionLocal, engine, Base
 import db_utils
 from models.database_models import Student, FaceImage, AttendanceRecord, Class
 from models.face_recognition_utils import FaceRecognitionUtils
+from models.frame_analysis import FrameAnalysis
+from models.session_store import SessionStore
+from models.gallery_shards import ShardedGallery, parse_address, AUTHKEY_ENV
 from models.liveness_detection_improved import ImprovedLivenessDetection
+from models.model_registry import registry as model_registry
+from models.overlay import overlay_for, export_overlay
 
 app = Flask(__name__, static_folder='../static', static_url_path='/static')
 CORS(app)  # 启用跨域支持
@@ -52,20 +61,151 @@ class CustomJSONEncoder(provider.DefaultJSONProvider):
 app.json_provider_class = CustomJSONEncoder
 app.json = CustomJSONEncoder(app)
 
-# 初始化各种活体检测器
-blink_detector = BlinkDetector()
-deep_learning_detector = DeepLearningLiveness()
-api_detector = APILiveness()
+# 活体检测CNN的微批推理参数：每批最多的人脸数和凑批的最长等待时间（毫秒）
+LIVENESS_BATCH_SIZE = int(os.environ.get("LIVENESS_BATCH_SIZE", "8"))
+LIVENESS_BATCH_WAIT_MS = float(os.environ.get("LIVENESS_BATCH_WAIT_MS", "5"))
+# 活体检测CNN的推理运行时：auto（存在导出的.tflite时使用TFLite）、tflite 或 keras
+LIVENESS_RUNTIME = os.environ.get("LIVENESS_RUNTIME", "auto")
+
+# 各种活体检测器在第一次使用该方法时才创建（特征点模型和CNN由注册表加载一次、在检测器之间共享），
+# 未使用的方法不加载任何模型，服务启动不必等待
+LIVENESS_METHODS = ("blink", "deep_learning", "api", "improved")
+model_registry.register("detector:blink", BlinkDetector)
+model_registry.register("detector:deep_learning", lambda: DeepLearningLiveness(
+    batch_size=LIVENESS_BATCH_SIZE, batch_wait_ms=LIVENESS_BATCH_WAIT_MS, runtime=LIVENESS_RUNTIME))
+model_registry.register("detector:api", APILiveness)
 # 添加改进的活体检测器
-improved_detector = ImprovedLivenessDetection()
+model_registry.register("detector:improved", lambda: ImprovedLivenessDetection(
+    batch_size=LIVENESS_BATCH_SIZE, batch_wait_ms=LIVENESS_BATCH_WAIT_MS, runtime=LIVENESS_RUNTIME))
+
+def get_liveness_detector(method):
+    """获取活体检测器（第一次使用时加载）"""
+    return model_registry.get(f"detector:{method}")
+
+# 各客户端（签到终端/浏览器）的活体检测状态：眨眼计数、EAR历史、平滑缓冲区和API调用时间
+liveness_sessions = SessionStore(
+    max_sessions=int(os.environ.get("LIVENESS_MAX_SESSIONS", "10000")),
+    ttl=float(os.environ.get("LIVENESS_SESSION_TTL", "300"))
+)
 
-# 初始化人脸识别工具
-face_recognition_utils = FaceRecognitionUtils(face_db_dir="static/face_db")
+# 初始化人脸识别工具（FACE_GALLERY_COMPRESSION设为float16或int8时，每个学生压缩为原型后量化存储）
+# 服务进程中串行计算人脸编码：spawn启动的编码子进程会重新导入app.py并执行这里的全部初始化，
+# 多进程编码只适合离线的批量导入/重建工具
+face_recognition_utils = FaceRecognitionUtils(
+    face_db_dir="static/face_db",
+    encoding_workers=1,
+    gallery_compression=os.environ.get("FACE_GALLERY_COMPRESSION") or None,
+    # 多个工作进程（如gunicorn -w N）设置相同的名称即可共享一份人脸库
+    shared_gallery=os.environ.get("FACE_SHARED_GALLERY") or None
+)
+
+model_registry.register("recognizer", lambda: face_recognition_utils)
+
+# 启动预热：WARMUP_MODELS为逗号分隔的活体检测方法名和recognition（或all），默认只预热人脸识别。
+# 这些模型在后台线程中加载并对合成帧各做一次完整推理，全部完成前 /api/health/ready 返回503，
+# 负载均衡只把请求转发给已预热的工作进程
+WARMUP_MODELS = os.environ.get("WARMUP_MODELS", "recognition")
+warmup_names = LIVENESS_METHODS + ("recognition",) if WARMUP_MODELS.strip() == "all" else \
+    [name.strip() for name in WARMUP_MODELS.split(',') if name.strip() in LIVENESS_METHODS + ("recognition",)]
+WARMUP_TARGETS = ["recognizer" if name == "recognition" else f"detector:{name}" for name in warmup_names]
 
 # 确保人脸数据库目录存在
 FACE_DB_DIR = "static/face_db"
 ensure_directory(FACE_DB_DIR)
 
+# 调试叠加层（请求的overlay字段为jpeg时）的JPEG质量
+OVERLAY_JPEG_QUALITY = int(os.environ.get("OVERLAY_JPEG_QUALITY", "80"))
+
+# 批量识别：单次请求最多的帧数，以及并行解码图像的线程池
+MAX_BATCH_FRAMES = 64
+image_decode_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+# 一次性考勤（/api/attend）中与活体检测并行执行人脸识别的线程池
+attend_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ATTEND_WORKERS", str(min(8, os.cpu_count() or 1)))),
+                                     thread_name_prefix="attend-recognition")
+
+def decode_image_bytes(data):
+    """直接在字节缓冲区上解码图像（不再复制），失败时返回None"""
+    if not data:
+        return None
+    try:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    except Exception:
+        return None
+
+def decode_data_url_image(data_url):
+    """解码BASE64（data URL或不带前缀的BASE64）图像，失败时返回None"""
+    try:
+        return decode_image_bytes(base64.b64decode(data_url[data_url.find(',') + 1:]))
+    except Exception:
+        return None
+
+# 以原始请求体上传的图像类型；元数据放在请求头或查询参数中
+RAW_IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'application/octet-stream')
+# 表单/请求头中以列表或布尔值传递的元数据字段
+LIST_FIELDS = ('roster',)
+BOOL_FIELDS = ('fallback_global',)
+
+def metadata_header(field):
+    """元数据字段对应的请求头，如 class_id -> X-Class-Id"""
+    return 'X-' + '-'.join(part.capitalize() for part in field.split('_'))
+
+def read_frame_request(fields):
+    """
+    读取请求中的图像和元数据，支持三种上传格式：
+    
+    - JSON：image字段为BASE64（data URL），元数据为其他字段（原有格式）
+    - multipart/form-data：image为文件字段，元数据为表单字段（列表字段可重复或以逗号分隔）
+    - 原始图像请求体（image/jpeg等）：元数据放在查询参数或请求头中（如 X-Method、X-Class-Id），
+      请求头只能是ASCII，非ASCII的值（如学生姓名）需做URL编码
+    
+    二进制格式直接在请求体缓冲区上用cv2.imdecode解码，没有BASE64膨胀，也不需要解析大JSON。
+    
+    Args:
+        fields: 需要读取的元数据字段名
+    
+    Returns:
+        (图像, 元数据字典, 错误信息)；缺少图像或解码失败时图像为None并给出错误信息
+    """
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        params = {key: value for key, value in payload.items() if key != 'image'}
+        data_url = payload.get('image')
+        if not isinstance(data_url, str) or not data_url:
+            return None, params, "缺少图像数据"
+        image = decode_data_url_image(data_url)
+        return image, params, None if image is not None else "无法解码图像"
+    
+    if request.mimetype == 'multipart/form-data':
+        params = {}
+        for field in fields:
+            values = request.form.getlist(field)
+            if field in LIST_FIELDS:
+                if values:
+                    params[field] = [item for value in values for item in value.split(',') if item]
+            elif values:
+                params[field] = values[0]
+        upload = request.files.get('image')
+        data = upload.read() if upload else None
+    elif request.mimetype in RAW_IMAGE_TYPES:
+        params = {}
+        for field in fields:
+            value = request.args.get(field)
+            if value is None and request.headers.get(metadata_header(field)) is not None:
+                value = unquote(request.headers[metadata_header(field)])
+            if value is not None:
+                params[field] = [item for item in value.split(',') if item] if field in LIST_FIELDS else value
+        data = request.get_data(cache=False)
+    else:
+        return None, {}, "不支持的请求格式，请使用JSON、multipart/form-data或图像请求体"
+    
+    for field in BOOL_FIELDS:
+        if field in params:
+            params[field] = params[field].strip().lower() in ('1', 'true', 'yes', 'on')
+    if not data:
+        return None, params, "缺少图像数据"
+    image = decode_image_bytes(data)
+    return image, params, None if image is not None else "无法解码图像"
+
 # 获取数据库会话
 def get_db():
     db = SessionLocal()
@@ -88,36 +228,84 @@ def with_db_session(func):
             db.close()
     return wrapper
 
+def get_inactive_face_images():
+    """查询已停用的人脸图像路径，刷新人脸编码缓存时跳过这些图像"""
+    db = get_db()
+    try:
+        return db_utils.get_inactive_face_image_paths(db)
+    finally:
+        db.close()
+
+def get_class_student_ids(class_id):
+    """查询班级的学生ID，用于班级范围内的人脸识别"""
+    db = get_db()
+    try:
+        return db_utils.get_student_ids_by_class(db, class_id)
+    finally:
+        db.close()
+
+face_recognition_utils.inactive_images_provider = get_inactive_face_images
+face_recognition_utils.roster_provider = get_class_student_ids
+# 分片匹配：FACE_GALLERY_SHARDS为逗号分隔的分片地址（host:port 或Unix域套接字路径），
+# 分片进程用 python -m models.gallery_shards serve/local 启动
+if os.environ.get("FACE_GALLERY_SHARDS"):
+    try:
+        face_recognition_utils.attach_shards(ShardedGallery(
+            [parse_address(address.strip()) for address in os.environ["FACE_GALLERY_SHARDS"].split(",") if address.strip()],
+            authkey=os.environ.get(AUTHKEY_ENV, "").encode("utf-8"),
+            timeout=float(os.environ.get("FACE_SHARD_TIMEOUT", "0.5"))
+        ))
+    except Exception as e:
+        print(f"启用分片匹配出错，使用本地人脸库: {str(e)}")
+# 在后台线程中定期刷新人脸编码缓存，识别请求不再等待重建
+face_recognition_utils.start_background_refresh()
+# 人脸识别和活体检测器都配置完成后开始后台预热
+model_registry.preload(WARMUP_TARGETS, warm_up=True)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def get_liveness_session(payload=None):
+    """
+    当前请求的客户端会话：请求体中的session_id或请求头X-Session-Id
+    
+    未提供或ID无效时返回None，各检测器使用默认会话（所有此类请求共用）。
+    """
+    session_id = (payload or {}).get('session_id') or request.headers.get('X-Session-Id')
+    if not session_id:
+        return None
+    try:
+        return liveness_sessions.get(str(session_id))
+    except ValueError:
+        return None
+
 @app.route('/api/detect_liveness', methods=['POST'])
 def detect_liveness():
-    if 'image' not in request.json or 'method' not in request.json:
+    # 图像可以是JSON中的BASE64，也可以是multipart文件或原始图像请求体（见read_frame_request）
+    img, params, error = read_frame_request(('method', 'session_id', 'overlay'))
+    if img is None and error != "缺少图像数据":
+        return jsonify({"error": error}), 400
+    if img is None or 'method' not in params:
         return jsonify({"error": "Missing image or method"}), 400
     
-    # 解码BASE64图像
-    image_data = request.json['image'].split(',')[1]
-    image_bytes = base64.b64decode(image_data)
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    method = request.json['method']
+    method = params['method']
+    session = get_liveness_session(params)
     result = {"is_live": False, "message": "未知错误", "confidence": 0}
     
+    # 调试叠加层只在请求时生成：overlay为jpeg（绘制后的JPEG）或primitives（绘制图元列表），默认不返回
+    overlay_mode = params.get('overlay') or "none"
+    try:
+        overlay = overlay_for(overlay_mode)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
     # 根据选择的方法进行活体检测
-    if method == "blink":
-        result = blink_detector.detect(img)
-    elif method == "deep_learning":
-        result = deep_learning_detector.detect(img)
-    elif method == "api":
-        result = api_detector.detect(img)
-    elif method == "improved":
-        # 使用改进的活体检测
-        result = improved_detector.detect(img)
-    else:
+    if method not in LIVENESS_METHODS:
         return jsonify({"error": "不支持的活体检测方法"}), 400
+    result = get_liveness_detector(method).detect(img, session=session, overlay=overlay)
+    if overlay is not None:
+        result["overlay"] = export_overlay(overlay, overlay_mode, img, OVERLAY_JPEG_QUALITY)
     
     # 在返回前转换结果
     result = to_serializable(result)
@@ -125,29 +313,29 @@ def detect_liveness():
 
 @app.route('/api/recognize_face', methods=['POST'])
 def recognize_face():
-    if 'image' not in request.json:
-        return jsonify({"error": "缺少图像数据"}), 400
-    
-    # 解码BASE64图像
-    image_data = request.json['image'].split(',')[1]
-    image_bytes = base64.b64decode(image_data)
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    # 图像可以是JSON中的BASE64，也可以是multipart文件或原始图像请求体（见read_frame_request）
+    img, params, error = read_frame_request(('method', 'session_id', 'overlay', 'class_id', 'roster', 'fallback_global'))
+    if img is None:
+        return jsonify({"error": error}), 400
+    # 活体检测和人脸识别共用同一帧的颜色转换、人脸框和特征点
+    analysis = FrameAnalysis(img)
     
     # 检查是否是活体
     liveness_result = None
-    if 'method' in request.json:
-        method = request.json['method']
-        
-        if method == "blink":
-            liveness_result = blink_detector.detect(img)
-        elif method == "deep_learning":
-            liveness_result = deep_learning_detector.detect(img)
-        elif method == "api":
-            liveness_result = api_detector.detect(img)
-        elif method == "improved":
-            # 使用改进的活体检测
-            liveness_result = improved_detector.detect(img)
+    if 'method' in params:
+        method = params['method']
+        session = get_liveness_session(params)
+        overlay_mode = params.get('overlay') or "none"
+        try:
+            overlay = overlay_for(overlay_mode)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if method in LIVENESS_METHODS:
+            liveness_result = get_liveness_detector(method).detect(img, analysis=analysis, session=session,
+                                                                    overlay=overlay)
+            if overlay is not None:
+                liveness_result["overlay"] = export_overlay(overlay, overlay_mode, img, OVERLAY_JPEG_QUALITY)
             
         if not liveness_result or not liveness_result.get("is_live", False):
             return jsonify({
@@ -156,55 +344,335 @@ def recognize_face():
                 "liveness_result": liveness_result
             })
     
-    # 进行人脸识别
-    recognition_result = face_recognition_utils.recognize_face(img)
+    # 进行人脸识别：指定班级ID或名单时只在该范围内匹配，fallback_global为真时范围内无匹配再查全部人脸库
+    class_id = params.get('class_id')
+    roster = params.get('roster')
+    if roster is not None and not isinstance(roster, list):
+        return jsonify({"error": "roster必须是学生ID列表"}), 400
+    recognition_result = face_recognition_utils.recognize_face(
+        img,
+        class_id=str(class_id) if class_id else None,
+        student_ids=[str(sid) for sid in roster] if roster is not None else None,
+        fallback_to_global=bool(params.get('fallback_global', False)),
+        analysis=analysis
+    )
     
     student_id = recognition_result.get("student_id", "未识别")
     student_name = "未知"
     similarity = recognition_result.get("similarity", 0.0)
     
-    # 如果识别成功，获取学生姓名
-    if recognition_result.get("success", False):
-        db = None
-        try:
-            db = get_db()
-            student = db_utils.get_student_by_id(db, student_id)
-            if student:
-                student_name = student.name
-        except Exception as e:
-            print(f"获取学生信息出错: {str(e)}")
-        finally:
-            if db:
-                db.close()
-    
-    # 模拟识别结果
+    # 如果识别成功，获取学生姓名并记录考勤
     success = recognition_result.get("success", False)
-    
-    # 记录考勤
     if success:
-        db = None
-        try:
-            db = get_db()
-            db_utils.record_attendance(
-                db=db,
-                student_id=student_id,
-                recognition_confidence=similarity,
-                liveness_method=request.json.get('method'),
-                liveness_confidence=liveness_result.get('confidence') if liveness_result else None
-            )
-        except Exception as e:
-            if db:
-                db.rollback()
-            print(f"记录考勤出错: {str(e)}")
-        finally:
-            if db:
-                db.close()
+        student_name, _ = record_recognized_attendance(
+            student_id, similarity, params.get('method'),
+            liveness_result.get('confidence') if liveness_result else None
+        )
     
     return jsonify({
         "success": success,
         "student_id": student_id,
         "student_name": student_name,
         "similarity": similarity,
+        "scope": recognition_result.get("scope", "global"),
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+
+def record_recognized_attendance(student_id, similarity, liveness_method, liveness_confidence):
+    """
+    查询识别出的学生姓名并记录考勤（今天已考勤的不重复记录）
+    
+    Returns:
+        (学生姓名，未找到时为"未知", 是否成功记录考勤)
+    """
+    student_name = "未知"
+    recorded = False
+    db = None
+    try:
+        db = get_db()
+        student = db_utils.get_student_by_id(db, student_id)
+        if student:
+            student_name = student.name
+    except Exception as e:
+        print(f"获取学生信息出错: {str(e)}")
+    
+    try:
+        db = db or get_db()
+        db_utils.record_attendance(
+            db=db,
+            student_id=student_id,
+            recognition_confidence=similarity,
+            liveness_method=liveness_method,
+            liveness_confidence=liveness_confidence
+        )
+        recorded = True
+    except Exception as e:
+        if db:
+            db.rollback()
+        print(f"记录考勤出错: {str(e)}")
+    finally:
+        if db:
+            db.close()
+    return student_name, recorded
+
+def record_matched_attendance(best_by_student):
+    """
+    为识别出的多个学生在一个事务中批量记录考勤（合影识别、批量识别）
+    
+    人脸库目录和编码缓存可能比数据库中的学生记录存在得更久，只为数据库中存在的学生写入考勤，
+    否则一个孤立的学生ID就会因外键约束使整批记录回滚。
+    
+    Args:
+        best_by_student: 学生ID -> 识别相似度
+    
+    Returns:
+        (学生ID -> 学生, 新记录考勤的学生ID集合, 未记录考勤的匹配 [{"student_id", "reason"}, ...])
+    """
+    students = {}
+    recorded = set()
+    if not best_by_student:
+        return students, recorded, []
+    
+    db = None
+    error = None
+    try:
+        db = get_db()
+        students = db_utils.get_students_by_ids(db, list(best_by_student))
+        new_records = db_utils.record_attendance_bulk(db, [
+            {"student_id": student_id, "recognition_confidence": similarity}
+            for student_id, similarity in best_by_student.items() if student_id in students
+        ])
+        recorded = {record.student_id for record in new_records}
+    except Exception as e:
+        if db:
+            db.rollback()
+        error = str(e)
+        print(f"批量记录考勤出错: {error}")
+    finally:
+        if db:
+            db.close()
+    
+    unrecorded = []
+    for student_id in best_by_student:
+        if student_id in recorded:
+            continue
+        if error is not None:
+            reason = f"记录考勤出错: {error}"
+        elif student_id not in students:
+            reason = "数据库中不存在该学生"
+        else:
+            reason = "今天已考勤"
+        unrecorded.append({"student_id": student_id, "reason": reason})
+    return students, recorded, unrecorded
+
+@app.route('/api/attend', methods=['POST'])
+def attend():
+    """
+    一次性考勤：图像只解码一次，活体检测与人脸识别在同一帧上并行执行（共用颜色转换和人脸检测），
+    活体检测未通过时取消识别，识别成功则记录考勤，返回合并的结果和各阶段耗时（毫秒）
+    
+    请求格式与 /api/recognize_face 相同（JSON、multipart/form-data或图像请求体），method为必填的活体检测方法。
+    """
+    started = time.perf_counter()
+    timings = {}
+    img, params, error = read_frame_request(('method', 'session_id', 'overlay', 'class_id', 'roster', 'fallback_global'))
+    timings["decode"] = (time.perf_counter() - started) * 1000
+    if img is None:
+        return jsonify({"error": error}), 400
+    
+    method = params.get('method')
+    if method not in LIVENESS_METHODS:
+        return jsonify({"error": "不支持的活体检测方法" if method else "缺少活体检测方法"}), 400
+    class_id = params.get('class_id')
+    roster = params.get('roster')
+    if roster is not None and not isinstance(roster, list):
+        return jsonify({"error": "roster必须是学生ID列表"}), 400
+    overlay_mode = params.get('overlay') or "none"
+    try:
+        overlay = overlay_for(overlay_mode)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    analysis = FrameAnalysis(img)
+    cancel = threading.Event()
+    
+    def run_recognition():
+        stage_started = time.perf_counter()
+        result = face_recognition_utils.recognize_face(
+            img,
+            class_id=str(class_id) if class_id else None,
+            student_ids=[str(sid) for sid in roster] if roster is not None else None,
+            fallback_to_global=bool(params.get('fallback_global', False)),
+            analysis=analysis,
+            cancel=cancel
+        )
+        return result, (time.perf_counter() - stage_started) * 1000
+    
+    # 识别在线程池中执行，活体检测在当前线程中执行
+    recognition_future = attend_executor.submit(run_recognition)
+    stage_started = time.perf_counter()
+    try:
+        liveness_result = get_liveness_detector(method).detect(img, analysis=analysis,
+                                                               session=get_liveness_session(params), overlay=overlay)
+    except Exception:
+        cancel.set()
+        raise
+    timings["liveness"] = (time.perf_counter() - stage_started) * 1000
+    if overlay is not None:
+        liveness_result["overlay"] = export_overlay(overlay, overlay_mode, img, OVERLAY_JPEG_QUALITY)
+    
+    response = {
+        "success": False,
+        "student_id": None,
+        "student_name": "未知",
+        "similarity": 0.0,
+        "attendance_recorded": False,
+        "liveness_result": liveness_result,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    
+    if not liveness_result.get("is_live", False):
+        # 活体检测未通过：取消识别（识别线程在下一个检查点返回），不等待其结果
+        cancel.set()
+        response["message"] = "活体检测失败"
+        response["recognition_cancelled"] = True
+        timings["total"] = (time.perf_counter() - started) * 1000
+        response["timings_ms"] = timings
+        return jsonify(to_serializable(response))
+    
+    stage_started = time.perf_counter()
+    recognition_result, timings["recognition"] = recognition_future.result()
+    # 活体检测结束后还需等待识别的时间（两者并行，理想情况下接近0）
+    timings["recognition_wait"] = (time.perf_counter() - stage_started) * 1000
+    response.update(
+        student_id=recognition_result.get("student_id"),
+        similarity=recognition_result.get("similarity", 0.0),
+        scope=recognition_result.get("scope", "global"),
+        message=recognition_result.get("message")
+    )
+    
+    if recognition_result.get("success", False):
+        stage_started = time.perf_counter()
+        response["student_name"], response["attendance_recorded"] = record_recognized_attendance(
+            response["student_id"], response["similarity"], method, liveness_result.get("confidence"))
+        timings["attendance"] = (time.perf_counter() - stage_started) * 1000
+        response["success"] = True
+    
+    timings["total"] = (time.perf_counter() - started) * 1000
+    response["timings_ms"] = timings
+    return jsonify(to_serializable(response))
+
+@app.route('/api/recognize_group', methods=['POST'])
+def recognize_group():
+    """合影/广角画面考勤：识别画面中的所有人脸，并在一个事务中为所有识别出的学生记录考勤"""
+    # 图像可以是JSON中的BASE64，也可以是multipart文件或原始图像请求体（见read_frame_request）
+    img, params, error = read_frame_request(('class_id', 'roster', 'upsample'))
+    if img is None:
+        return jsonify({"error": error}), 400
+    
+    class_id = params.get('class_id')
+    roster = params.get('roster')
+    if roster is not None and not isinstance(roster, list):
+        return jsonify({"error": "roster必须是学生ID列表"}), 400
+    
+    # 合影中的人脸通常较小，默认上采样一次再检测
+    try:
+        upsample = min(max(int(params.get('upsample', 1)), 0), 2)
+    except (TypeError, ValueError):
+        return jsonify({"error": "upsample必须是整数"}), 400
+    group_result = face_recognition_utils.recognize_faces(
+        img,
+        class_id=str(class_id) if class_id else None,
+        student_ids=[str(sid) for sid in roster] if roster is not None else None,
+        analysis=FrameAnalysis(img, upsample=upsample)
+    )
+    
+    # 同一学生在画面中匹配到多张人脸时按相似度最高的一张记录考勤
+    best_by_student = {}
+    for face in group_result["faces"]:
+        if face["matched"] and face["similarity"] > best_by_student.get(face["student_id"], float("-inf")):
+            best_by_student[face["student_id"]] = face["similarity"]
+    students, recorded, unrecorded = record_matched_attendance(best_by_student)
+    
+    faces = []
+    for face in group_result["faces"]:
+        student = students.get(face["student_id"]) if face["matched"] else None
+        faces.append({
+            "student_id": face["student_id"] if face["matched"] else "未识别",
+            "student_name": student.name if student else "未知",
+            "similarity": face["similarity"],
+            "face_location": face["face_location"],
+            "matched": face["matched"],
+            "attendance_recorded": face["student_id"] in recorded
+        })
+    
+    return jsonify(to_serializable({
+        "success": group_result["success"],
+        "message": group_result["message"],
+        "face_count": group_result["face_count"],
+        "matched_count": group_result["matched_count"],
+        "scope": group_result["scope"],
+        "faces": faces,
+        "unrecorded": unrecorded,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }))
+
+@app.route('/api/recognize_batch', methods=['POST'])
+def recognize_batch():
+    """
+    批量识别多帧图像（如考勤终端断网期间缓存的画面）
+    
+    并行解码所有帧，检测和编码在线程池中并行完成，所有编码一次性与人脸库比对，
+    考勤记录在一个事务中批量写入，按帧返回识别结果。
+    """
+    images = request.json.get('images') if request.json else None
+    if not images or not isinstance(images, list):
+        return jsonify({"error": "缺少图像数据"}), 400
+    if len(images) > MAX_BATCH_FRAMES:
+        return jsonify({"error": f"单次最多识别 {MAX_BATCH_FRAMES} 帧"}), 400
+    
+    class_id = request.json.get('class_id')
+    roster = request.json.get('roster')
+    if roster is not None and not isinstance(roster, list):
+        return jsonify({"error": "roster必须是学生ID列表"}), 400
+    
+    frames = list(image_decode_executor.map(
+        lambda data: decode_data_url_image(data) if isinstance(data, str) else None, images))
+    frame_results = face_recognition_utils.recognize_frames(
+        frames,
+        class_id=str(class_id) if class_id else None,
+        student_ids=[str(sid) for sid in roster] if roster is not None else None
+    )
+    
+    # 同一学生出现在多帧时只按相似度最高的一帧记录考勤
+    best_by_student = {}
+    for result in frame_results:
+        if result["success"]:
+            current = best_by_student.get(result["student_id"])
+            if current is None or result["similarity"] > current:
+                best_by_student[result["student_id"]] = result["similarity"]
+    
+    students, recorded, unrecorded = record_matched_attendance(best_by_student)
+    
+    results = []
+    for frame_idx, result in enumerate(frame_results):
+        student = students.get(result["student_id"]) if result["success"] else None
+        results.append({
+            "frame": frame_idx,
+            "success": result["success"],
+            "student_id": result["student_id"] if result["success"] else "未识别",
+            "student_name": student.name if student else "未知",
+            "similarity": result["similarity"],
+            "message": result["message"],
+            "attendance_recorded": result["success"] and result["student_id"] in recorded
+        })
+    
+    return jsonify({
+        "success": any(result["success"] for result in results),
+        "frame_count": len(results),
+        "recognized_count": sum(1 for result in results if result["success"]),
+        "results": results,
+        "unrecorded": unrecorded,
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     })
 
@@ -212,88 +680,88 @@ def recognize_face():
 def register_face():
     print("接收到register_face请求")
     
+    # 二进制上传（multipart/form-data或原始图像请求体）时图像直接从请求体解码，元数据在表单字段或请求头中
+    img, error = None, None
+    if request.is_json:
+        payload = request.json
+    else:
+        img, payload, error = read_frame_request(('student_id', 'student_name', 'class_id'))
+    
     # 验证请求参数
-    if not all(k in request.json for k in ['image', 'student_id', 'student_name']):
+    if not all(k in payload for k in ['student_id', 'student_name']) or \
+            (request.is_json and 'image' not in payload) or error == "缺少图像数据":
         error_msg = "缺少必要参数"
         print(f"错误: {error_msg}")
         return jsonify({"error": error_msg, "success": False}), 400
+    if error:
+        print(f"错误: {error}")
+        return jsonify({"error": error, "success": False}), 400
     
-    student_id = request.json['student_id']
-    student_name = request.json['student_name']
-    class_id = request.json.get('class_id')
+    student_id = payload['student_id']
+    student_name = payload['student_name']
+    class_id = payload.get('class_id')
     
     print(f"处理注册请求: 学生ID={student_id}, 姓名={student_name}, 班级ID={class_id}")
     
-    # 解码BASE64图像
-    try:
-        print("开始解码图像...")
-        image_data = request.json['image']
-        
-        # 检查并去除数据URL前缀
-        if ',' in image_data:
-            print("检测到数据URL前缀，处理中...")
-            # 提取MIME类型和Base64部分
-            header, base64_data = image_data.split(',', 1)
-            print(f"图像头部: {header[:30]}...")
-        else:
-            # 没有前缀，直接使用
-            base64_data = image_data
-            print("图像没有数据URL前缀")
-            
-        print(f"Base64数据长度: {len(base64_data)}")
-        print(f"Base64数据前几个字符: {base64_data[:20]}...")
-        
-        # 解码Base64数据
+    # 解码BASE64图像（JSON请求）
+    if request.is_json:
         try:
-            image_bytes = base64.b64decode(base64_data)
-            print(f"解码后的图像字节长度: {len(image_bytes)}")
-        except Exception as e:
-            error_msg = f"Base64解码失败: {str(e)}"
-            print(f"错误: {error_msg}")
-            traceback.print_exc()
-            return jsonify({"error": error_msg, "success": False}), 400
+            print("开始解码图像...")
+            image_data = payload['image']
         
-        # 解码图像数据
-        try:
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # 检查并去除数据URL前缀
+            if ',' in image_data:
+                print("检测到数据URL前缀，处理中...")
+                # 提取MIME类型和Base64部分
+                header, base64_data = image_data.split(',', 1)
+                print(f"图像头部: {header[:30]}...")
+            else:
+                # 没有前缀，直接使用
+                base64_data = image_data
+                print("图像没有数据URL前缀")
             
-            if img is None:
-                error_msg = "图像解码失败，可能是格式不支持或数据损坏"
+            print(f"Base64数据长度: {len(base64_data)}")
+            print(f"Base64数据前几个字符: {base64_data[:20]}...")
+        
+            # 解码Base64数据
+            try:
+                image_bytes = base64.b64decode(base64_data)
+                print(f"解码后的图像字节长度: {len(image_bytes)}")
+            except Exception as e:
+                error_msg = f"Base64解码失败: {str(e)}"
                 print(f"错误: {error_msg}")
+                traceback.print_exc()
+                return jsonify({"error": error_msg, "success": False}), 400
+        
+            # 解码图像数据
+            try:
+                nparr = np.frombuffer(image_bytes, np.uint8)
+                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            
+                if img is None:
+                    error_msg = "图像解码失败，可能是格式不支持或数据损坏"
+                    print(f"错误: {error_msg}")
                 
-                # 保存原始字节用于调试
-                debug_path = os.path.join("static/uploads", f"debug_{student_id}.bin")
-                os.makedirs(os.path.dirname(debug_path), exist_ok=True)
-                with open(debug_path, "wb") as f:
-                    f.write(image_bytes)
-                print(f"已保存调试数据到: {debug_path}")
+                    # 保存原始字节用于调试
+                    debug_path = os.path.join("static/uploads", f"debug_{student_id}.bin")
+                    os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+                    with open(debug_path, "wb") as f:
+                        f.write(image_bytes)
+                    print(f"已保存调试数据到: {debug_path}")
                 
-                return jsonify({"error": error_msg, "success": False}), 400
+                    return jsonify({"error": error_msg, "success": False}), 400
                 
-            print(f"图像解码成功: 尺寸={img.shape}")
+                print(f"图像解码成功: 尺寸={img.shape}")
+            except Exception as e:
+                error_msg = f"图像处理出错: {str(e)}"
+                print(f"错误: {error_msg}")
+                traceback.print_exc()
+                return jsonify({"error": error_msg, "success": False}), 400
         except Exception as e:
             error_msg = f"图像处理出错: {str(e)}"
             print(f"错误: {error_msg}")
             traceback.print_exc()
             return jsonify({"error": error_msg, "success": False}), 400
-    except Exception as e:
-        error_msg = f"图像处理出错: {str(e)}"
-        print(f"错误: {error_msg}")
-        traceback.print_exc()
-        return jsonify({"error": error_msg, "success": False}), 400
-    
-    # 图像解码后，添加人脸编码到缓存
-    try:
-        # 将人脸编码添加到缓存
-        face_encoding_result = face_recognition_utils.add_face_encoding(student_id, img)
-        
-        if not face_encoding_result.get("success", False):
-            print(f"添加人脸编码失败: {face_encoding_result.get('message')}")
-            # 继续处理，因为我们仍然会保存原始图像
-    except Exception as e:
-        print(f"处理人脸编码时出错: {str(e)}")
-        # 继续处理，保存原始图像
     
     db = None
     try:
@@ -378,6 +846,17 @@ def register_face():
             traceback.print_exc()
             return jsonify({"error": error_msg, "success": False}), 500
         
+        # 图像保存后再添加人脸编码到缓存：带上图像路径记录到清单，刷新时不会重新编码这张图像
+        try:
+            face_encoding_result = face_recognition_utils.add_face_encoding(student_id, img, image_path=abs_image_path)
+            
+            if not face_encoding_result.get("success", False):
+                print(f"添加人脸编码失败: {face_encoding_result.get('message')}")
+                # 继续处理，原始图像已保存
+        except Exception as e:
+            print(f"处理人脸编码时出错: {str(e)}")
+            # 继续处理，原始图像已保存
+        
         # 检查班级是否存在
         if class_id:
             class_obj = db.query(Class).filter(Class.id == class_id).first()
@@ -400,6 +879,8 @@ def register_face():
             print(f"创建新学生: {student_id}")
             db_student = db_utils.create_student(db, student_id, student_name, class_id)
             print(f"学生创建成功: {db_student.id}")
+            if class_id:
+                face_recognition_utils.invalidate_class_roster(class_id)
         else:
             print(f"学生已存在: {db_student.id}")
         
@@ -523,6 +1004,48 @@ def livenessdetection_methods():
     
     return jsonify(methods)
 
+@app.route('/api/liveness_inference_metrics', methods=['GET'])
+def liveness_inference_metrics():
+    """
+    活体检测模型微批推理的统计（推理运行时、实际批大小、排队等待和推理耗时）
+
+    只包含已加载的检测器；两个深度学习检测器共用同一个模型和批推理队列，统计相同。
+    """
+    metrics = {}
+    for method in ("deep_learning", "improved"):
+        if model_registry.is_loaded(f"detector:{method}"):
+            detector = get_liveness_detector(method)
+            if detector.batcher is not None:
+                metrics[method] = dict(detector.batcher.metrics(), runtime=detector.runtime)
+    return jsonify(metrics)
+
+@app.route('/api/health/ready', methods=['GET'])
+def health_ready():
+    """
+    就绪检查：WARMUP_MODELS中的模型全部加载并预热完成前返回503，附带各模型的加载状态和耗时
+    
+    加载或预热失败的模型在退避时间过后由本检查触发后台重试（失败原因见errors），原因排除后无需重启即可恢复就绪。
+    """
+    model_registry.retry_failed(WARMUP_TARGETS)
+    ready = model_registry.is_ready(WARMUP_TARGETS)
+    models = model_registry.status()
+    now = time.time()
+    errors = {
+        name: {
+            "error": models[name].get("error"),
+            "failures": models[name].get("failures"),
+            "retrying": models[name].get("retrying", False),
+            "next_retry_in_s": max(models[name].get("retry_at", now) - now, 0.0)
+        }
+        for name in WARMUP_TARGETS if models.get(name, {}).get("state") == "error"
+    }
+    return jsonify({
+        "ready": ready,
+        "warmup": WARMUP_TARGETS,
+        "errors": errors,
+        "models": models
+    }), 200 if ready else 503
+
 @app.route('/api/student_template', methods=['GET'])
 def student_template():
     """提供学生信息模板下载"""
@@ -769,6 +1292,7 @@ def import_excel():
                 db_student = db_utils.get_student_by_id(db, student_id)
                 if not db_student:
                     db_student = db_utils.create_student(db, student_id, student_name, class_id)
+                    face_recognition_utils.invalidate_class_roster(class_id)
                 
                 # 保存人脸图像
                 student_dir = os.path.join(FACE_DB_DIR, student_id)
@@ -782,7 +1306,7 @@ def import_excel():
                 cv2.imwrite(target_image_path, img)
                 
                 # 将图像添加到人脸编码缓存
-                face_encoding_result = face_recognition_utils.add_face_encoding(student_id, img)
+                face_encoding_result = face_recognition_utils.add_face_encoding(student_id, img, image_path=target_image_path)
                 
                 # 保存人脸图像信息到数据库
                 db_face = db_utils.add_face_image(db, student_id, target_image_path)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+活体检测模型推理运行时基准测试
+
+对比Keras（.h5）和导出的TFLite模型（float32 / 动态量化 / int8）：运行时版本、导入耗时、模型加载耗时、模型文件大小、
+常驻内存、各批大小的推理延迟分位数与吞吐量，以及与Keras输出的偏差和活体判定一致率。
+每个模型在独立的子进程中测量，导入耗时和内存互不影响。结果以JSON输出。
+
+示例:
+    python benchmark_liveness_runtime.py --export none,int8
+    python benchmark_liveness_runtime.py --tflite models/liveness_model.tflite --images faces/ --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+from benchmark_recognition import log, percentiles, git_revision
+
+
+def rss_bytes(field):
+    """进程内存（Linux读取/proc的VmRSS或VmHWM，其他平台返回None）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_worker(args):
+    """子进程：加载一个模型并测量，结果以JSON输出到stdout"""
+    baseline_rss = rss_bytes("VmRSS")
+    start = time.perf_counter()
+    from models import liveness_runtime
+    if args.worker == "keras":
+        import tensorflow
+        runtime_version = f"tensorflow {tensorflow.__version__}"
+    else:
+        interpreter = liveness_runtime._interpreter_class()
+        package = sys.modules[interpreter.__module__.split('.')[0]]
+        runtime_version = f"{package.__name__} {getattr(package, '__version__', 'unknown')}"
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if args.worker == "keras":
+        model = liveness_runtime.load_keras_model(args.model)
+    else:
+        model = liveness_runtime.TFLiteLivenessModel(args.model, args.threads)
+    load_time = time.perf_counter() - start
+    loaded_rss = rss_bytes("VmRSS")
+
+    samples = np.stack(list(liveness_runtime.calibration_samples(args.images, args.samples, args.seed)))
+    result = {
+        "runtime_version": runtime_version,
+        "import_time_s": import_time,
+        "load_time_s": load_time,
+        "baseline_rss_bytes": baseline_rss,
+        "loaded_rss_bytes": loaded_rss,
+        "batches": []
+    }
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',') if size]
+    for batch_size in batch_sizes:
+        batch = np.resize(samples, (batch_size,) + samples.shape[1:])
+        for _ in range(args.warmup):
+            model.predict_on_batch(batch)
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            model.predict_on_batch(batch)
+            timings.append(time.perf_counter() - start)
+        result["batches"].append({
+            "batch_size": batch_size,
+            "latency_ms": percentiles(timings),
+            "throughput_per_s": batch_size * len(timings) / sum(timings)
+        })
+
+    outputs = np.concatenate([np.asarray(model.predict_on_batch(samples[start:start + 8])).reshape(-1)
+                              for start in range(0, len(samples), 8)])
+    result["outputs"] = [float(value) for value in outputs]
+    result["peak_rss_bytes"] = rss_bytes("VmHWM")
+    print(json.dumps(result))
+
+
+def bench_variant(name, runtime, model_path, args):
+    """在子进程中测量一个模型"""
+    command = [sys.executable, os.path.abspath(__file__), "--worker", runtime, "--model", model_path,
+               "--batch-sizes", args.batch_sizes, "--runs", str(args.runs), "--warmup", str(args.warmup),
+               "--samples", str(args.samples), "--seed", str(args.seed)]
+    if args.images:
+        command += ["--images", args.images]
+    if args.threads:
+        command += ["--threads", str(args.threads)]
+    completed = subprocess.run(command, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {"variant": name, "runtime": runtime, "model": model_path,
+                "error": lines[-1] if lines else f"exit code {completed.returncode}"}
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    return dict({"variant": name, "runtime": runtime, "model": model_path,
+                 "model_size_bytes": os.path.getsize(model_path)}, **result)
+
+
+def compare_outputs(result, reference):
+    """与Keras输出的偏差和活体判定（>0.5）一致率"""
+    if "outputs" not in result or reference is None:
+        return
+    outputs, expected = np.asarray(result["outputs"]), np.asarray(reference)
+    result["max_abs_diff"] = float(np.abs(outputs - expected).max())
+    result["mean_abs_diff"] = float(np.abs(outputs - expected).mean())
+    result["decision_agreement"] = float(np.mean((outputs > 0.5) == (expected > 0.5)))
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='活体检测模型推理运行时基准测试')
+    parser.add_argument('--h5', type=str, default='models/liveness_model.h5', help='Keras模型文件')
+    parser.add_argument('--tflite', type=str, action='append', default=[], help='要测量的TFLite模型（可重复）')
+    parser.add_argument('--export', type=str, default='',
+                        help='先把Keras模型导出为这些量化方式的TFLite模型再测量，逗号分隔，可选 none,dynamic,int8')
+    parser.add_argument('--skip-keras', action='store_true', help='不测量Keras模型')
+    parser.add_argument('--images', type=str, default=None, help='人脸图像目录（输入和int8校准），默认使用随机图像')
+    parser.add_argument('--samples', type=int, default=32, help='用于比较输出的样本数')
+    parser.add_argument('--batch-sizes', type=str, default='1,8', help='测量的批大小，逗号分隔')
+    parser.add_argument('--runs', type=int, default=200, help='每个批大小的推理次数')
+    parser.add_argument('--warmup', type=int, default=10, help='每个批大小的预热次数')
+    parser.add_argument('--threads', type=int, default=None, help='TFLite解释器线程数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--output', type=str, default=None, help='JSON结果文件，默认输出到stdout')
+    parser.add_argument('--worker', type=str, choices=('keras', 'tflite'), help=argparse.SUPPRESS)
+    parser.add_argument('--model', type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.worker:
+        run_worker(args)
+        return
+
+    variants = []
+    if not args.skip_keras:
+        variants.append(("keras", "keras", args.h5))
+    for path in args.tflite:
+        variants.append((os.path.basename(path), "tflite", path))
+
+    export_dir = tempfile.mkdtemp(prefix="liveness-runtime-")
+    for quantize in [mode.strip() for mode in args.export.split(',') if mode.strip()]:
+        log(f"导出TFLite模型: {quantize} ...")
+        from models.liveness_runtime import export_tflite
+        path = export_tflite(args.h5, os.path.join(export_dir, f"liveness_{quantize}.tflite"), quantize, args.images)
+        variants.append((f"tflite-{quantize}", "tflite", path))
+    if not variants:
+        raise SystemExit("没有要测量的模型")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args)
+        },
+        "results": []
+    }
+
+    reference = None
+    for name, runtime, path in variants:
+        log(f"  {name} ...")
+        result = bench_variant(name, runtime, path, args)
+        if name == "keras":
+            reference = result.get("outputs")
+        compare_outputs(result, reference)
+        log(f"  {name}: {json.dumps({key: value for key, value in result.items() if key != 'outputs'}, ensure_ascii=False)}")
+        report["results"].append(result)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        log(f"结果已保存到 {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+人脸识别性能基准测试
+
+使用合成的128维人脸库（不需要运行服务器，也不需要真实照片），对每种匹配实现测量：
+索引构建时间、内存占用、单次匹配延迟分位数、批量匹配吞吐量和识别准确率，
+并通过FaceRecognitionUtils测量人脸库文件的保存/加载时间。结果以JSON输出，便于不同版本之间对比。
+
+示例:
+    python benchmark_recognition.py --sizes 1000,10000 --output bench.json
+    python benchmark_recognition.py --sizes 100000 --matchers exact,int8 --queries 500
+"""
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+from models.gallery_index import ExactGalleryIndex, IVFGalleryIndex
+from models.gallery_compression import QuantizedGalleryIndex, build_compressed_index
+from models.gallery_store import write_gallery
+
+DIM = 128
+# 合成编码的尺度：不同学生之间的距离约0.9，同一学生不同照片之间的距离约0.35，与dlib编码的分布相近
+STUDENT_SCALE = 0.9 / np.sqrt(2 * DIM)
+NOISE_SCALE = 0.35 / np.sqrt(2 * DIM)
+
+MATCHERS = ("exact", "ivf", "float16", "int8", "prototype", "sharded")
+DEFAULT_MATCHERS = ("exact", "ivf", "float16", "int8")
+
+
+def log(message):
+    """进度信息输出到stderr，stdout只输出JSON"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def generate_gallery(n_students, per_student, seed=0, chunk=100000):
+    """
+    生成合成人脸库
+
+    Returns:
+        (学生中心矩阵, 编码矩阵 (n_students*per_student, dim), 平行的学生ID列表)
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.empty((n_students, DIM), dtype=np.float32)
+    for start in range(0, n_students, chunk):
+        stop = min(start + chunk, n_students)
+        centers[start:stop] = rng.standard_normal((stop - start, DIM), dtype=np.float32) * STUDENT_SCALE
+
+    matrix = np.repeat(centers, per_student, axis=0)
+    for start in range(0, len(matrix), chunk):
+        stop = min(start + chunk, len(matrix))
+        matrix[start:stop] += rng.standard_normal((stop - start, DIM), dtype=np.float32) * NOISE_SCALE
+    student_ids = [f"S{i:07d}" for i in range(n_students) for _ in range(per_student)]
+    return centers, matrix, student_ids
+
+
+def generate_queries(centers, n_queries, seed=1):
+    """从已知学生生成查询编码，返回 (查询矩阵, 对应的学生ID)"""
+    rng = np.random.default_rng(seed)
+    students = rng.integers(0, len(centers), n_queries)
+    queries = centers[students] + rng.standard_normal((n_queries, DIM), dtype=np.float32) * NOISE_SCALE
+    return queries.astype(np.float32), [f"S{i:07d}" for i in students]
+
+
+def encodings_cache_from(matrix, student_ids):
+    """转换为FaceRecognitionUtils使用的 学生ID -> 编码列表"""
+    cache = {}
+    for row, student_id in enumerate(student_ids):
+        cache.setdefault(student_id, []).append(matrix[row])
+    return cache
+
+
+def percentiles(samples):
+    """延迟统计（毫秒）"""
+    samples = np.asarray(samples) * 1000.0
+    return {
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p90": float(np.percentile(samples, 90)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max())
+    }
+
+
+def peak_rss_bytes():
+    """进程的峰值常驻内存（Linux读取/proc，其他平台返回None）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure_latency(search, queries, k):
+    """逐个查询，返回每次查询的耗时（秒）和结果"""
+    timings, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query, k))
+        timings.append(time.perf_counter() - start)
+    return timings, results
+
+
+class ShardedMatcher:
+    """把ShardedGallery包装成与其他索引相同的查询接口：基准测试中各分片都在本机运行，有分片未应答时视为出错"""
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def search_batch(self, queries, k=1):
+        results, missing = self.gallery.search_batch(queries, k)
+        if missing:
+            raise RuntimeError(f"分片 {missing} 未应答")
+        return results
+
+    def search(self, query, k=1):
+        return self.search_batch(query, k)[0]
+
+
+class Matchers:
+    """各种匹配实现的构建函数，返回 (索引, 关闭函数或None)"""
+
+    def __init__(self, args):
+        self.args = args
+
+    def build(self, name, matrix, student_ids, cache):
+        if name == "exact":
+            return ExactGalleryIndex.from_matrix(matrix, student_ids), None
+        if name == "ivf":
+            index = IVFGalleryIndex(n_probe=self.args.ivf_n_probe)
+            index.build(cache)
+            return index, None
+        if name in ("float16", "int8"):
+            return QuantizedGalleryIndex.from_matrix(matrix, student_ids, dtype=name), None
+        if name == "prototype":
+            return build_compressed_index(cache, self.args.prototype_medoids, "int8"), None
+        if name == "sharded":
+            from models.gallery_shards import ShardedGallery, start_local_shards
+            authkey = os.urandom(16)
+            directory = tempfile.mkdtemp(prefix="bench-shards-")
+            addresses, processes = start_local_shards(self.args.shards, directory, authkey)
+            gallery = ShardedGallery(addresses, authkey, timeout=self.args.shard_timeout)
+            gallery.replace(student_ids, matrix)
+            index = ShardedMatcher(gallery)
+
+            def close():
+                gallery.close()
+                for process in processes:
+                    process.terminate()
+                    process.join()
+                shutil.rmtree(directory, ignore_errors=True)
+            return index, close
+        raise ValueError(f"未知的匹配实现: {name}")
+
+
+def index_nbytes(index):
+    """索引自身数组占用的字节数（不含Python对象）"""
+    if isinstance(index, QuantizedGalleryIndex):
+        return int(index.nbytes)
+    if isinstance(index, ExactGalleryIndex):
+        return int(len(index) * (index.dim * 4 + 4))
+    if isinstance(index, IVFGalleryIndex):
+        centroids = index.centroids.nbytes if index.centroids is not None else 0
+        return int(sum(index_nbytes(inv_list) for inv_list in index.lists) + centroids)
+    return None
+
+
+def bench_matcher(name, matchers, matrix, student_ids, cache, queries, truth, exact_top1, args):
+    """测量一种匹配实现"""
+    result = {"matcher": name}
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    index, close = matchers.build(name, matrix, student_ids, cache)
+    result["build_time_s"] = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["memory"] = {
+        "index_bytes": index_nbytes(index),
+        "allocated_bytes": current,
+        "build_peak_bytes": peak
+    }
+
+    try:
+        # 预热一次，避免首次查询的缓存未命中影响分位数
+        index.search(queries[0], args.top_k)
+        timings, results = measure_latency(index.search, queries, args.top_k)
+        result["latency_ms"] = percentiles(timings)
+        result["qps"] = len(queries) / sum(timings)
+
+        batch_timings = []
+        for start in range(0, len(queries), args.batch_size):
+            batch = queries[start:start + args.batch_size]
+            began = time.perf_counter()
+            index.search_batch(batch, args.top_k)
+            batch_timings.append(time.perf_counter() - began)
+        result["batch"] = {
+            "batch_size": args.batch_size,
+            "per_query_ms": sum(batch_timings) * 1000.0 / len(queries),
+            "qps": len(queries) / sum(batch_timings)
+        }
+
+        top1 = [matches[0][0] if matches else None for matches in results]
+        result["accuracy_at_1"] = float(np.mean([found == expected for found, expected in zip(top1, truth)]))
+        if exact_top1 is not None:
+            result["recall_at_1"] = float(np.mean([found == expected for found, expected in zip(top1, exact_top1)]))
+        return result, top1
+    finally:
+        if close is not None:
+            close()
+
+
+def bench_gallery_file(matrix, student_ids, queries, args):
+    """通过FaceRecognitionUtils测量人脸库文件的保存、加载时间及加载后的匹配延迟"""
+    from models.face_recognition_utils import FaceRecognitionUtils
+
+    directory = tempfile.mkdtemp(prefix="bench-gallery-", dir=args.tmp_dir)
+    try:
+        os.makedirs(os.path.join(directory, "face_db"))
+        cache_file = os.path.join(directory, "face_encodings_cache.pkl")
+        gallery_file = os.path.join(directory, "face_gallery.bin")
+
+        start = time.perf_counter()
+        write_gallery(gallery_file, matrix, student_ids, [""] * len(student_ids), [None] * len(student_ids),
+                      extra={"has_manifest": True, "unencodable": [], "journal_epoch": 0})
+        write_time = time.perf_counter() - start
+
+        gc.collect()
+        start = time.perf_counter()
+        utils = FaceRecognitionUtils(face_db_dir=os.path.join(directory, "face_db"), encoding_cache_file=cache_file)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        utils.save_encoding_cache()
+        save_time = time.perf_counter() - start
+
+        utils.match_encoding(queries[0], args.top_k)
+        timings, _ = measure_latency(lambda query, k: utils.match_encoding(query, k), queries, args.top_k)
+        return {
+            "file_bytes": os.path.getsize(gallery_file),
+            "write_time_s": write_time,
+            "load_time_s": load_time,
+            "save_time_s": save_time,
+            "match_latency_ms": percentiles(timings)
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='人脸识别性能基准测试（合成人脸库）')
+    parser.add_argument('--sizes', type=str, default='1000,10000,100000,1000000', help='人脸库学生数，逗号分隔')
+    parser.add_argument('--per-student', type=int, default=1, help='每个学生的编码数')
+    parser.add_argument('--matchers', type=str, default=','.join(DEFAULT_MATCHERS),
+                        help=f'匹配实现，逗号分隔，可选 {",".join(MATCHERS)}')
+    parser.add_argument('--queries', type=int, default=200, help='每种匹配实现的查询次数')
+    parser.add_argument('--top-k', type=int, default=1, help='每次查询返回的学生数')
+    parser.add_argument('--batch-size', type=int, default=16, help='批量查询的批大小')
+    parser.add_argument('--ivf-n-probe', type=int, default=8, help='IVF索引每次查询扫描的簇数量')
+    parser.add_argument('--prototype-medoids', type=int, default=3, help='prototype模式每个学生保留的中心样本数')
+    parser.add_argument('--shards', type=int, default=4, help='sharded模式启动的本地分片进程数')
+    parser.add_argument('--shard-timeout', type=float, default=5.0, help='sharded模式的分片超时（秒）')
+    parser.add_argument('--skip-gallery', action='store_true', help='不测量人脸库文件的保存/加载（需要face_recognition）')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='人脸库文件的临时目录')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--output', type=str, default=None, help='JSON结果文件，默认输出到stdout')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    names = [name.strip() for name in args.matchers.split(',') if name.strip()]
+    unknown = [name for name in names if name not in MATCHERS]
+    if unknown:
+        raise SystemExit(f"未知的匹配实现: {', '.join(unknown)}")
+    matchers = Matchers(args)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "dim": DIM,
+            "args": vars(args)
+        },
+        "results": []
+    }
+
+    for size in sizes:
+        log(f"生成人脸库: {size} 个学生 x {args.per_student} 条编码")
+        start = time.perf_counter()
+        centers, matrix, student_ids = generate_gallery(size, args.per_student, args.seed)
+        queries, truth = generate_queries(centers, args.queries, args.seed + 1)
+        cache = encodings_cache_from(matrix, student_ids)
+        entry = {
+            "students": size,
+            "encodings": len(matrix),
+            "generate_time_s": time.perf_counter() - start,
+            "matchers": []
+        }
+
+        exact_top1 = None
+        # 先测exact，作为近似实现召回率的基准
+        for name in sorted(names, key=lambda name: name != "exact"):
+            log(f"  {name} ...")
+            try:
+                result, top1 = bench_matcher(name, matchers, matrix, student_ids, cache, queries, truth, exact_top1, args)
+                if name == "exact":
+                    exact_top1 = top1
+            except Exception as e:
+                result = {"matcher": name, "error": f"{type(e).__name__}: {e}"}
+            log(f"  {name}: {json.dumps({key: value for key, value in result.items() if key != 'matcher'}, ensure_ascii=False)}")
+            entry["matchers"].append(result)
+            gc.collect()
+
+        if not args.skip_gallery:
+            log("  gallery file ...")
+            try:
+                entry["gallery_file"] = bench_gallery_file(matrix, student_ids, queries, args)
+            except Exception as e:
+                entry["gallery_file"] = {"error": f"{type(e).__name__}: {e}"}
+
+        entry["peak_rss_bytes"] = peak_rss_bytes()
+        report["results"].append(entry)
+        del centers, matrix, student_ids, cache
+        gc.collect()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+        log(f"结果已保存到 {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
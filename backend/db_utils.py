@@ -42,6 +42,10 @@ def get_all_face_images(db: Session) -> List[FaceImage]:
     """获取所有人脸图像"""
     return db.query(FaceImage).filter(FaceImage.is_active == True).all()
 
+def get_inactive_face_image_paths(db: Session) -> List[str]:
+    """获取已停用人脸图像的存储路径"""
+    return [row.image_path for row in db.query(FaceImage.image_path).filter(FaceImage.is_active == False).all()]
+
 def record_attendance(db: Session, 
                      student_id: str, 
                      recognition_confidence: float = None,
@@ -75,10 +79,61 @@ def record_attendance(db: Session,
     db.refresh(db_record)
     return db_record
 
+def record_attendance_bulk(db: Session, records: List[Dict[str, Any]]) -> List[AttendanceRecord]:
+    """
+    在一个事务中批量记录考勤（多人脸识别）
+    
+    Args:
+        records: 每项包含student_id，可选recognition_confidence、liveness_method、liveness_confidence、status
+        
+    Returns:
+        新增的考勤记录（今天已考勤的学生不重复记录）
+    """
+    if not records:
+        return []
+    
+    today = date.today()
+    now = datetime.now().time()
+    student_ids = [record["student_id"] for record in records]
+    # 一次查询今天已经考勤的学生
+    existing = {row.student_id for row in db.query(AttendanceRecord.student_id).filter(
+        AttendanceRecord.student_id.in_(student_ids),
+        AttendanceRecord.date == today
+    ).all()}
+    
+    new_records = []
+    for record in records:
+        if record["student_id"] in existing:
+            continue
+        existing.add(record["student_id"])
+        new_records.append(AttendanceRecord(
+            student_id=record["student_id"],
+            date=today,
+            time=now,
+            status=record.get("status", "normal"),
+            recognition_confidence=record.get("recognition_confidence"),
+            liveness_method=record.get("liveness_method"),
+            liveness_confidence=record.get("liveness_confidence")
+        ))
+    
+    db.add_all(new_records)
+    db.commit()
+    return new_records
+
+def get_students_by_ids(db: Session, student_ids: List[str]) -> Dict[str, Student]:
+    """一次查询多个学生，返回 学生ID -> 学生"""
+    if not student_ids:
+        return {}
+    return {student.id: student for student in db.query(Student).filter(Student.id.in_(student_ids)).all()}
+
 def get_all_attendance_records(db: Session) -> List[AttendanceRecord]:
     """获取所有考勤记录"""
     return db.query(AttendanceRecord).all()
 
+def get_student_ids_by_class(db: Session, class_id: str) -> List[str]:
+    """获取班级中所有学生的ID"""
+    return [row.id for row in db.query(Student.id).filter(Student.class_id == class_id).all()]
+
 def get_class_by_id(db: Session, class_id: str) -> Optional[Class]:
     """根据ID获取班级信息"""
     return db.query(Class).filter(Class.id == class_id).first()
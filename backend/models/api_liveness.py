@@ -5,6 +5,17 @@ import os
 import cv2
 import numpy as np
 import time
+from models.frame_analysis import FrameAnalysis
+from models.session_store import SessionState
+
+
+class APILivenessState:
+    """一个会话的API调用状态"""
+    
+    def __init__(self):
+        # 上次API调用的时间戳（用于限制调用频率）
+        self.last_api_call_time = 0
+
 
 class APILiveness:
     def __init__(self):
@@ -30,8 +41,8 @@ class APILiveness:
         # 人脸检测器（作为备选）
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
         
-        # 上次API调用的时间戳（用于限制调用频率）
-        self.last_api_call_time = 0
+        # 调用频率按会话限制（见APILivenessState），未指定会话的请求共用默认会话
+        self.default_session = SessionState("default")
         self.api_call_interval = 3  # 秒
     
     def save_config(self, config):
@@ -44,11 +55,9 @@ class APILiveness:
         
         self.api_config.update(config)
     
-    def detect_faces_local(self, frame):
-        """使用本地方法检测人脸（备选方案）"""
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        return faces
+    def detect_faces_local(self, frame, analysis=None):
+        """使用本地方法检测人脸（备选方案，传入analysis时复用其灰度图和检测结果）"""
+        return FrameAnalysis.of(frame, analysis).haar_faces(self.face_cascade)
     
     def call_tencent_api(self, image_base64):
         """调用腾讯云人脸识别API进行活体检测"""
@@ -108,8 +117,20 @@ class APILiveness:
                 "score": 0
             }
     
-    def detect(self, frame):
-        """检测输入帧是否为活体"""
+    def warm_up(self, frame):
+        """只预热本地人脸检测（不调用远程API，避免消耗调用额度）"""
+        self.detect_faces_local(frame)
+    
+    def detect(self, frame, analysis=None, session=None, overlay=None):
+        """
+        检测输入帧是否为活体
+        
+        Args:
+            frame: BGR图像
+            analysis: 同一帧的分析对象
+            session: 客户端会话，API调用频率按会话限制；None时使用默认会话
+            overlay: 调试叠加层（Overlay），传入时记录人脸框和结果标签，None时不做任何可视化
+        """
         result = {
             "is_live": False,
             "message": "API活体检测失败",
@@ -122,17 +143,18 @@ class APILiveness:
             result["message"] = "API未配置或已禁用"
             return result
         
-        # 检查API调用频率
-        current_time = time.time()
-        if current_time - self.last_api_call_time < self.api_call_interval:
-            result["message"] = f"API调用过于频繁，请等待 {self.api_call_interval - (current_time - self.last_api_call_time):.1f} 秒"
-            return result
-        
-        # 更新API调用时间
-        self.last_api_call_time = current_time
+        # 检查API调用频率，并更新API调用时间
+        session = session or self.default_session
+        with session.lock:
+            state = session.get("api", APILivenessState)
+            current_time = time.time()
+            if current_time - state.last_api_call_time < self.api_call_interval:
+                result["message"] = f"API调用过于频繁，请等待 {self.api_call_interval - (current_time - state.last_api_call_time):.1f} 秒"
+                return result
+            state.last_api_call_time = current_time
         
         # 基本的人脸检测（确保图像中有人脸）
-        faces = self.detect_faces_local(frame)
+        faces = self.detect_faces_local(frame, analysis)
         
         if len(faces) == 0:
             result["message"] = "未检测到人脸"
@@ -159,22 +181,11 @@ class APILiveness:
             result["message"] = f"API调用失败: {api_result.get('error', '未知错误')}"
             result["error"] = api_result.get("error", "未知错误")
         
-        # 可视化结果
-        visualized_frame = frame.copy()
-        for (x, y, w, h) in faces:
-            color = (0, 255, 0) if result["is_live"] else (0, 0, 255)
-            cv2.rectangle(visualized_frame, (x, y), (x+w, y+h), color, 2)
-            cv2.putText(
-                visualized_frame, 
-                f"API: {result['is_live']}, Conf: {result['confidence']:.2f}", 
-                (x, y-10), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                0.5, 
-                color, 
-                2
-            )
-        
-        result["visualized_frame"] = visualized_frame
+        # 可视化结果（按请求记录）
+        if overlay is not None:
+            for (x, y, w, h) in faces:
+                color = (0, 255, 0) if result["is_live"] else (0, 0, 255)
+                overlay.box(x, y, w, h, color, f"API: {result['is_live']}, Conf: {result['confidence']:.2f}")
         
         return result
         
@@ -1,34 +1,43 @@
 import cv2
 import numpy as np
-import dlib
 from collections import deque
 import time
 import os
+from models.frame_analysis import FrameAnalysis, get_default_face_detector
+from models.session_store import SessionState
+from models.model_registry import get_shape_predictor
+
+
+class BlinkState:
+    """一个会话的眨眼检测状态"""
+
+    def __init__(self, history_size=10):
+        # 保存最近的EAR值历史
+        self.ear_history = deque(maxlen=history_size)
+        self.baseline_ear = None  # 基线EAR值
+        self.blink_counter = 0
+        self.blink_total = 0
+        self.last_blink_time = time.time()
+
 
 class BlinkDetector:
     def __init__(self):
         print("初始化眨眼检测模块...")
         # 初始化人脸检测器和人脸关键点检测器
-        self.detector = dlib.get_frontal_face_detector()
+        self.detector = get_default_face_detector()
         # 加载预训练的面部特征点检测器（68个点）
        
         model_path = os.path.join("models/shape_predictor_68_face_landmarks.dat")
         print(f"加载人脸特征点模型: {model_path}")
         
-        # 加载预训练的面部特征点检测器（68个点）
-        self.predictor = dlib.shape_predictor(model_path)
+        # 加载预训练的面部特征点检测器（68个点，进程内与其他检测器共用同一个模型）
+        self.predictor = get_shape_predictor(model_path)
         # 用于检测眨眼的参数 - 进一步降低阈值
         self.EYE_AR_THRESH = 0.25  # 眼睛长宽比阈值 - 设置更高使检测更灵敏
         self.EYE_AR_CONSEC_FRAMES = 1  # 眼睛闭合的连续帧数 - 降为1帧使检测更灵敏
         
-        # 保存最近的EAR值历史
-        self.ear_history = deque(maxlen=10)
-        self.baseline_ear = None  # 基线EAR值
-        
-        # 用于存储眨眼状态的队列
-        self.blink_counter = 0
-        self.blink_total = 0
-        self.last_blink_time = time.time()
+        # 眨眼计数和EAR历史按会话保存（见BlinkState），未指定会话的请求共用默认会话
+        self.default_session = SessionState("default")
         
         # 每次调用detect方法时重置检测状态
         self.reset_on_each_call = True
@@ -55,36 +64,37 @@ class BlinkDetector:
         ear = (A + B) / (2.0 * C)
         return ear
     
-    def get_landmarks(self, frame):
-        # 转换为灰度图像
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # 检测人脸
-        faces = self.detector(gray, 0)
-        print(f"检测到 {len(faces)} 个人脸")
-        
-        landmarks = []
-        for face in faces:
-            # 检测面部特征点
-            shape = self.predictor(gray, face)
-            
-            # 将特征点坐标转换为numpy数组
-            coords = np.zeros((68, 2), dtype=int)
-            for i in range(0, 68):
-                coords[i] = (shape.part(i).x, shape.part(i).y)
-            
-            landmarks.append(coords)
-        
+    def warm_up(self, frame):
+        """对合成帧做一次检测（初始化dlib人脸检测），使用临时会话，不影响默认会话的眨眼计数"""
+        self.detect(frame, session=SessionState("warmup"))
+    
+    def get_landmarks(self, frame, analysis=None):
+        # 灰度图、人脸框和特征点由帧分析对象计算，与同一帧的其他检测器共用
+        landmarks = FrameAnalysis.of(frame, analysis).landmarks(self.predictor)
+        print(f"检测到 {len(landmarks)} 个人脸")
         return landmarks
     
-    def detect(self, frame):
+    def detect(self, frame, analysis=None, session=None, overlay=None):
+        """
+        检测输入帧中的眨眼
+        
+        Args:
+            frame: BGR图像
+            analysis: 同一帧的分析对象
+            session: 客户端会话（SessionState），EAR历史和眨眼计数按会话保存；None时使用默认会话
+            overlay: 调试叠加层（Overlay），传入时记录眼睛轮廓，None时不做任何可视化
+        """
+        session = session or self.default_session
+        landmarks = self.get_landmarks(frame, analysis)
+        with session.lock:
+            return self._detect_blink(frame, landmarks, session.get("blink", BlinkState), overlay)
+    
+    def _detect_blink(self, frame, landmarks, state, overlay=None):
         # 如果设置了每次调用重置状态
         if self.reset_on_each_call:
             print("重置眨眼检测状态...")
-            self.blink_counter = 0
-            self.blink_total = 0
-        
-        landmarks = self.get_landmarks(frame)
+            state.blink_counter = 0
+            state.blink_total = 0
         
         result = {
             "is_live": False,
@@ -110,47 +120,45 @@ class BlinkDetector:
         ear = (left_ear + right_ear) / 2.0
         
         # 更新EAR历史
-        self.ear_history.append(ear)
+        state.ear_history.append(ear)
         
         # 计算EAR变化量
-        if len(self.ear_history) >= 3:
+        if len(state.ear_history) >= 3:
             # 如果没有基线，使用最初几帧的平均值
-            if self.baseline_ear is None and len(self.ear_history) >= 5:
-                self.baseline_ear = sum(list(self.ear_history)[:5]) / 5
-                print(f"设置基线EAR值: {self.baseline_ear:.4f}")
+            if state.baseline_ear is None and len(state.ear_history) >= 5:
+                state.baseline_ear = sum(list(state.ear_history)[:5]) / 5
+                print(f"设置基线EAR值: {state.baseline_ear:.4f}")
             
             # 计算EAR变化
-            ear_change = abs(ear - self.ear_history[-2])
+            ear_change = abs(ear - state.ear_history[-2])
             print(f"眼睛长宽比(EAR): {ear:.4f}, 变化量: {ear_change:.4f}, 阈值: {self.EYE_AR_THRESH}")
             
             # 检测显著下降，这可能表示眨眼
-            if (self.baseline_ear and ear < self.baseline_ear * 0.85) or ear_change > 0.04:
-                self.blink_counter += 1
+            if (state.baseline_ear and ear < state.baseline_ear * 0.85) or ear_change > 0.04:
+                state.blink_counter += 1
                 print(f"检测到可能的眨眼动作: 眼睛变化明显")
                 # 立即计为眨眼
-                if self.blink_counter >= self.EYE_AR_CONSEC_FRAMES:
-                    self.blink_total += 1
-                    print(f"确认眨眼! 总数: {self.blink_total}")
-                    self.last_blink_time = time.time()
+                if state.blink_counter >= self.EYE_AR_CONSEC_FRAMES:
+                    state.blink_total += 1
+                    print(f"确认眨眼! 总数: {state.blink_total}")
+                    state.last_blink_time = time.time()
         else:
             print(f"眼睛长宽比(EAR): {ear:.4f}, 初始化EAR历史数据...")
         
         # 判断活体检测结果
-        if self.blink_total > 0:
+        if state.blink_total > 0:
             result["is_live"] = True
-            result["message"] = f"检测到眨眼次数: {self.blink_total}"
-            result["confidence"] = min(0.5 + self.blink_total * 0.1, 0.95)
+            result["message"] = f"检测到眨眼次数: {state.blink_total}"
+            result["confidence"] = min(0.5 + state.blink_total * 0.1, 0.95)
             print(f"活体检测结果: 是, 置信度: {result['confidence']:.2f}")
         else:
             print("活体检测结果: 否，未检测到眨眼")
         
-        # 可视化眨眼检测结果（用于调试）
-        visualized_frame = frame.copy()
-        for eye in [left_eye, right_eye]:
-            hull = cv2.convexHull(eye)
-            cv2.drawContours(visualized_frame, [hull], -1, (0, 255, 0), 1)
+        # 可视化眨眼检测结果（用于调试，按请求记录眼睛轮廓）
+        if overlay is not None:
+            for eye in [left_eye, right_eye]:
+                overlay.polygon(cv2.convexHull(eye), (0, 255, 0))
         
-        result["visualized_frame"] = visualized_frame
         result["ear"] = ear
         
         return result 
\ No newline at end of file
@@ -1,20 +1,26 @@
 import cv2
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.models import load_model
 import os
+from models.texture_features import high_frequency_ratio
+from models.frame_analysis import FrameAnalysis
+from models.model_registry import get_liveness_model
 
 class DeepLearningLiveness:
-    def __init__(self):
+    def __init__(self, batch_size=8, batch_wait_ms=5.0, runtime="auto"):
+        """
+        Args:
+            batch_size: 并发请求合并推理时每批最多的人脸数
+            batch_wait_ms: 凑批时最长等待时间（毫秒）
+            runtime: 推理运行时，'auto'(有导出的.tflite时使用TFLite)、'tflite' 或 'keras'
+        """
         # 模型路径
         self.model_path = 'models/liveness_model.h5'
         
-        # 如果模型不存在，则创建一个简单的模型
-        if not os.path.exists(self.model_path):
-            self._create_simple_model()
-        else:
-            # 加载预训练模型
-            self.model = load_model(self.model_path)
+        # 加载预训练模型（优先使用导出的TFLite模型），都不存在时创建一个简单的模型。
+        # 模型和批推理队列在进程内共享：并发请求的人脸区域合并为一批推理，模型只在批处理线程中调用
+        shared = get_liveness_model(self.model_path, runtime, self._create_simple_model,
+                                    batch_size=batch_size, batch_wait_ms=batch_wait_ms)
+        self.model, self.runtime, self.batcher = shared.model, shared.runtime, shared.batcher
         
         # 图像预处理参数
         self.input_shape = (96, 96)
@@ -41,12 +47,13 @@ class DeepLearningLiveness:
         x = Dropout(0.5)(x)
         output_layer = Dense(1, activation='sigmoid')(x)
         
-        self.model = Model(inputs=input_layer, outputs=output_layer)
-        self.model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+        model = Model(inputs=input_layer, outputs=output_layer)
+        model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
         
         # 保存模型
         os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
-        self.model.save(self.model_path)
+        model.save(self.model_path)
+        return model
     
     def preprocess_image(self, image):
         """预处理图像用于深度学习模型输入"""
@@ -64,11 +71,9 @@ class DeepLearningLiveness:
         
         return image
     
-    def detect_faces(self, frame):
-        """检测图像中的人脸"""
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        return faces
+    def detect_faces(self, frame, analysis=None):
+        """检测图像中的人脸（传入analysis时复用其灰度图和检测结果）"""
+        return FrameAnalysis.of(frame, analysis).haar_faces(self.face_cascade)
     
     def extract_face(self, frame, face):
         """从图像中提取人脸区域"""
@@ -91,30 +96,20 @@ class DeepLearningLiveness:
         # 转换为灰度图
         gray = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
         
-        # 计算局部二值模式(LBP)特征（简化版本）
-        lbp = np.zeros_like(gray)
-        for i in range(1, gray.shape[0] - 1):
-            for j in range(1, gray.shape[1] - 1):
-                center = gray[i, j]
-                neighbors = [gray[i-1, j-1], gray[i-1, j], gray[i-1, j+1],
-                            gray[i, j+1], gray[i+1, j+1], gray[i+1, j],
-                            gray[i+1, j-1], gray[i, j-1]]
-                binary = [1 if n >= center else 0 for n in neighbors]
-                lbp[i, j] = sum([b * (2 ** idx) for idx, b in enumerate(binary)])
-        
-        # 计算LBP直方图
-        hist, _ = np.histogram(lbp, bins=256, range=(0, 256))
-        
-        # 归一化直方图
-        hist = hist.astype(np.float32) / (lbp.shape[0] * lbp.shape[1])
-        
-        # 使用简单的启发式方法：高频纹理比例
-        high_freq_ratio = np.sum(hist[128:]) / np.sum(hist)
-        
-        return high_freq_ratio
+        # 使用高频纹理比例作为评分（LBP按整幅图数组运算计算）
+        return high_frequency_ratio(gray)
+    
+    def warm_up(self, frame):
+        """对合成帧做一次检测，并直接对整帧做一次模型推理（合成帧未必能检测到人脸，推理路径也要执行到）"""
+        self.detect(frame)
+        self.batcher.predict(self.preprocess_image(frame)[0])
     
-    def detect(self, frame):
-        """检测输入帧是否为活体"""
+    def detect(self, frame, analysis=None, session=None, overlay=None):
+        """
+        检测输入帧是否为活体（本检测器没有跨帧状态，session仅为与其他检测器接口一致）
+        
+        overlay为调试叠加层（Overlay），传入时记录人脸框和结果标签，None时不做任何可视化
+        """
         result = {
             "is_live": False,
             "message": "深度学习活体检测失败",
@@ -123,7 +118,7 @@ class DeepLearningLiveness:
         }
         
         # 检测人脸
-        faces = self.detect_faces(frame)
+        faces = self.detect_faces(frame, analysis)
         
         if len(faces) == 0:
             result["message"] = "未检测到人脸"
@@ -141,8 +136,8 @@ class DeepLearningLiveness:
             # 预处理图像
             processed_img = self.preprocess_image(cv2.resize(face_img, self.input_shape))
             
-            # 模型预测
-            prediction = self.model.predict(processed_img)[0][0]
+            # 模型预测（与其他请求合并为一批）
+            prediction = self.batcher.predict(processed_img[0])[0]
             
             # 结合纹理分析和深度学习模型的结果
             combined_score = prediction * 0.7 + texture_score * 0.3
@@ -160,21 +155,11 @@ class DeepLearningLiveness:
             else:
                 result["message"] = "检测为欺骗攻击"
             
-            # 添加可视化信息
-            visualized_frame = frame.copy()
-            x, y, w, h = face
-            color = (0, 255, 0) if is_live else (0, 0, 255)
-            cv2.rectangle(visualized_frame, (x, y), (x+w, y+h), color, 2)
-            cv2.putText(
-                visualized_frame, 
-                f"Live: {is_live}, Conf: {combined_score:.2f}", 
-                (x, y-10), 
-                cv2.FONT_HERSHEY_SIMPLEX, 
-                0.5, 
-                color, 
-                2
-            )
-            result["visualized_frame"] = visualized_frame
+            # 添加可视化信息（按请求记录）
+            if overlay is not None:
+                x, y, w, h = face
+                color = (0, 255, 0) if is_live else (0, 0, 255)
+                overlay.box(x, y, w, h, color, f"Live: {is_live}, Conf: {combined_score:.2f}")
             
         except Exception as e:
             result["message"] = f"模型预测错误: {str(e)}"
@@ -4,71 +4,581 @@ import numpy as np
 import os
 import pickle
 import time
-from typing import Dict, List, Tuple, Optional, Any
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional, Any, Callable, Iterable, Mapping
 import logging
+from models.gallery_compression import compress_encodings, build_compressed_index, evaluate_compression
+from models.gallery_index import ExactGalleryIndex, IVFGalleryIndex, create_gallery_index
+from models.gallery_store import read_gallery, write_gallery, mapped_from, REPLACE_MAPPED_FILES
+from models.gallery_journal import GalleryJournal
+from models.gallery_snapshot import GallerySnapshot
+from models.shared_gallery import SharedGallery
+from models.gallery_shards import ShardedGallery, shard_for, merge_results
+from models.frame_analysis import FrameAnalysis
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('face_recognition_utils')
 
+# 人脸库中支持的图像格式
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# 图像中未检测到人脸时encode_image_file返回的错误信息
+NO_FACE_ERROR = "未检测到人脸"
+
+
+def encode_image_file(image_path: str, model_type: str = "hog") -> Tuple[str, Optional[np.ndarray], Optional[str]]:
+    """
+    计算单个图像文件中第一张人脸的编码（模块级函数，可在进程池的子进程中执行）
+    
+    Args:
+        image_path: 图像文件路径
+        model_type: 人脸检测模型类型
+        
+    Returns:
+        (图像路径, 面部编码或None, 错误信息或None)
+    """
+    try:
+        image = face_recognition.load_image_file(image_path)
+        face_locations = face_recognition.face_locations(image, model=model_type)
+        if not face_locations:
+            return image_path, None, NO_FACE_ERROR
+        return image_path, face_recognition.face_encodings(image, [face_locations[0]])[0], None
+    except Exception as e:
+        return image_path, None, str(e)
+
+
 class FaceRecognitionUtils:
-    def __init__(self, face_db_dir: str = "static/face_db", model_type: str = "hog", encoding_cache_file: str = "models/face_encodings_cache.pkl"):
+    def __init__(self, face_db_dir: str = "static/face_db", model_type: str = "hog", encoding_cache_file: str = "models/face_encodings_cache.pkl",
+                 index_type: str = "exact", ivf_n_probe: int = 8, encoding_workers: int = 1,
+                 gallery_compression: Optional[str] = None, prototype_medoids: int = 3,
+                 shared_gallery: Optional[str] = None):
         """
         初始化人脸识别工具类
         
         Args:
             face_db_dir: 人脸数据库目录
             model_type: 人脸检测模型类型，可选 'hog'(CPU) 或 'cnn'(GPU)
-            encoding_cache_file: 人脸编码缓存文件
+            encoding_cache_file: 旧版pickle人脸编码缓存文件（仅用于迁移，新缓存保存在同目录的 face_gallery.bin）
+            index_type: 人脸库索引类型，'exact'(精确匹配) 或 'ivf'(近似最近邻，适用于超大人脸库)
+            ivf_n_probe: IVF索引每次查询扫描的簇数量，越大召回率越高、速度越慢
+            encoding_workers: 批量计算人脸编码时使用的进程数，1表示串行计算
+            gallery_compression: 人脸库压缩模式，None表示不压缩；'float16'或'int8'表示把每个学生压缩为
+                                 原型（中心点+若干中心样本）并以该类型存储在索引中
+            prototype_medoids: 压缩模式下每个学生保留的中心样本数量
+            shared_gallery: 共享人脸库名称，同一台机器上预先fork的多个工作进程使用相同名称时共享一份编码矩阵，
+                            一个进程注册的编码其他进程下次查询时即可看到（仅支持未压缩的精确索引）
         """
         self.face_db_dir = face_db_dir
         self.model_type = model_type
         self.encoding_cache_file = encoding_cache_file
-        self.encodings_cache = {}  # 学生ID -> 面部编码列表
+        self.index_type = index_type
+        self.ivf_n_probe = ivf_n_probe
+        self.gallery_compression = gallery_compression
+        self.prototype_medoids = prototype_medoids
+        self.gallery_file = os.path.join(os.path.dirname(encoding_cache_file), "face_gallery.bin")
+        self.index_file = os.path.join(os.path.dirname(encoding_cache_file), "face_encodings_ivf.npz")
+        # 新注册的编码先写入追加日志，定期压缩合并到人脸库文件
+        self.journal = GalleryJournal(os.path.join(os.path.dirname(encoding_cache_file), "face_gallery.journal"))
+        self.journal_compact_threshold = 1000  # 日志记录数达到该值时触发压缩
+        self.encoding_workers = max(1, encoding_workers)
+        self.parallel_min_images = 16  # 待编码图像少于该数量时不启动进程池
+        self.last_encoding_report = None  # 最近一次批量编码的统计信息
+        self.frame_workers = min(4, os.cpu_count() or 1)  # 批量识别时并行检测/编码的线程数
+        self._frame_executor = None
+        
+        # 班级范围识别：班级名单（班级ID -> (加载时间, 学生ID集合)）和按名单划分的人脸库分区
+        self.roster_provider: Optional[Callable[[str], Iterable[str]]] = None  # 按班级ID查询学生ID的回调
+        self._class_rosters: Dict[str, Tuple[float, frozenset]] = {}
+        self._partitions = OrderedDict()  # 名单 -> (人脸库版本, 分区索引)
+        self._partitions_lock = threading.Lock()
+        self.max_partitions = 64
+        # 返回已停用图像路径的回调（如FaceImage.is_active为False的记录），刷新时会跳过这些图像
+        self.inactive_images_provider: Optional[Callable[[], Iterable[str]]] = None
         self.last_cache_update = 0
         self.cache_ttl = 60  # 缓存有效期（秒）
         
+        # 人脸库快照：识别请求无锁读取当前快照；注册和刷新在_write_lock内构建新快照后整体替换。
+        # _head_index是写入方独占的可变索引，新编码追加到它上面，快照中保存的是它的只读视图
+        self._head_index = create_gallery_index(index_type, n_probe=ivf_n_probe)
+        self._snapshot = GallerySnapshot(0, self._head_index.snapshot(), {})
+        self._write_lock = threading.Lock()  # 串行化写入方（注册、重建、快照落盘），读取方不加锁
+        # 重建期间注册的编码：重建基于开始时的快照，替换时需要重新追加这些编码
+        self._appended_during_rebuild: List[Tuple[str, np.ndarray, str, Optional[Tuple[int, int]]]] = []
+        self._rebuild_in_progress = False
+        # 注册的编码增量追加到索引（立即可识别）后索引需要在下次刷新时重建：压缩模式下重新压缩为原型，
+        # 避免原型数无限增长；IVF索引增长到needs_retrain时重新训练聚类中心
+        self._index_dirty = False
+        
+        # 后台刷新：重建在后台线程中完成，完成后原子替换，识别请求只读取最近一次成功的结果
+        self._refresh_lock = threading.Lock()  # 保证同一时间只有一个重建任务
+        self._refresh_thread = None
+        self._refresher_stop = threading.Event()
+        
+        # 多进程共享人脸库：写入方把编码写入共享内存，各进程发现代数变化后重新映射
+        self._shared: Optional[SharedGallery] = None
+        self._shared_generation = 0  # 当前快照对应的共享代数
+        self._shared_segment = 0
+        self._shared_count = 0
+        
+        # 分片匹配：全库查询并行发送到各分片进程后合并，见attach_shards
+        self.shards: Optional[ShardedGallery] = None
+        
         # 加载缓存的面部编码
         self.load_encoding_cache()
+        if shared_gallery:
+            if index_type == "ivf" or gallery_compression:
+                logger.warning("共享人脸库只支持未压缩的精确索引，已禁用")
+            else:
+                self._attach_shared_gallery(shared_gallery)
+    
+    @property
+    def snapshot(self) -> GallerySnapshot:
+        """当前的人脸库快照（不可变，可在任意线程中无锁使用）"""
+        return self._snapshot
+    
+    @property
+    def encodings_cache(self) -> Mapping[str, Tuple[np.ndarray, ...]]:
+        """学生ID -> 面部编码（当前快照的只读映射）"""
+        return self._snapshot.encodings
+    
+    @property
+    def manifest(self) -> Optional[Mapping[str, Dict[str, Any]]]:
+        """图像清单：图像路径 -> {student_id, signature(mtime_ns, size), encoding}，None表示尚未建立"""
+        return self._snapshot.manifest
+    
+    @property
+    def gallery_index(self):
+        """当前快照的人脸库索引"""
+        return self._snapshot.index
+    
+    @property
+    def gallery_version(self) -> int:
+        """当前快照的版本号，人脸库每次变化时递增"""
+        return self._snapshot.version
+    
+    def _publish(self, encodings_cache: Mapping[str, Iterable[np.ndarray]], manifest, index) -> None:
+        """
+        以新的缓存和索引发布一个新快照（调用方需持有_write_lock）
+        
+        index成为新的可写索引，快照中保存其只读视图。共享模式下把编码整体发布到共享人脸库后重新映射，
+        index仅用于单进程模式。
+        """
+        if self.shards is not None:
+            student_ids, rows, _, _ = self._gallery_rows(encodings_cache, manifest)
+            self.shards.replace(student_ids, rows)
+        if self._shared is not None:
+            student_ids, rows, image_paths, signatures = self._gallery_rows(encodings_cache, manifest)
+            self._shared.publish(rows, student_ids, image_paths, signatures, added_at=time.time())
+            self._sync_shared_locked(manifest)
+            return
+        self._head_index = index
+        self._index_dirty = False
+        self._snapshot = GallerySnapshot.create(self._snapshot.version + 1, index.snapshot(), encodings_cache, manifest)
+    
+    def _append_encodings(self, records: List[Tuple[str, np.ndarray, str, Optional[Tuple[int, int]]]]) -> None:
+        """
+        把若干编码追加到人脸库并发布新快照（调用方需持有_write_lock）
+        
+        Args:
+            records: [(学生ID, 编码, 图像路径, 图像签名), ...]
+        """
+        if not records:
+            return
+        if self.shards is not None:
+            self.shards.add([record[0] for record in records], np.asarray([record[1] for record in records]))
+        if self._shared is not None:
+            # 重建期间追加的记录由_sync_shared_locked统一记录（包括其他进程追加的）
+            self._shared.append(records, time.time())
+            self._sync_shared_locked()
+            return
+        for student_id, encoding, _, _ in records:
+            self._head_index.add(student_id, encoding)
+        if self.gallery_compression or (isinstance(self._head_index, IVFGalleryIndex) and self._head_index.needs_retrain):
+            self._index_dirty = True
+        self._snapshot = self._snapshot.with_encodings(self._head_index.snapshot(), records)
+        if self._rebuild_in_progress:
+            self._appended_during_rebuild.extend(records)
+    
+    def attach_shards(self, shards: ShardedGallery) -> None:
+        """
+        启用分片匹配：不限定名单的查询改由各分片并行匹配后合并，所有分片都不可用时回退到本进程的索引
+        
+        本进程仍维护完整的人脸库（清单、日志和落盘），注册和重建时同步到各分片；
+        分片重新连接时按当前快照补齐。按班级名单限定的查询规模较小，仍在本进程中匹配。
+        """
+        shards.source = lambda: self._snapshot.encodings
+        with self._write_lock:
+            snapshot = self._snapshot
+            student_ids, rows, _, _ = self._gallery_rows(snapshot.encodings, snapshot.manifest)
+            shards.replace(student_ids, rows)
+            self.shards = shards
+        logger.info(f"已启用分片匹配，共 {shards.n_shards} 个分片")
+    
+    def _attach_shared_gallery(self, name: str) -> None:
+        """
+        连接共享人脸库
+        
+        共享人脸库为空，或其来源标记与人脸库文件不一致（文件在共享内容之外被替换过）时，
+        用本进程加载的人脸库发布；否则直接使用共享内容（其中可能包含尚未合并到文件的注册）。
+        """
+        try:
+            shared = SharedGallery(name, dim=self._head_index.dim)
+        except Exception as e:
+            logger.error(f"连接共享人脸库出错，使用进程内人脸库: {str(e)}")
+            return
+        
+        with self._write_lock, shared.lock():
+            stamp = self._gallery_file_stamp()
+            if shared.generation == 0 or shared.stamp != stamp:
+                snapshot = self._snapshot
+                student_ids, rows, image_paths, signatures = self._gallery_rows(snapshot.encodings, snapshot.manifest)
+                shared.publish(rows, student_ids, image_paths, signatures, stamp=stamp, added_at=time.time())
+                logger.info(f"已发布共享人脸库 {name}，包含 {len(student_ids)} 条编码")
+            self._shared = shared
+            self._sync_shared_locked()
+        logger.info(f"已连接共享人脸库 {name}（代数 {self._shared_generation}，{self._shared_count} 条编码）")
+    
+    def _gallery_file_stamp(self) -> int:
+        """人脸库文件的修改时间（纳秒），用作共享人脸库的来源标记"""
+        try:
+            return os.stat(self.gallery_file).st_mtime_ns
+        except OSError:
+            return 0
+    
+    def _sync_shared_gallery(self) -> None:
+        """共享人脸库的代数变化时重新映射（代数未变时只是一次内存读取；写入方正忙时本次跳过）"""
+        shared = self._shared
+        if shared is None or shared.generation == self._shared_generation:
+            return
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            self._sync_shared_locked()
+        except Exception as e:
+            logger.error(f"同步共享人脸库出错: {str(e)}")
+        finally:
+            self._write_lock.release()
+    
+    def _sync_shared_locked(self, manifest: Optional[Mapping[str, Dict[str, Any]]] = None) -> None:
+        """
+        按共享人脸库的当前一代发布新快照（调用方需持有_write_lock）
+        
+        数据段未变时只把新增的行追加到快照；数据段切换时（整体重新发布或扩容）重新建立缓存和清单。
+        编码和索引直接引用共享内存中的行，不复制。
+        
+        Args:
+            manifest: 重新建立清单时沿用其中未检测到人脸的图像记录（默认为当前快照的清单），
+                      这些记录不在共享人脸库中
+        """
+        view = self._shared.view()
+        if view.generation == self._shared_generation:
+            return
+        
+        snapshot = self._snapshot
+        index = ExactGalleryIndex.from_matrix(view.matrix, view.student_ids, copy=False, sq_norms=view.sq_norms)
+        mtimes = view.row_meta['mtime_ns'].tolist()
+        sizes = view.row_meta['size'].tolist()
+        
+        def row_signature(row):
+            return (mtimes[row], sizes[row]) if mtimes[row] >= 0 else None
+        
+        if view.segment == self._shared_segment and len(view) >= self._shared_count:
+            records = [(view.student_ids[row], view.matrix[row], view.image_paths[row], row_signature(row))
+                       for row in range(self._shared_count, len(view))]
+            if records:
+                self._snapshot = snapshot.with_encodings(index.snapshot(), records)
+                if self._rebuild_in_progress:
+                    self._appended_during_rebuild.extend(records)
+        else:
+            manifest = manifest if manifest is not None else snapshot.manifest
+            encodings_cache = {}
+            shared_manifest = {}
+            for row, (student_id, image_path) in enumerate(zip(view.student_ids, view.image_paths)):
+                encoding = view.matrix[row]
+                encodings_cache.setdefault(student_id, []).append(encoding)
+                signature = row_signature(row)
+                if image_path and signature is not None:
+                    shared_manifest[image_path] = {"student_id": student_id, "signature": signature, "encoding": encoding}
+            for image_path, entry in (manifest or {}).items():
+                if entry["encoding"] is None and image_path not in shared_manifest:
+                    shared_manifest[image_path] = entry
+            if manifest is None and not shared_manifest:
+                shared_manifest = None
+            self._snapshot = GallerySnapshot.create(snapshot.version + 1, index.snapshot(), encodings_cache, shared_manifest)
+        
+        self._head_index = index
+        self._shared_generation = view.generation
+        self._shared_segment = view.segment
+        self._shared_count = len(view)
     
     def load_encoding_cache(self) -> None:
-        """加载缓存的面部编码"""
-        if os.path.exists(self.encoding_cache_file):
+        """加载缓存的面部编码（二进制人脸库文件不存在时，从旧的pickle缓存迁移），并重放追加日志"""
+        journal_epoch = 0
+        try:
+            if os.path.exists(self.gallery_file):
+                journal_epoch = self._load_gallery_file()
+            elif os.path.exists(self.encoding_cache_file):
+                self._migrate_pickle_cache()
+        except Exception as e:
+            logger.error(f"加载人脸编码缓存出错: {str(e)}")
+            self.last_cache_update = 0
+            with self._write_lock:
+                self._publish({}, None, self.build_gallery_index({}))
+        
+        try:
+            self._replay_journal(journal_epoch)
+        except Exception as e:
+            logger.error(f"重放人脸编码日志出错: {str(e)}")
+    
+    def _replay_journal(self, since_epoch: int) -> None:
+        """把快照之后追加的日志记录应用到内存中的缓存和索引（全部记录一次发布为一个新快照）"""
+        records = [(record.student_id, record.encoding, record.image_path, record.signature)
+                   for record in self.journal.replay(since_epoch)]
+        if records:
+            with self._write_lock:
+                self._append_encodings(records)
+            logger.info(f"已从追加日志恢复 {len(records)} 条人脸编码")
+    
+    def _load_gallery_file(self) -> int:
+        """
+        以内存映射方式加载二进制人脸库文件，编码直接引用映射的只读页，不复制数据
+        
+        Returns:
+            快照已合并到的日志纪元号
+        """
+        stored = read_gallery(self.gallery_file)
+        mtimes = stored.row_meta['mtime_ns'].tolist()
+        sizes = stored.row_meta['size'].tolist()
+        
+        encodings_cache = {}
+        manifest = {} if stored.extra.get('has_manifest') else None
+        for row, (student_id, image_path) in enumerate(zip(stored.student_ids, stored.image_paths)):
+            encoding = stored.matrix[row]
+            encodings_cache.setdefault(student_id, []).append(encoding)
+            if manifest is not None and image_path:
+                manifest[image_path] = {
+                    "student_id": student_id,
+                    "signature": (mtimes[row], sizes[row]),
+                    "encoding": encoding
+                }
+        # 未检测到人脸的图像也记录在清单中，避免每次刷新重复计算
+        if manifest is not None:
+            for image_path, student_id, mtime_ns, size in stored.extra.get('unencodable', []):
+                manifest[image_path] = {"student_id": student_id, "signature": (mtime_ns, size), "encoding": None}
+        
+        if self.index_type == "ivf" or self.gallery_compression:
+            index = self.build_gallery_index(encodings_cache, use_saved_index=True)
+        else:
+            index = ExactGalleryIndex.from_matrix(stored.matrix, stored.student_ids, copy=False)
+        
+        with self._write_lock:
+            self._publish(encodings_cache, manifest, index)
+        self.last_cache_update = stored.timestamp
+        logger.info(f"已加载人脸库文件，包含 {len(encodings_cache)} 个学生，{len(stored)} 条编码")
+        return stored.extra.get('journal_epoch', 0)
+    
+    def _migrate_pickle_cache(self) -> None:
+        """读取旧版pickle缓存并转换为二进制人脸库文件"""
+        with open(self.encoding_cache_file, 'rb') as f:
+            cache_data = pickle.load(f)
+        
+        encodings_cache = cache_data.get('encodings', {})
+        index = self.build_gallery_index(encodings_cache, use_saved_index=True)
+        with self._write_lock:
+            self._publish(encodings_cache, cache_data.get('manifest'), index)
+        self.save_encoding_cache()
+        # 保留旧缓存的时间戳，迁移本身不算一次刷新
+        self.last_cache_update = cache_data.get('timestamp', 0)
+        logger.info(f"已将pickle缓存迁移为人脸库文件 {self.gallery_file}，包含 {len(self.encodings_cache)} 个学生")
+    
+    def rebuild_gallery_index(self, use_saved_index: bool = False) -> None:
+        """
+        根据当前快照的编码重建人脸库索引并发布新快照
+        
+        重建期间持有_write_lock（注册会等待），识别请求继续使用旧快照。
+        
+        Args:
+            use_saved_index: 对于IVF索引，若磁盘上已保存的索引与缓存规模一致，则直接加载而不重新训练
+        """
+        with self._write_lock:
+            snapshot = self._snapshot
+            index = self.build_gallery_index(snapshot.encodings, use_saved_index)
+            self._publish(snapshot.encodings, snapshot.manifest, index)
+    
+    def build_gallery_index(self, encodings_cache: Mapping[str, Iterable[np.ndarray]], use_saved_index: bool = False):
+        """
+        为给定的编码缓存构建一个新的索引（不修改当前索引，可在后台线程中调用）
+        
+        Args:
+            encodings_cache: 学生ID -> 面部编码列表
+            use_saved_index: 对于IVF索引，若磁盘上已保存的索引与缓存规模一致，则直接加载而不重新训练
+        """
+        if self.gallery_compression:
+            # 压缩模式：精确索引直接以量化形式存储原型；IVF索引只减少行数，簇内仍为float32
+            if self.index_type != "ivf":
+                return build_compressed_index(encodings_cache, self.prototype_medoids, self.gallery_compression)
+            encodings_cache = compress_encodings(encodings_cache, self.prototype_medoids)
+        elif self.index_type != "ivf":
+            index = create_gallery_index(self.index_type)
+            index.build(encodings_cache)
+            return index
+        
+        num_encodings = sum(len(encodings) for encodings in encodings_cache.values())
+        if use_saved_index and os.path.exists(self.index_file):
             try:
-                with open(self.encoding_cache_file, 'rb') as f:
-                    cache_data = pickle.load(f)
-                    self.encodings_cache = cache_data.get('encodings', {})
-                    self.last_cache_update = cache_data.get('timestamp', 0)
-                    
-                    logger.info(f"已加载人脸编码缓存，包含 {len(self.encodings_cache)} 个学生")
+                index = IVFGalleryIndex.load(self.index_file, n_probe=self.ivf_n_probe)
+                if len(index) == num_encodings:
+                    logger.info(f"已加载IVF人脸库索引，包含 {len(index)} 条编码")
+                    return index
+                logger.info("IVF索引与编码缓存不一致，重新构建")
             except Exception as e:
-                logger.error(f"加载人脸编码缓存出错: {str(e)}")
-                self.encodings_cache = {}
-                self.last_cache_update = 0
+                logger.error(f"加载IVF索引出错: {str(e)}")
+        
+        # 沿用已训练的聚类中心，人脸库规模变化较大时才重新训练
+        index = create_gallery_index("ivf", n_probe=self.ivf_n_probe)
+        current_index = self.gallery_index
+        if isinstance(current_index, IVFGalleryIndex) and current_index.is_trained:
+            index.centroids = current_index.centroids
+            index.trained_size = current_index.trained_size
+        index.build(encodings_cache)
+        self.save_gallery_index(index)
+        return index
+    
+    def save_gallery_index(self, index=None) -> None:
+        """保存IVF索引到编码缓存文件旁边（精确索引无需保存）"""
+        index = index if index is not None else self.gallery_index
+        if not isinstance(index, IVFGalleryIndex):
+            return
+        try:
+            os.makedirs(os.path.dirname(self.index_file) or ".", exist_ok=True)
+            index.save(self.index_file)
+        except Exception as e:
+            logger.error(f"保存IVF索引出错: {str(e)}")
+    
+    def exact_index(self) -> ExactGalleryIndex:
+        """获取当前快照的精确匹配索引（用作近似索引的后备以及召回率评估的基准）"""
+        return self._snapshot.exact_index()
+    
+    def evaluate_gallery_compression(self, dtype: Optional[str] = None, n_medoids: Optional[int] = None,
+                                     threshold: float = 0.6) -> Dict[str, Any]:
+        """
+        在当前人脸库上评估压缩模式相对完整人脸库的匹配准确率变化
+        
+        Args:
+            dtype: 量化类型，默认使用gallery_compression（未启用压缩时为'int8'）
+            n_medoids: 每个学生的中心样本数量，默认使用prototype_medoids
+            threshold: 识别阈值
+        """
+        return evaluate_compression(
+            self._snapshot.encodings,
+            n_medoids=self.prototype_medoids if n_medoids is None else n_medoids,
+            dtype=dtype or self.gallery_compression or "int8",
+            threshold=threshold
+        )
     
     def save_encoding_cache(self) -> None:
-        """保存面部编码到缓存文件"""
+        """
+        保存面部编码到二进制人脸库文件（写临时文件后原子替换），同时压缩追加日志
+        
+        在写锁内切换日志纪元并取得当前快照：旧纪元的记录全部包含在该快照中，
+        新纪元的记录全部不包含，文件写入成功后再删除旧纪元的日志。快照不可变，写文件时无需复制。
+        不能覆盖仍被映射的文件的平台（Windows）上，先把快照中引用人脸库文件映射的编码复制到内存。
+        """
         try:
-            os.makedirs(os.path.dirname(self.encoding_cache_file), exist_ok=True)
+            with self._write_lock:
+                journal_epoch = self.journal.rotate()
+                if not REPLACE_MAPPED_FILES:
+                    self._detach_gallery_file()
+                snapshot = self._snapshot
+            encodings = snapshot.encodings
+            manifest = snapshot.manifest
+            student_ids, rows, image_paths, signatures = self._gallery_rows(encodings, manifest)
             
-            with open(self.encoding_cache_file, 'wb') as f:
-                cache_data = {
-                    'encodings': self.encodings_cache,
-                    'timestamp': time.time()
-                }
-                pickle.dump(cache_data, f)
+            unencodable = [[image_path, entry["student_id"], *entry["signature"]]
+                           for image_path, entry in (manifest or {}).items()
+                           if entry["encoding"] is None]
+            
+            write_gallery(
+                self.gallery_file,
+                rows,
+                student_ids,
+                image_paths,
+                signatures,
+                extra={"has_manifest": manifest is not None, "unencodable": unencodable, "journal_epoch": journal_epoch}
+            )
+            self.journal.discard_before(journal_epoch)
+            if self._shared is not None:
+                # 共享内容包含文件中的全部编码，记录文件的新标记，重启时无需重新发布
+                self._shared.set_stamp(self._gallery_file_stamp())
                 
             self.last_cache_update = time.time()
-            logger.info(f"已保存人脸编码缓存，包含 {len(self.encodings_cache)} 个学生")
+            logger.info(f"已保存人脸编码缓存，包含 {len(encodings)} 个学生")
         except Exception as e:
             logger.error(f"保存人脸编码缓存出错: {str(e)}")
     
+    def _detach_gallery_file(self) -> None:
+        """
+        把当前快照中引用人脸库文件内存映射的编码复制到内存，以内容相同的新快照发布（调用方需持有_write_lock）
+        
+        之后文件不再被当前快照映射，可以被os.replace覆盖；编码内容不变，分片和共享人脸库无需同步。
+        """
+        snapshot = self._snapshot
+        copies = {}
+        
+        def detach(encoding):
+            if not mapped_from(encoding, self.gallery_file):
+                return encoding
+            if id(encoding) not in copies:
+                copies[id(encoding)] = np.array(encoding)
+            return copies[id(encoding)]
+        
+        encodings = {student_id: [detach(encoding) for encoding in student_encodings]
+                     for student_id, student_encodings in snapshot.encodings.items()}
+        if not copies:
+            return
+        # 清单中的编码与缓存中的是同一个对象（_gallery_rows据此找到每行的图像），复制后保持一致
+        manifest = None
+        if snapshot.manifest is not None:
+            manifest = {image_path: dict(entry, encoding=detach(entry["encoding"]))
+                        for image_path, entry in snapshot.manifest.items()}
+        index = self._head_index
+        if type(index) is ExactGalleryIndex and mapped_from(index.matrix, self.gallery_file):
+            index = ExactGalleryIndex.from_matrix(index.matrix, index.student_ids)
+        self._head_index = index
+        self._snapshot = GallerySnapshot.create(snapshot.version + 1, index.snapshot(), encodings, manifest)
+        logger.info(f"已将 {len(copies)} 条编码从人脸库文件的内存映射复制到内存")
+    
+    def _gallery_rows(self, encodings: Mapping[str, Iterable[np.ndarray]], manifest) -> Tuple[List[str], np.ndarray, List[str], List[Optional[Tuple[int, int]]]]:
+        """
+        把编码缓存展开为平行的行：(学生ID列表, 编码矩阵, 图像路径列表, 图像签名列表)
+        
+        清单中的编码与缓存中的是同一个对象，据此找到每行编码对应的图像（没有时为空路径）。
+        """
+        entries_by_encoding = {id(entry["encoding"]): (image_path, entry)
+                               for image_path, entry in (manifest or {}).items()
+                               if entry["encoding"] is not None}
+        student_ids, rows, image_paths, signatures = [], [], [], []
+        for student_id, student_encodings in encodings.items():
+            for encoding in student_encodings:
+                image_path, entry = entries_by_encoding.get(id(encoding), ("", None))
+                student_ids.append(student_id)
+                rows.append(encoding)
+                image_paths.append(image_path)
+                signatures.append(entry["signature"] if entry else None)
+        matrix = np.asarray(rows, dtype=np.float32).reshape(-1, self._head_index.dim)
+        return student_ids, matrix, image_paths, signatures
+    
     def update_encodings_cache(self, force: bool = False) -> None:
         """
         更新人脸编码缓存
         
+        新的缓存和索引全部构建完成后才替换当前版本，构建失败时保留上一次的结果。
+        
         Args:
-            force: 是否强制更新缓存
+            force: 是否强制更新缓存（强制更新会等待正在进行的重建完成后再执行）
         """
         current_time = time.time()
         
@@ -76,42 +586,251 @@ class FaceRecognitionUtils:
         if not force and current_time - self.last_cache_update < self.cache_ttl:
             return
         
+        # 已有重建任务在进行时，非强制更新直接返回
+        if not self._refresh_lock.acquire(blocking=force):
+            return
+        
+        try:
+            self._rebuild_encodings_cache()
+        finally:
+            self._refresh_lock.release()
+    
+    def _rebuild_dirty_index(self) -> None:
+        """
+        重建注册后需要重建的索引（图像没有变化，不重新扫描）
+        
+        压缩模式下把原样追加的编码与已有编码一起重新压缩为原型；IVF索引沿用旧的聚类中心构建时，
+        规模增长到needs_retrain的条件会重新训练。
+        """
+        with self._write_lock:
+            if not self._index_dirty:
+                return
+            snapshot = self._snapshot
+            index = self.build_gallery_index(snapshot.encodings)
+            self._publish(snapshot.encodings, snapshot.manifest, index)
+        self.save_encoding_cache()
+        logger.info(f"已重建人脸库索引，共 {len(index)} 行")
+    
+    def _rebuild_encodings_cache(self) -> None:
+        """
+        按图像清单增量更新编码缓存和索引，完成后原子替换
+        
+        只对新增或修改过（mtime/大小变化）的图像重新计算编码，已删除或已停用的图像从缓存中移除；
+        没有任何变化时不重建索引也不写缓存文件。
+        """
         logger.info("开始更新人脸编码缓存...")
         
-        # 扫描人脸数据库目录
         try:
-            student_dirs = [d for d in os.listdir(self.face_db_dir) 
-                          if os.path.isdir(os.path.join(self.face_db_dir, d))]
+            with self._write_lock:
+                if self._shared is not None:
+                    # 其他进程已编码的图像不再重复计算
+                    self._sync_shared_locked()
+                old_manifest = self._snapshot.manifest
+                # 记录重建期间注册的编码，替换时重新追加到新快照
+                self._rebuild_in_progress = True
+                self._appended_during_rebuild = []
+            previous = old_manifest or {}
+            inactive_paths = self._inactive_image_paths()
             
-            updated_cache = {}
-            
-            for student_id in student_dirs:
-                student_dir = os.path.join(self.face_db_dir, student_id)
-                image_files = [f for f in os.listdir(student_dir) 
-                             if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-                
-                if not image_files:
+            # 扫描人脸数据库目录，未变化的图像直接沿用清单中的编码
+            manifest = {}
+            pending = []
+            for student_entry in os.scandir(self.face_db_dir):
+                if not student_entry.is_dir():
                     continue
-                
-                # 为每个学生计算面部编码
-                student_encodings = []
-                
-                for img_file in image_files:
-                    img_path = os.path.join(student_dir, img_file)
-                    encoding = self.compute_face_encoding(img_path)
-                    if encoding is not None:
-                        student_encodings.append(encoding)
-                
-                if student_encodings:
-                    updated_cache[student_id] = student_encodings
+                student_id = student_entry.name
+                for file_entry in os.scandir(student_entry.path):
+                    if not file_entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    img_path = file_entry.path
+                    if inactive_paths and os.path.abspath(img_path) in inactive_paths:
+                        continue
+                    
+                    stat = file_entry.stat()
+                    signature = (stat.st_mtime_ns, stat.st_size)
+                    entry = previous.get(img_path)
+                    if entry is not None and entry["student_id"] == student_id and entry["signature"] == signature:
+                        manifest[img_path] = entry
+                    else:
+                        pending.append((img_path, student_id, signature))
+            
+            removed = [path for path in previous if path not in manifest]
+            if old_manifest is not None and not pending and not removed:
+                self.last_cache_update = time.time()
+                if self._index_dirty:
+                    self._rebuild_dirty_index()
+                else:
+                    logger.info("人脸数据库没有变化，跳过更新")
+                return
+            
+            # 只为新增或修改过的图像计算面部编码
+            encodings = self.encode_images([img_path for img_path, _, _ in pending])
+            for img_path, student_id, signature in pending:
+                manifest[img_path] = {
+                    "student_id": student_id,
+                    "signature": signature,
+                    "encoding": encodings.get(img_path)
+                }
             
-            # 更新缓存
-            self.encodings_cache = updated_cache
+            updated_cache = {}
+            for entry in manifest.values():
+                if entry["encoding"] is not None:
+                    updated_cache.setdefault(entry["student_id"], []).append(entry["encoding"])
+            
+            # 先构建新索引，再与缓存一起发布为新快照
+            updated_index = self.build_gallery_index(updated_cache)
+            with self._write_lock:
+                if self._shared is not None:
+                    self._sync_shared_locked()
+                self._rebuild_in_progress = False
+                # 扫描时已经包含的图像不再重复追加
+                appended = [record for record in self._appended_during_rebuild
+                            if not (record[2] and record[2] in manifest)]
+                self._appended_during_rebuild = []
+                self._publish(updated_cache, manifest, updated_index)
+                self._append_encodings(appended)
             self.save_encoding_cache()
             
-            logger.info(f"人脸编码缓存更新完成，包含 {len(self.encodings_cache)} 个学生")
+            logger.info(f"人脸编码缓存更新完成，包含 {len(updated_cache)} 个学生"
+                        f"（新编码 {len(pending)} 张图像，移除 {len(removed)} 张）")
         except Exception as e:
             logger.error(f"更新人脸编码缓存出错: {str(e)}")
+        finally:
+            with self._write_lock:
+                self._rebuild_in_progress = False
+                self._appended_during_rebuild = []
+    
+    def _inactive_image_paths(self) -> set:
+        """获取已停用图像的绝对路径集合"""
+        if self.inactive_images_provider is None:
+            return set()
+        try:
+            return {os.path.abspath(path) for path in self.inactive_images_provider()}
+        except Exception as e:
+            logger.error(f"获取已停用图像列表出错: {str(e)}")
+            return set()
+    
+    def refresh_in_background(self) -> None:
+        """缓存过期时在后台线程中更新，不阻塞调用者"""
+        self._sync_shared_gallery()
+        if time.time() - self.last_cache_update < self.cache_ttl or self._refresh_lock.locked():
+            return
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        
+        self._refresh_thread = threading.Thread(target=self.update_encodings_cache, name="gallery-refresh", daemon=True)
+        self._refresh_thread.start()
+    
+    def start_background_refresh(self, interval: Optional[float] = None) -> None:
+        """
+        启动后台定时刷新线程
+        
+        Args:
+            interval: 刷新间隔（秒），默认为cache_ttl
+        """
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        
+        interval = interval or self.cache_ttl
+        self._refresher_stop.clear()
+        
+        def _run():
+            # 启动后立即检查一次，之后按间隔定时更新
+            while True:
+                self.update_encodings_cache()
+                self.compact_journal()
+                if self._refresher_stop.wait(interval):
+                    break
+        
+        self._refresh_thread = threading.Thread(target=_run, name="gallery-refresher", daemon=True)
+        self._refresh_thread.start()
+        logger.info(f"已启动人脸编码缓存后台刷新线程，间隔 {interval} 秒")
+    
+    def compact_journal(self) -> None:
+        """把追加日志合并到人脸库文件（日志为空时不做任何事）"""
+        if self.journal.record_count == 0:
+            return
+        # 与重建共用一把锁：重建完成时本身就会写入完整快照
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            logger.info(f"开始压缩人脸编码日志（{self.journal.record_count} 条记录）")
+            self.save_encoding_cache()
+            self.save_gallery_index()
+        finally:
+            self._refresh_lock.release()
+    
+    def stop_background_refresh(self) -> None:
+        """停止后台定时刷新线程"""
+        self._refresher_stop.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join(timeout=5)
+            self._refresh_thread = None
+    
+    def encode_images(self, image_paths: List[str], workers: Optional[int] = None,
+                      chunksize: Optional[int] = None) -> Dict[str, Optional[np.ndarray]]:
+        """
+        批量计算图像文件的人脸编码
+        
+        图像数量足够多且workers大于1时，把图像分块分发到进程池并行计算，否则串行计算。
+        每张图像的错误单独记录，不影响其他图像；统计信息（含吞吐量）保存在last_encoding_report中。
+        
+        Args:
+            image_paths: 图像文件路径列表
+            workers: 进程数，默认使用encoding_workers
+            chunksize: 每次分发给子进程的图像数，默认按进程数自动计算
+            
+        Returns:
+            图像路径 -> 面部编码（未检测到人脸或出错时为None）
+        """
+        workers = workers or self.encoding_workers
+        start_time = time.time()
+        results = []
+        
+        if workers > 1 and len(image_paths) >= self.parallel_min_images:
+            chunksize = chunksize or max(1, len(image_paths) // (workers * 4))
+            # 使用spawn启动子进程：Windows不支持fork，Linux上从多线程的服务进程fork也不安全
+            # （子进程可能继承其他线程持有的锁）。子进程只执行模块级的encode_image_file
+            try:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    results = list(executor.map(encode_image_file, image_paths,
+                                                [self.model_type] * len(image_paths), chunksize=chunksize))
+            except Exception as e:
+                # 无法创建进程池或子进程异常退出时改为串行计算，不影响人脸库刷新
+                logger.warning(f"进程池编码失败，改为串行计算: {str(e)}")
+                results = []
+        if not results:
+            workers = 1
+            results = [encode_image_file(image_path, self.model_type) for image_path in image_paths]
+        
+        encodings = {}
+        failed = []
+        no_face = 0
+        for image_path, encoding, error in results:
+            encodings[image_path] = encoding
+            if encoding is not None:
+                continue
+            if error == NO_FACE_ERROR:
+                no_face += 1
+                logger.warning(f"在图像 {image_path} 中未检测到人脸")
+            else:
+                failed.append((image_path, error))
+                logger.error(f"计算面部编码出错 ({image_path}): {error}")
+        
+        elapsed = time.time() - start_time
+        self.last_encoding_report = {
+            "total": len(image_paths),
+            "encoded": len(image_paths) - no_face - len(failed),
+            "no_face": no_face,
+            "failed": failed,
+            "workers": workers,
+            "seconds": elapsed,
+            "images_per_sec": len(image_paths) / elapsed if elapsed > 0 else 0.0
+        }
+        if image_paths:
+            logger.info(f"人脸编码完成: {len(image_paths)} 张图像，{workers} 个进程，"
+                        f"耗时 {elapsed:.2f} 秒，{self.last_encoding_report['images_per_sec']:.1f} 张/秒")
+        return encodings
     
     def compute_face_encoding(self, image_path: str) -> Optional[np.ndarray]:
         """
@@ -123,24 +842,12 @@ class FaceRecognitionUtils:
         Returns:
             面部编码向量或None（如果未检测到人脸）
         """
-        try:
-            # 加载图像
-            image = face_recognition.load_image_file(image_path)
-            
-            # 检测人脸位置
-            face_locations = face_recognition.face_locations(image, model=self.model_type)
-            
-            if not face_locations:
-                logger.warning(f"在图像 {image_path} 中未检测到人脸")
-                return None
-            
-            # 使用第一个检测到的人脸
-            face_encoding = face_recognition.face_encodings(image, [face_locations[0]])[0]
-            return face_encoding
-            
-        except Exception as e:
-            logger.error(f"计算面部编码出错 ({image_path}): {str(e)}")
-            return None
+        _, face_encoding, error = encode_image_file(image_path, self.model_type)
+        if error == NO_FACE_ERROR:
+            logger.warning(f"在图像 {image_path} 中未检测到人脸")
+        elif error:
+            logger.error(f"计算面部编码出错 ({image_path}): {error}")
+        return face_encoding
     
     def compute_face_encoding_from_image(self, image: np.ndarray) -> Optional[np.ndarray]:
         """
@@ -171,16 +878,37 @@ class FaceRecognitionUtils:
             logger.error(f"从图像计算面部编码出错: {str(e)}")
             return None
     
-    def recognize_face(self, image: np.ndarray, threshold: float = 0.6) -> Dict[str, Any]:
+    def warm_up(self, frame: np.ndarray) -> None:
+        """
+        预热识别路径：对合成帧做一次识别（人脸检测、人脸库刷新检查），再在帧中央的固定区域计算一次编码
+        并与人脸库比对，加载编码模型、触发人脸库矩阵的首次访问
+        """
+        self.recognize_face(frame)
+        height, width = frame.shape[:2]
+        location = (height // 4, width * 3 // 4, height * 3 // 4, width // 4)
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        face_encoding = face_recognition.face_encodings(rgb, [location])[0]
+        if len(self.gallery_index) > 0:
+            self.match_encoding(face_encoding)
+    
+    def recognize_face(self, image: np.ndarray, threshold: float = 0.6, class_id: Optional[str] = None,
+                       student_ids: Optional[Iterable[str]] = None, fallback_to_global: bool = False,
+                       analysis: Optional[FrameAnalysis] = None,
+                       cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
         """
         识别图像中的人脸
         
         Args:
             image: 图像数组(BGR格式)
             threshold: 匹配阈值，值越小越严格
+            class_id: 只在该班级的学生中匹配
+            student_ids: 只在给定的学生名单（如本次考勤的名单）中匹配，优先于class_id
+            fallback_to_global: 班级/名单范围内没有达到阈值的匹配时，是否再与全部人脸库比对
+            analysis: 同一帧的分析对象，复用活体检测时已计算的RGB图和人脸框
+            cancel: 取消信号（如与识别并行的活体检测未通过），在人脸检测和编码之后检查，已设置时不再继续
             
         Returns:
-            包含识别结果的字典
+            包含识别结果的字典（被取消时cancelled为True）
         """
         result = {
             "success": False,
@@ -188,48 +916,45 @@ class FaceRecognitionUtils:
             "student_name": None,
             "similarity": 0.0,
             "face_location": None,
+            "scope": "global",
             "message": "未识别到人脸"
         }
         
-        # 更新编码缓存
-        self.update_encodings_cache()
+        # 缓存过期时在后台更新，本次请求使用当前版本的人脸库
+        self.refresh_in_background()
         
         # 如果缓存为空，则无法识别
-        if not self.encodings_cache:
+        if len(self.gallery_index) == 0:
             result["message"] = "人脸数据库为空"
             return result
         
         # 检测人脸并计算编码
         try:
-            # 转换为RGB（face_recognition需要）
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # 检测人脸位置
-            face_locations = face_recognition.face_locations(rgb_image, model=self.model_type)
-            
-            if not face_locations:
+            if cancel is not None and cancel.is_set():
+                return dict(result, message="识别已取消", cancelled=True)
+            face_location, face_encoding = self._encode_largest_face(image, analysis, cancel)
+            if cancel is not None and cancel.is_set():
+                return dict(result, message="识别已取消", cancelled=True)
+            if face_encoding is None:
                 return result
             
-            # 使用最大的人脸（假设是最接近的）
-            face_areas = [(loc[2]-loc[0])*(loc[3]-loc[1]) for loc in face_locations]
-            largest_face_idx = face_areas.index(max(face_areas))
-            face_location = face_locations[largest_face_idx]
-            
-            # 计算人脸编码
-            face_encoding = face_recognition.face_encodings(rgb_image, [face_location])[0]
-            
-            # 与数据库中的人脸进行比对
+            # 与数据库中的人脸进行比对（一次矩阵运算）
             best_match = None
             highest_similarity = 0.0
             
-            for student_id, encodings in self.encodings_cache.items():
-                for encoding in encodings:
-                    # 计算相似度（1 - 距离）
-                    similarity = 1 - face_recognition.face_distance([encoding], face_encoding)[0]
-                    
-                    if similarity > highest_similarity:
-                        highest_similarity = similarity
-                        best_match = student_id
+            scoped = student_ids is not None or class_id is not None
+            matches = self.match_encoding(face_encoding, class_id=class_id, student_ids=student_ids)
+            if matches and matches[0][1] > highest_similarity:
+                best_match, highest_similarity = matches[0]
+            if scoped:
+                result["scope"] = "roster" if student_ids is not None else "class"
+            
+            # 范围内没有达到阈值的匹配时，按需回退到全部人脸库
+            if scoped and highest_similarity < threshold and fallback_to_global:
+                global_matches = self.match_encoding(face_encoding)
+                if global_matches and global_matches[0][1] > highest_similarity:
+                    best_match, highest_similarity = global_matches[0]
+                    result["scope"] = "global"
             
             # 检查是否达到阈值
             if highest_similarity >= threshold:
@@ -250,13 +975,375 @@ class FaceRecognitionUtils:
             
         return result
     
-    def add_face_encoding(self, student_id: str, image: np.ndarray) -> Dict[str, Any]:
+    def _encode_largest_face(self, image: np.ndarray, analysis: Optional[FrameAnalysis] = None,
+                             cancel: Optional[threading.Event] = None):
+        """
+        检测图像中最大的人脸（假设是最接近的）并计算其编码
+        
+        RGB图（face_recognition需要）和人脸位置由帧分析对象计算，活体检测已算过时直接复用。
+        
+        Returns:
+            (人脸位置, 人脸编码)，未检测到人脸时为 (None, None)，cancel已设置时不计算编码（编码为None）
+        """
+        analysis = FrameAnalysis.of(image, analysis)
+        face_locations = analysis.face_locations(self.model_type)
+        if not face_locations:
+            return None, None
+        
+        face_areas = [(loc[2]-loc[0])*(loc[3]-loc[1]) for loc in face_locations]
+        face_location = face_locations[face_areas.index(max(face_areas))]
+        if cancel is not None and cancel.is_set():
+            # 已取消时跳过编码（编码是识别中最耗时的一步）
+            return face_location, None
+        return face_location, face_recognition.face_encodings(analysis.rgb, [face_location])[0]
+    
+    def recognize_frames(self, images: List[np.ndarray], threshold: float = 0.6, class_id: Optional[str] = None,
+                         student_ids: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """
+        批量识别多帧图像（每帧取最大的人脸），如离线缓存后补传的考勤画面
+        
+        各帧的人脸检测和编码在线程池中并行进行（dlib和OpenCV计算时释放GIL），
+        所有帧的编码再一次性与人脸库比对。
+        
+        Args:
+            images: BGR图像列表，无法解码的帧可以传None
+            threshold: 匹配阈值
+            class_id: 只在该班级的学生中匹配
+            student_ids: 只在给定的学生名单中匹配，优先于class_id
+            
+        Returns:
+            与images一一对应的识别结果（字段与recognize_face相同）
+        """
+        results = [{
+            "success": False,
+            "student_id": None,
+            "student_name": None,
+            "similarity": 0.0,
+            "face_location": None,
+            "scope": "roster" if student_ids is not None else "class" if class_id is not None else "global",
+            "message": "未识别到人脸" if image is not None else "无法解码图像"
+        } for image in images]
+        
+        self.refresh_in_background()
+        
+        if len(self.gallery_index) == 0:
+            for result in results:
+                result["message"] = "人脸数据库为空"
+            return results
+        
+        def encode(image):
+            if image is None:
+                return None, None
+            try:
+                return self._encode_largest_face(image)
+            except Exception as e:
+                logger.error(f"批量识别中处理图像出错: {str(e)}")
+                return None, None
+        
+        if self._frame_executor is None:
+            self._frame_executor = ThreadPoolExecutor(max_workers=self.frame_workers)
+        encoded = list(self._frame_executor.map(encode, images))
+        
+        query_frames = [i for i, (_, encoding) in enumerate(encoded) if encoding is not None]
+        if not query_frames:
+            return results
+        
+        try:
+            all_matches = self.match_encodings(np.asarray([encoded[i][1] for i in query_frames]),
+                                               class_id=class_id, student_ids=student_ids)
+        except Exception as e:
+            logger.error(f"批量人脸比对出错: {str(e)}")
+            for i in query_frames:
+                results[i]["message"] = f"识别过程出错: {str(e)}"
+            return results
+        
+        for frame_idx, matches in zip(query_frames, all_matches):
+            result = results[frame_idx]
+            result["face_location"] = encoded[frame_idx][0]
+            student_id, similarity = matches[0] if matches else (None, 0.0)
+            result["similarity"] = float(similarity)
+            if student_id is not None and similarity >= threshold:
+                result["success"] = True
+                result["student_id"] = student_id
+                result["student_name"] = student_id
+                result["message"] = "人脸识别成功"
+            else:
+                result["message"] = "未找到匹配的人脸"
+        return results
+    
+    def recognize_faces(self, image: np.ndarray, threshold: float = 0.6, class_id: Optional[str] = None,
+                        student_ids: Optional[Iterable[str]] = None,
+                        analysis: Optional[FrameAnalysis] = None) -> Dict[str, Any]:
+        """
+        识别图像中的所有人脸（合影、广角摄像头画面）
+        
+        所有人脸位置一次性交给face_encodings批量编码，再与人脸库做一次矩阵对矩阵的比对；
+        按相似度从高到低贪心分配，同一个学生最多分配给一张人脸。
+        
+        Args:
+            image: 图像数组(BGR格式)
+            threshold: 匹配阈值
+            class_id: 只在该班级的学生中匹配
+            student_ids: 只在给定的学生名单中匹配，优先于class_id
+            analysis: 同一帧的分析对象（合影中人脸较小时可传入upsample=1的分析对象）
+            
+        Returns:
+            包含每张人脸识别结果的字典
+        """
+        result = {
+            "success": False,
+            "faces": [],
+            "face_count": 0,
+            "matched_count": 0,
+            "scope": "roster" if student_ids is not None else "class" if class_id is not None else "global",
+            "message": "未识别到人脸"
+        }
+        
+        self.refresh_in_background()
+        
+        if len(self.gallery_index) == 0:
+            result["message"] = "人脸数据库为空"
+            return result
+        
+        try:
+            analysis = FrameAnalysis.of(image, analysis)
+            face_locations = analysis.face_locations(self.model_type)
+            if not face_locations:
+                return result
+            
+            # 一次调用计算所有人脸的编码
+            face_encodings = face_recognition.face_encodings(analysis.rgb, face_locations)
+            
+            # 每张人脸取足够多的候选学生：最坏情况下其他人脸各占用一个候选
+            candidates = self.match_encodings(np.asarray(face_encodings), top_k=len(face_locations),
+                                              class_id=class_id, student_ids=student_ids)
+            assignments = self._assign_unique_students(candidates, threshold)
+            
+            for face_idx, face_location in enumerate(face_locations):
+                student_id, similarity = assignments.get(face_idx, (None, 0.0))
+                if student_id is None and candidates[face_idx]:
+                    # 未分配的人脸报告其最相似的候选，便于排查阈值
+                    similarity = candidates[face_idx][0][1]
+                result["faces"].append({
+                    "student_id": student_id,
+                    "similarity": float(similarity),
+                    "face_location": face_location,
+                    "matched": student_id is not None
+                })
+            
+            result["face_count"] = len(face_locations)
+            result["matched_count"] = len(assignments)
+            result["success"] = bool(assignments)
+            result["message"] = (f"检测到 {len(face_locations)} 张人脸，识别出 {len(assignments)} 名学生"
+                                 if assignments else "未找到匹配的人脸")
+        except Exception as e:
+            logger.error(f"多人脸识别过程出错: {str(e)}")
+            result["message"] = f"识别过程出错: {str(e)}"
+        
+        return result
+    
+    @staticmethod
+    def _assign_unique_students(candidates: List[List[Tuple[str, float]]], threshold: float) -> Dict[int, Tuple[str, float]]:
+        """
+        按相似度从高到低贪心地把学生分配给人脸，每张人脸、每个学生最多分配一次
+        
+        Args:
+            candidates: 每张人脸的候选 [(学生ID, 相似度), ...]
+            threshold: 相似度低于该值的候选不参与分配
+            
+        Returns:
+            人脸序号 -> (学生ID, 相似度)
+        """
+        pairs = [(similarity, face_idx, student_id)
+                 for face_idx, face_candidates in enumerate(candidates)
+                 for student_id, similarity in face_candidates
+                 if similarity >= threshold]
+        pairs.sort(key=lambda pair: pair[0], reverse=True)
+        
+        assignments = {}
+        assigned_students = set()
+        for similarity, face_idx, student_id in pairs:
+            if face_idx in assignments or student_id in assigned_students:
+                continue
+            assignments[face_idx] = (student_id, similarity)
+            assigned_students.add(student_id)
+        return assignments
+    
+    def match_encodings(self, face_encodings: np.ndarray, top_k: int = 1, class_id: Optional[str] = None,
+                        student_ids: Optional[Iterable[str]] = None) -> List[List[Tuple[str, float]]]:
+        """
+        将多个人脸编码一次性与人脸库比对（精确索引为一次矩阵运算）
+        
+        Args:
+            face_encodings: 查询编码矩阵 (Q, dim)
+            top_k: 每个查询返回最相似的学生数量
+            class_id: 只与该班级的学生比对
+            student_ids: 只与给定名单中的学生比对，优先于class_id
+            
+        Returns:
+            每个查询一个 [(学生ID, 相似度), ...] 列表
+        """
+        # 整个查询只使用同一个快照
+        self._sync_shared_gallery()
+        snapshot = self._snapshot
+        if student_ids is not None or class_id is not None:
+            roster = frozenset(student_ids) if student_ids is not None else self.get_class_roster(class_id)
+            index = self.partition_index(roster, snapshot)
+        else:
+            index = self.shards if self.shards is not None else snapshot.index
+        
+        try:
+            if index is self.shards:
+                results = self._search_shards(face_encodings, top_k, snapshot)
+            else:
+                results = index.search_batch(face_encodings, k=top_k)
+        except Exception as e:
+            if index is self.shards or (index is snapshot.index and index is not snapshot.exact_index()):
+                logger.error(f"{'分片' if index is self.shards else '近似索引'}批量查询出错，改用精确匹配: {str(e)}")
+                results = snapshot.exact_index().search_batch(face_encodings, k=top_k)
+            else:
+                raise
+        return [[(student_id, 1 - distance) for student_id, distance in matches] for matches in results]
+    
+    def _search_shards(self, face_encodings: np.ndarray, top_k: int,
+                       snapshot: GallerySnapshot) -> List[List[Tuple[str, float]]]:
+        """
+        在各分片上查询，未应答（超时、忙或已退出）分片中的学生改在本地快照的对应分区中补查后合并
+        
+        Returns:
+            每个查询一个 [(学生ID, 距离), ...] 列表
+        """
+        results, missing = self.shards.search_batch(face_encodings, k=top_k)
+        if not missing:
+            return results
+        missing = set(missing)
+        logger.warning(f"分片 {sorted(missing)} 未应答，在本地人脸库中补查这些分片的学生")
+        roster = frozenset(student_id for student_id in snapshot.encodings
+                           if shard_for(student_id, self.shards.n_shards) in missing)
+        local_results = self.partition_index(roster, snapshot).search_batch(face_encodings, k=top_k)
+        return [merge_results((matches, local_matches), top_k)
+                for matches, local_matches in zip(results, local_results)]
+    
+    def match_encoding(self, face_encoding: np.ndarray, top_k: int = 1, exact: bool = False,
+                       class_id: Optional[str] = None, student_ids: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        将人脸编码与人脸库比对
+        
+        Args:
+            face_encoding: 查询的人脸编码
+            top_k: 返回最相似的学生数量
+            exact: 是否强制使用精确匹配
+            class_id: 只与该班级的学生比对
+            student_ids: 只与给定名单中的学生比对，优先于class_id
+            
+        Returns:
+            [(学生ID, 相似度), ...]，相似度为 1 - 欧氏距离，按相似度降序排列
+        """
+        # 整个查询只使用同一个快照
+        self._sync_shared_gallery()
+        snapshot = self._snapshot
+        if student_ids is not None or class_id is not None:
+            roster = frozenset(student_ids) if student_ids is not None else self.get_class_roster(class_id)
+            matches = self.partition_index(roster, snapshot).search(face_encoding, k=top_k)
+            return [(student_id, 1 - distance) for student_id, distance in matches]
+        
+        if exact:
+            index = snapshot.exact_index()
+        else:
+            index = self.shards if self.shards is not None else snapshot.index
+        try:
+            if index is self.shards:
+                matches = self._search_shards(face_encoding, top_k, snapshot)[0]
+            else:
+                matches = index.search(face_encoding, k=top_k)
+        except Exception as e:
+            if index is snapshot.exact_index():
+                raise
+            logger.error(f"{'分片' if index is self.shards else '近似索引'}查询出错，回退到精确匹配: {str(e)}")
+            matches = snapshot.exact_index().search(face_encoding, k=top_k)
+        return [(student_id, 1 - distance) for student_id, distance in matches]
+    
+    def get_class_roster(self, class_id: str) -> frozenset:
+        """获取班级的学生ID集合（通过roster_provider查询，按cache_ttl缓存）"""
+        cached = self._class_rosters.get(class_id)
+        if cached is not None and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+        
+        roster = frozenset()
+        if self.roster_provider is not None:
+            try:
+                roster = frozenset(self.roster_provider(class_id))
+            except Exception as e:
+                logger.error(f"获取班级 {class_id} 的学生名单出错: {str(e)}")
+                # 查询失败时继续使用旧名单
+                return cached[1] if cached is not None else roster
+        self._class_rosters[class_id] = (time.time(), roster)
+        return roster
+    
+    def set_class_roster(self, class_id: str, student_ids: Iterable[str]) -> None:
+        """直接设置班级的学生名单"""
+        self._class_rosters[class_id] = (time.time(), frozenset(student_ids))
+    
+    def invalidate_class_roster(self, class_id: Optional[str] = None) -> None:
+        """清除班级名单缓存（class_id为None时清除全部），下次识别时重新查询"""
+        if class_id is None:
+            self._class_rosters.clear()
+        else:
+            self._class_rosters.pop(class_id, None)
+    
+    def partition_index(self, roster: frozenset, snapshot: Optional[GallerySnapshot] = None) -> ExactGalleryIndex:
+        """
+        获取只包含名单中学生的人脸库分区
+        
+        分区按名单缓存在内存中（最多max_partitions个），人脸库变化后在下次使用时重建。
+        
+        Args:
+            roster: 学生ID集合
+            snapshot: 从哪个快照划分，默认为当前快照
+        """
+        snapshot = snapshot if snapshot is not None else self._snapshot
+        with self._partitions_lock:
+            cached = self._partitions.get(roster)
+            if cached is not None and cached[0] == snapshot.version:
+                self._partitions.move_to_end(roster)
+                return cached[1]
+        
+        encodings = {student_id: snapshot.encodings[student_id]
+                     for student_id in roster if student_id in snapshot.encodings}
+        if self.gallery_compression:
+            index = build_compressed_index(encodings, self.prototype_medoids, self.gallery_compression)
+        else:
+            index = ExactGalleryIndex.from_encodings(encodings)
+        
+        with self._partitions_lock:
+            # 较旧快照的分区不覆盖较新的
+            cached = self._partitions.get(roster)
+            if cached is None or cached[0] <= snapshot.version:
+                self._partitions[roster] = (snapshot.version, index)
+                self._partitions.move_to_end(roster)
+            while len(self._partitions) > self.max_partitions:
+                self._partitions.popitem(last=False)
+        return index
+    
+    def _manifest_path(self, image_path: str) -> str:
+        """
+        图像在清单中的路径：人脸库目录中的图像与重建时扫描得到的路径写法一致（face_db_dir/学生ID/文件名），
+        调用方传入绝对路径或相对路径都能与清单对应，刷新时不会把同一张图像当作新图像再编码一次
+        """
+        abs_path = os.path.abspath(image_path)
+        relative = os.path.relpath(abs_path, os.path.abspath(self.face_db_dir))
+        if relative.startswith(os.pardir + os.sep) or os.path.isabs(relative):
+            return image_path
+        return os.path.join(self.face_db_dir, relative)
+    
+    def add_face_encoding(self, student_id: str, image: np.ndarray, image_path: Optional[str] = None) -> Dict[str, Any]:
         """
         添加新的人脸编码到缓存
         
         Args:
             student_id: 学生ID
             image: 图像数组(BGR格式)
+            image_path: 图像已保存到人脸库时的路径，记录到图像清单后刷新时无需重新编码
             
         Returns:
             操作结果字典
@@ -273,15 +1360,21 @@ class FaceRecognitionUtils:
             result["message"] = "未检测到人脸，无法添加"
             return result
         
-        # 更新缓存
-        if student_id in self.encodings_cache:
-            self.encodings_cache[student_id].append(face_encoding)
-        else:
-            self.encodings_cache[student_id] = [face_encoding]
+        signature = None
+        if image_path and os.path.exists(image_path):
+            stat = os.stat(image_path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            image_path = self._manifest_path(image_path)
         
-        # 保存更新后的缓存
-        self.save_encoding_cache()
+        # 发布包含新编码的快照，并追加到日志（不再重写整个人脸库文件）；识别请求不等待这把锁
+        with self._write_lock:
+            self._append_encodings([(student_id, face_encoding, image_path or "", signature)])
+            self.journal.append(student_id, face_encoding, image_path or "", signature)
+        
+        # 日志过长时在后台压缩
+        if self.journal.record_count >= self.journal_compact_threshold:
+            threading.Thread(target=self.compact_journal, name="gallery-compact", daemon=True).start()
         
         result["success"] = True
         result["message"] = "成功添加人脸编码"
-        return result 
\ No newline at end of file
+        return result
@@ -0,0 +1,129 @@
+import cv2
+import numpy as np
+import dlib
+import face_recognition
+import threading
+from typing import Dict, List, Tuple, Any
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('frame_analysis')
+
+_default_detector = None
+_default_detector_lock = threading.Lock()
+
+
+def get_default_face_detector():
+    """进程内共享的dlib正面人脸检测器（各检测器使用的是同一个模型，无需各自创建）"""
+    global _default_detector
+    if _default_detector is None:
+        with _default_detector_lock:
+            if _default_detector is None:
+                _default_detector = dlib.get_frontal_face_detector()
+    return _default_detector
+
+
+class FrameAnalysis:
+    """
+    单帧图像的分析结果
+
+    灰度图、RGB图、人脸框和特征点都在第一次用到时计算并缓存，同一帧交给多个活体检测器和
+    人脸识别时共用这些结果：无论有几个模块使用，颜色转换和人脸检测都只做一次。
+    face_recognition的HOG检测器与dlib正面人脸检测器是同一个模型，因此HOG模式下识别直接
+    复用dlib的人脸框（换算为 (top, right, bottom, left)）。
+    活体检测和识别可以在不同线程中并发使用同一个分析对象，人脸检测加锁，后到的线程等待并复用结果。
+    """
+
+    def __init__(self, frame: np.ndarray, upsample: int = 0):
+        """
+        Args:
+            frame: BGR图像
+            upsample: dlib人脸检测的上采样次数（0与活体检测器原有设置一致，1可检测更小的人脸但更慢）
+        """
+        self.frame = frame
+        self.upsample = upsample
+        self._gray = None
+        self._rgb = None
+        self._dlib_faces = None
+        self._face_locations: Dict[str, List[Tuple[int, int, int, int]]] = {}
+        self._landmarks: Dict[int, List[np.ndarray]] = {}
+        self._haar_faces: Dict[Tuple, Any] = {}
+        self._faces_lock = threading.RLock()  # 人脸检测只做一次
+
+    @classmethod
+    def of(cls, frame: np.ndarray, analysis: 'FrameAnalysis' = None) -> 'FrameAnalysis':
+        """返回传入的分析对象，没有时为frame新建一个"""
+        return analysis if analysis is not None else cls(frame)
+
+    @property
+    def gray(self) -> np.ndarray:
+        """灰度图"""
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def rgb(self) -> np.ndarray:
+        """RGB图（face_recognition需要）"""
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    def dlib_faces(self):
+        """dlib检测到的人脸框（dlib.rectangles）"""
+        if self._dlib_faces is None:
+            with self._faces_lock:
+                if self._dlib_faces is None:
+                    self._dlib_faces = get_default_face_detector()(self.gray, self.upsample)
+        return self._dlib_faces
+
+    def face_locations(self, model: str = "hog") -> List[Tuple[int, int, int, int]]:
+        """
+        face_recognition格式的人脸位置 [(top, right, bottom, left), ...]
+
+        Args:
+            model: 'hog' 复用dlib人脸框；'cnn' 调用face_recognition的CNN检测器
+        """
+        if model not in self._face_locations:
+            with self._faces_lock:
+                if model == "hog":
+                    height, width = self.frame.shape[:2]
+                    self._face_locations[model] = [
+                        (max(face.top(), 0), min(face.right(), width), min(face.bottom(), height), max(face.left(), 0))
+                        for face in self.dlib_faces()
+                    ]
+                elif model not in self._face_locations:
+                    self._face_locations[model] = face_recognition.face_locations(
+                        self.rgb, number_of_times_to_upsample=self.upsample, model=model)
+        return self._face_locations[model]
+
+    def landmarks(self, predictor) -> List[np.ndarray]:
+        """
+        所有人脸的68个特征点坐标，每张人脸一个 (68, 2) 的int数组
+
+        Args:
+            predictor: dlib.shape_predictor，结果按预测器缓存
+        """
+        key = id(predictor)
+        if key not in self._landmarks:
+            landmarks = []
+            for face in self.dlib_faces():
+                shape = predictor(self.gray, face)
+                landmarks.append(np.array([(point.x, point.y) for point in shape.parts()], dtype=int))
+            self._landmarks[key] = landmarks
+        return self._landmarks[key]
+
+    def haar_faces(self, cascade, scale_factor: float = 1.1, min_neighbors: int = 5,
+                   min_size: Tuple[int, int] = (30, 30)):
+        """
+        Haar级联检测到的人脸框 [(x, y, w, h), ...]
+
+        Args:
+            cascade: cv2.CascadeClassifier，结果按分类器缓存
+        """
+        key = (id(cascade), scale_factor, min_neighbors, min_size)
+        if key not in self._haar_faces:
+            self._haar_faces[key] = cascade.detectMultiScale(
+                self.gray, scaleFactor=scale_factor, minNeighbors=min_neighbors, minSize=min_size)
+        return self._haar_faces[key]
@@ -0,0 +1,305 @@
+import numpy as np
+from typing import Dict, List, Tuple, Any
+import logging
+
+from models.gallery_index import ExactGalleryIndex
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('gallery_compression')
+
+# 支持的编码存储类型：float16 直接截断精度；int8 每行一个缩放系数，编码 ≈ codes * scale
+QUANTIZATION_TYPES = ("float32", "float16", "int8")
+
+# 计算距离时每次反量化的行数，限制临时float32矩阵的大小
+DEQUANTIZE_BLOCK_ROWS = 65536
+
+
+def select_prototypes(encodings: np.ndarray, n_medoids: int = 3, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    把一个学生的多条编码压缩为有限个原型：所有编码的中心点加上n_medoids个中心样本（medoid）
+
+    先用k-means把编码分成n_medoids组，每组取离组中心最近的真实编码作为中心样本；
+    中心点代表学生的平均特征，中心样本保留光照、角度等不同拍摄条件下的特征。
+    编码数不超过 n_medoids + 1 时原样返回。
+
+    Args:
+        encodings: 编码矩阵 (n, dim)
+        n_medoids: 中心样本数量
+        iters: k-means迭代次数
+        seed: 随机种子
+
+    Returns:
+        原型矩阵 (m, dim)，m <= n_medoids + 1
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    if len(encodings) <= n_medoids + 1:
+        return encodings.copy()
+
+    centroid = encodings.mean(axis=0, keepdims=True)
+    if n_medoids <= 0:
+        return centroid
+
+    rng = np.random.default_rng(seed)
+    centers = encodings[rng.choice(len(encodings), n_medoids, replace=False)]
+    for _ in range(iters):
+        labels = np.argmin(_sq_distances(encodings, centers), axis=1)
+        for c in range(n_medoids):
+            members = encodings[labels == c]
+            if len(members):
+                centers[c] = members.mean(axis=0)
+
+    # 每组取离组中心最近的真实编码；空组不产生中心样本
+    dists = _sq_distances(encodings, centers)
+    labels = np.argmin(dists, axis=1)
+    medoid_rows = []
+    for c in range(n_medoids):
+        members = np.flatnonzero(labels == c)
+        if len(members):
+            medoid_rows.append(members[np.argmin(dists[members, c])])
+    return np.vstack([centroid, encodings[medoid_rows]])
+
+
+def _sq_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """计算两组向量之间的平方欧氏距离 (len(a), len(b))"""
+    sq = np.einsum('ij,ij->i', a, a)[:, None] - 2.0 * (a @ b.T) + np.einsum('ij,ij->i', b, b)[None, :]
+    return np.maximum(sq, 0.0)
+
+
+def compress_encodings(encodings_cache: Dict[str, List[np.ndarray]], n_medoids: int = 3) -> Dict[str, List[np.ndarray]]:
+    """把 学生ID -> 面部编码列表 中每个学生的编码压缩为原型"""
+    compressed = {}
+    for student_id, encodings in encodings_cache.items():
+        if not encodings:
+            continue
+        prototypes = select_prototypes(np.asarray(encodings, dtype=np.float32), n_medoids)
+        compressed[student_id] = list(prototypes)
+    return compressed
+
+
+def quantize_rows(matrix: np.ndarray, dtype: str = "int8") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    按行量化编码矩阵
+
+    Args:
+        matrix: 编码矩阵 (N, dim)
+        dtype: 'float32'、'float16' 或 'int8'
+
+    Returns:
+        (codes, scales)，反量化结果为 codes * scales[:, None]；非int8类型的scales全为1
+    """
+    if dtype not in QUANTIZATION_TYPES:
+        raise ValueError(f"不支持的量化类型: {dtype}")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.ones(len(matrix), dtype=np.float32)
+    if dtype == "float32":
+        return matrix.copy(), scales
+    if dtype == "float16":
+        return matrix.astype(np.float16), scales
+
+    # int8：每行按最大绝对值缩放到 [-127, 127]
+    max_abs = np.abs(matrix).max(axis=1) if matrix.size else scales
+    scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def dequantize_rows(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """把量化后的编码还原为float32矩阵"""
+    return codes.astype(np.float32) * scales[:, None]
+
+
+class QuantizedGalleryIndex(ExactGalleryIndex):
+    """
+    以float16或int8存储编码的精确匹配索引
+
+    接口与ExactGalleryIndex相同。int8编码每行保存一个float32缩放系数，
+    计算距离时按块反量化后做矩阵乘法，临时内存不超过 DEQUANTIZE_BLOCK_ROWS 行。
+    """
+
+    def __init__(self, dim: int = 128, initial_capacity: int = 64, dtype: str = "int8"):
+        """
+        初始化索引
+
+        Args:
+            dim: 人脸编码维度
+            initial_capacity: 初始容量（行数）
+            dtype: 编码存储类型，'float32'、'float16' 或 'int8'
+        """
+        if dtype not in QUANTIZATION_TYPES:
+            raise ValueError(f"不支持的量化类型: {dtype}")
+        super().__init__(dim=dim, initial_capacity=0)
+        self.dtype = dtype
+        self._matrix = np.empty((initial_capacity, dim), dtype=np.int8 if dtype == "int8" else dtype)
+        self._scales = np.empty(initial_capacity, dtype=np.float32)
+        self._sq_norms = np.empty(initial_capacity, dtype=np.float32)
+
+    @classmethod
+    def from_encodings(cls, encodings_cache: Dict[str, List[np.ndarray]], dim: int = 128,
+                       dtype: str = "int8") -> 'QuantizedGalleryIndex':
+        """根据 学生ID -> 面部编码列表 的字典构建量化索引"""
+        index = cls(dim=dim, dtype=dtype)
+        index.build(encodings_cache)
+        return index
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, student_ids: List[str], copy: bool = True,
+                    dtype: str = "int8") -> 'QuantizedGalleryIndex':
+        """根据float32编码矩阵和平行的学生ID列表构建量化索引（总是复制）"""
+        index = cls(dim=matrix.shape[1], initial_capacity=0, dtype=dtype)
+        index.build_from_matrix(matrix, student_ids)
+        return index
+
+    def build_from_matrix(self, matrix: np.ndarray, student_ids: List[str]) -> None:
+        """用float32编码矩阵和与之平行的学生ID列表重建索引"""
+        codes, scales = quantize_rows(np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim), self.dtype)
+        capacity = max(len(codes), 64)
+        self._matrix = np.empty((capacity, self.dim), dtype=codes.dtype)
+        self._matrix[:len(codes)] = codes
+        self._scales = np.empty(capacity, dtype=np.float32)
+        self._scales[:len(codes)] = scales
+        self._size = len(codes)
+        self._student_ids = list(student_ids)
+        # 范数按反量化后的编码计算，与距离计算使用的值一致
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        for start in range(0, self._size, DEQUANTIZE_BLOCK_ROWS):
+            block = self._dequantize(start, min(start + DEQUANTIZE_BLOCK_ROWS, self._size))
+            self._sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    def add(self, student_id: str, encoding: np.ndarray) -> None:
+        """追加一条人脸编码（量化后保存）"""
+        if self._size == self._matrix.shape[0]:
+            self._grow(max(64, self._size * 2))
+
+        codes, scales = quantize_rows(np.asarray(encoding, dtype=np.float32).reshape(1, self.dim), self.dtype)
+        self._matrix[self._size] = codes[0]
+        self._scales[self._size] = scales[0]
+        row = dequantize_rows(codes, scales)[0]
+        self._sq_norms[self._size] = np.dot(row, row)
+        self._student_ids.append(student_id)
+        self._size += 1
+
+    def _grow(self, capacity: int) -> None:
+        """扩容编码、缩放系数和范数数组"""
+        matrix = np.empty((capacity, self.dim), dtype=self._matrix.dtype)
+        matrix[:self._size] = self._matrix[:self._size]
+        scales = np.empty(capacity, dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        self._matrix = matrix
+        self._scales = scales
+        self._sq_norms = sq_norms
+
+    def _dequantize(self, start: int, stop: int) -> np.ndarray:
+        return dequantize_rows(self._matrix[start:stop], self._scales[start:stop])
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """反量化后的编码矩阵 (N, dim)（返回新数组）"""
+        return self._dequantize(0, self._size)
+
+    @property
+    def nbytes(self) -> int:
+        """有效行占用的字节数（编码+缩放系数+范数）"""
+        return self._size * (self.dim * self._matrix.itemsize + 8)
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        计算查询编码与人脸库所有编码的欧氏距离
+
+        Args:
+            queries: 单个编码 (dim,) 或编码矩阵 (Q, dim)
+
+        Returns:
+            距离矩阵 (Q, N)
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        size = self._size
+        dots = np.empty((len(queries), size), dtype=np.float32)
+        for start in range(0, size, DEQUANTIZE_BLOCK_ROWS):
+            stop = min(start + DEQUANTIZE_BLOCK_ROWS, size)
+            # g·q = scale * (codes·q)：先乘未缩放的编码，再按行乘缩放系数
+            dots[:, start:stop] = (queries @ self._matrix[start:stop].astype(np.float32).T) * self._scales[start:stop]
+        q_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        sq_dists = self._sq_norms[:size][None, :] - 2.0 * dots + q_sq_norms[:, None]
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+        return np.sqrt(sq_dists)
+
+
+def build_compressed_index(encodings_cache: Dict[str, List[np.ndarray]], n_medoids: int = 3,
+                           dtype: str = "int8", dim: int = 128) -> QuantizedGalleryIndex:
+    """把每个学生压缩为原型并以量化形式构建索引"""
+    return QuantizedGalleryIndex.from_encodings(compress_encodings(encodings_cache, n_medoids), dim=dim, dtype=dtype)
+
+
+def evaluate_compression(encodings_cache: Dict[str, List[np.ndarray]], n_medoids: int = 3, dtype: str = "int8",
+                         threshold: float = 0.6, seed: int = 0, dim: int = 128) -> Dict[str, Any]:
+    """
+    评估压缩人脸库相对完整人脸库的匹配准确率变化
+
+    每个至少有两条编码的学生随机留出一条作为查询，其余编码分别构建完整索引和压缩索引，
+    比较两者的识别结果。识别正确指最相似的学生就是查询所属学生，且相似度（1 - 距离）不低于threshold。
+
+    Args:
+        encodings_cache: 学生ID -> 面部编码列表
+        n_medoids: 每个学生保留的中心样本数量
+        dtype: 压缩索引的存储类型
+        threshold: 识别阈值（与recognize_face一致）
+        seed: 随机种子
+        dim: 人脸编码维度
+
+    Returns:
+        包含查询数、两种索引的Top-1准确率与阈值准确率、准确率变化、结果一致率、行数和内存占用的字典
+    """
+    rng = np.random.default_rng(seed)
+    gallery = {}
+    queries = []
+    for student_id, encodings in encodings_cache.items():
+        encodings = list(encodings)
+        if len(encodings) >= 2:
+            held_out = int(rng.integers(len(encodings)))
+            queries.append((student_id, encodings.pop(held_out)))
+        if encodings:
+            gallery[student_id] = encodings
+
+    full_index = ExactGalleryIndex.from_encodings(gallery, dim=dim)
+    compressed_index = build_compressed_index(gallery, n_medoids, dtype, dim=dim)
+
+    stats = {"full": [0, 0], "compressed": [0, 0]}  # [Top-1正确数, 阈值内正确数]
+    agree = 0
+    for student_id, query in queries:
+        results = {}
+        for name, index in (("full", full_index), ("compressed", compressed_index)):
+            matches = index.search(query, k=1)
+            predicted, distance = matches[0] if matches else (None, float('inf'))
+            results[name] = predicted if 1 - distance >= threshold else None
+            stats[name][0] += predicted == student_id
+            stats[name][1] += results[name] == student_id
+        agree += results["full"] == results["compressed"]
+
+    n_queries = len(queries)
+
+    def rate(count: int) -> float:
+        return count / n_queries if n_queries else 1.0
+
+    report = {
+        "queries": n_queries,
+        "n_medoids": n_medoids,
+        "dtype": dtype,
+        "threshold": threshold,
+        "full_top1_accuracy": rate(stats["full"][0]),
+        "compressed_top1_accuracy": rate(stats["compressed"][0]),
+        "full_accuracy": rate(stats["full"][1]),
+        "compressed_accuracy": rate(stats["compressed"][1]),
+        "agreement": rate(agree),
+        "full_rows": len(full_index),
+        "compressed_rows": len(compressed_index),
+        "full_bytes": len(full_index) * (dim * 4 + 4),
+        "compressed_bytes": compressed_index.nbytes,
+    }
+    report["top1_accuracy_delta"] = report["compressed_top1_accuracy"] - report["full_top1_accuracy"]
+    report["accuracy_delta"] = report["compressed_accuracy"] - report["full_accuracy"]
+    logger.info(f"人脸库压缩评估：{n_queries} 个查询，准确率 {report['full_accuracy']:.4f} -> "
+                f"{report['compressed_accuracy']:.4f}，行数 {report['full_rows']} -> {report['compressed_rows']}")
+    return report
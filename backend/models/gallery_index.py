@@ -0,0 +1,460 @@
+import numpy as np
+import os
+import copy
+from typing import Dict, List, Tuple, Optional, Sequence
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('gallery_index')
+
+
+class ExactGalleryIndex:
+    """
+    精确匹配的人脸库索引
+
+    将所有人脸编码保存在一个连续的float32矩阵中，并维护一个与行号平行的学生ID列表，
+    一次矩阵运算（BLAS）即可算出查询编码与整个人脸库的欧氏距离。
+    """
+
+    def __init__(self, dim: int = 128, initial_capacity: int = 64):
+        """
+        初始化索引
+
+        Args:
+            dim: 人脸编码维度（face_recognition为128维）
+            initial_capacity: 矩阵初始容量（行数），不足时按倍数扩容
+        """
+        self.dim = dim
+        self._matrix = np.empty((initial_capacity, dim), dtype=np.float32)
+        self._sq_norms = np.empty(initial_capacity, dtype=np.float32)
+        self._student_ids: List[str] = []
+        self._size = 0
+
+    @classmethod
+    def from_encodings(cls, encodings_cache: Dict[str, List[np.ndarray]], dim: int = 128) -> 'ExactGalleryIndex':
+        """根据 学生ID -> 面部编码列表 的字典构建索引"""
+        index = cls(dim=dim)
+        index.build(encodings_cache)
+        return index
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, student_ids: List[str], copy: bool = True,
+                    sq_norms: Optional[np.ndarray] = None) -> 'ExactGalleryIndex':
+        """
+        根据编码矩阵和平行的学生ID列表构建索引
+
+        Args:
+            matrix: 编码矩阵 (N, dim)
+            student_ids: 与矩阵行平行的学生ID
+            copy: 为False时直接引用传入的float32矩阵（如只读内存映射），首次追加时才复制
+            sq_norms: copy为False时可传入已算好的各行平方范数（同样直接引用）
+        """
+        index = cls(dim=matrix.shape[1], initial_capacity=0)
+        if copy or matrix.dtype != np.float32:
+            index.build_from_matrix(matrix, student_ids)
+        else:
+            index._matrix = matrix
+            index._size = len(matrix)
+            index._student_ids = list(student_ids)
+            if sq_norms is None:
+                sq_norms = np.einsum('ij,ij->i', matrix, matrix).astype(np.float32)
+            index._sq_norms = sq_norms
+        return index
+
+    def build(self, encodings_cache: Dict[str, List[np.ndarray]]) -> None:
+        """用缓存字典整体重建索引"""
+        student_ids = []
+        rows = []
+        for student_id, encodings in encodings_cache.items():
+            for encoding in encodings:
+                student_ids.append(student_id)
+                rows.append(encoding)
+        self.build_from_matrix(np.asarray(rows, dtype=np.float32).reshape(-1, self.dim), student_ids)
+
+    def build_from_matrix(self, matrix: np.ndarray, student_ids: List[str]) -> None:
+        """用编码矩阵和与之平行的学生ID列表重建索引"""
+        capacity = max(len(matrix), 64)
+        self._matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        self._matrix[:len(matrix)] = matrix
+        self._size = len(matrix)
+        self._student_ids = list(student_ids)
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        self._sq_norms[:self._size] = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+    def add(self, student_id: str, encoding: np.ndarray) -> None:
+        """追加一条人脸编码（容量不足时倍增扩容，均摊O(1)）"""
+        if self._size == self._matrix.shape[0]:
+            self._grow(max(64, self._size * 2))
+
+        row = np.asarray(encoding, dtype=np.float32)
+        self._matrix[self._size] = row
+        self._sq_norms[self._size] = np.dot(row, row)
+        self._student_ids.append(student_id)
+        self._size += 1
+
+    def _grow(self, capacity: int) -> None:
+        """扩容矩阵"""
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        self._matrix = matrix
+        self._sq_norms = sq_norms
+
+    def snapshot(self) -> 'ExactGalleryIndex':
+        """
+        返回当前内容的只读视图
+
+        视图与本索引共享矩阵缓冲区和学生ID列表，但行数固定为创建时的行数：之后追加到本索引的行
+        写在视图可见范围之外，扩容时本索引换用新缓冲区，视图仍引用旧缓冲区，因此视图的内容不会再变化。
+        只能向最新的索引追加，不能向视图追加。
+        """
+        return copy.copy(self)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """有效行组成的编码矩阵 (N, dim)"""
+        return self._matrix[:self._size]
+
+    @property
+    def student_ids(self) -> List[str]:
+        """与矩阵行平行的学生ID列表"""
+        if len(self._student_ids) != self._size:
+            return self._student_ids[:self._size]
+        return self._student_ids
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """
+        计算查询编码与人脸库所有编码的欧氏距离
+
+        Args:
+            queries: 单个编码 (dim,) 或编码矩阵 (Q, dim)
+
+        Returns:
+            距离矩阵 (Q, N)
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        # 只读取一次行数：并发追加只会写入该行数之后的位置，不影响本次计算
+        size = self._size
+        # ||g - q||^2 = ||g||^2 - 2 g·q + ||q||^2，其中 g·q 为一次矩阵乘法
+        q_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        sq_dists = self._sq_norms[:size][None, :] - 2.0 * (queries @ self._matrix[:size].T) + q_sq_norms[:, None]
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+        return np.sqrt(sq_dists)
+
+    def search(self, query: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """
+        查找与查询编码最接近的k个学生（每个学生只保留其最近的一条编码）
+
+        Args:
+            query: 查询编码 (dim,)
+            k: 返回的学生数量
+
+        Returns:
+            [(学生ID, 距离), ...]，按距离升序排列
+        """
+        if self._size == 0 or k <= 0:
+            return []
+
+        dists = self.distances(query)[0]
+        return self._top_students(dists, k)
+
+    def search_batch(self, queries: np.ndarray, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """
+        一次矩阵运算查找多个查询编码各自最接近的k个学生
+
+        Args:
+            queries: 查询编码矩阵 (Q, dim)
+
+        Returns:
+            每个查询一个 [(学生ID, 距离), ...] 列表，与search的结果相同
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self._size == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        dists = self.distances(queries)
+        return [self._top_students(row, k) for row in dists]
+
+    def _top_students(self, dists: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """从一行距离中选出距离最小的k个不同学生"""
+        if k == 1:
+            best_row = int(np.argmin(dists))
+            return [(self._student_ids[best_row], float(dists[best_row]))]
+
+        # 先取少量候选行，学生不足k个时再退化为完整排序
+        n_candidates = min(len(dists), k * 4)
+        candidates = np.argpartition(dists, n_candidates - 1)[:n_candidates]
+        order = candidates[np.argsort(dists[candidates])]
+        matches = self._unique_students(order, dists, k)
+        if len(matches) < k and n_candidates < len(dists):
+            matches = self._unique_students(np.argsort(dists), dists, k)
+        return matches
+
+    def _unique_students(self, order: Sequence[int], dists: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """按给定行顺序取前k个不重复的学生"""
+        matches = []
+        seen = set()
+        for row in order:
+            student_id = self._student_ids[row]
+            if student_id in seen:
+                continue
+            seen.add(student_id)
+            matches.append((student_id, float(dists[row])))
+            if len(matches) == k:
+                break
+        return matches
+
+
+class IVFGalleryIndex:
+    """
+    倒排文件（IVF）近似最近邻索引
+
+    用k-means把人脸库划分为n_lists个簇，每个簇是一个独立的ExactGalleryIndex；
+    查询时只扫描离查询编码最近的n_probe个簇。n_probe越大召回率越高、延迟越大，
+    n_probe >= n_lists 时等价于精确匹配。人脸库小于min_train_size时不训练，
+    所有编码放在同一个簇中，行为与精确匹配完全相同。
+    """
+
+    FILE_VERSION = 1
+
+    def __init__(self, dim: int = 128, n_lists: Optional[int] = None, n_probe: int = 8,
+                 min_train_size: int = 2048, train_iters: int = 20, seed: int = 0):
+        """
+        初始化索引
+
+        Args:
+            dim: 人脸编码维度
+            n_lists: 簇数量，None表示训练时按 4*sqrt(N) 自动确定
+            n_probe: 每次查询扫描的簇数量（召回率/延迟调节参数）
+            min_train_size: 开始训练聚类中心所需的最少编码数
+            train_iters: k-means迭代次数
+            seed: 随机种子
+        """
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.train_iters = train_iters
+        self.seed = seed
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.lists: List[ExactGalleryIndex] = [ExactGalleryIndex(dim=dim)]
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def needs_retrain(self) -> bool:
+        """人脸库增长到训练时的4倍以上，或已达到训练规模但尚未训练"""
+        return self._needs_retrain(len(self))
+
+    def _needs_retrain(self, size: int) -> bool:
+        if not self.is_trained:
+            return size >= self.min_train_size
+        return size > self.trained_size * 4
+
+    def __len__(self) -> int:
+        return sum(len(inv_list) for inv_list in self.lists)
+
+    def snapshot(self) -> 'IVFGalleryIndex':
+        """返回当前内容的只读视图（每个簇各取一个视图，见ExactGalleryIndex.snapshot）"""
+        view = copy.copy(self)
+        view.lists = [inv_list.snapshot() for inv_list in self.lists]
+        return view
+
+    def build(self, encodings_cache: Dict[str, List[np.ndarray]], retrain: bool = False) -> None:
+        """
+        用缓存字典整体重建索引
+
+        Args:
+            encodings_cache: 学生ID -> 面部编码列表
+            retrain: 是否强制重新训练聚类中心；否则只在未训练或needs_retrain时训练
+        """
+        student_ids = []
+        rows = []
+        for student_id, encodings in encodings_cache.items():
+            for encoding in encodings:
+                student_ids.append(student_id)
+                rows.append(encoding)
+        matrix = np.asarray(rows, dtype=np.float32).reshape(-1, self.dim)
+        self._build_from_matrix(matrix, student_ids, retrain)
+
+    def _build_from_matrix(self, matrix: np.ndarray, student_ids: List[str], retrain: bool = True) -> None:
+        """由编码矩阵和平行的学生ID列表构建各个簇"""
+        if len(matrix) < self.min_train_size:
+            self.centroids = None
+            self.trained_size = 0
+        elif retrain or self._needs_retrain(len(matrix)):
+            self.train(matrix)
+
+        n_lists = len(self.centroids) if self.is_trained else 1
+        self.lists = [ExactGalleryIndex(dim=self.dim) for _ in range(n_lists)]
+        if len(matrix) == 0:
+            return
+
+        assignments = self._assign(matrix)
+        for list_id in range(n_lists):
+            rows = np.flatnonzero(assignments == list_id)
+            self.lists[list_id].build_from_matrix(matrix[rows], [student_ids[i] for i in rows])
+
+    def train(self, matrix: np.ndarray) -> None:
+        """用k-means训练聚类中心"""
+        rng = np.random.default_rng(self.seed)
+        n_lists = self.n_lists or int(4 * np.sqrt(len(matrix)))
+        n_lists = max(1, min(n_lists, len(matrix)))
+
+        # 每个簇最多取64个训练样本，避免超大人脸库训练过慢
+        sample_size = min(len(matrix), n_lists * 64)
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(self.train_iters):
+            assignments = np.argmin(_pairwise_sq_distances(sample, centroids), axis=1)
+            counts = np.bincount(assignments, minlength=n_lists)
+            non_empty = counts > 0
+            # 按簇排序后分段求和，得到每个簇的新中心
+            order = np.argsort(assignments, kind='stable')
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+            centroids[non_empty] = sums / counts[non_empty, None]
+            # 空簇重新随机选取中心
+            empty = np.flatnonzero(~non_empty)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = len(matrix)
+        logger.info(f"IVF索引训练完成: {len(matrix)} 条编码, {n_lists} 个簇")
+
+    def _assign(self, matrix: np.ndarray) -> np.ndarray:
+        """计算每条编码所属的簇"""
+        if not self.is_trained:
+            return np.zeros(len(matrix), dtype=np.int64)
+        return np.argmin(_pairwise_sq_distances(matrix, self.centroids), axis=1)
+
+    def add(self, student_id: str, encoding: np.ndarray) -> None:
+        """增量插入一条人脸编码"""
+        row = np.asarray(encoding, dtype=np.float32).reshape(1, self.dim)
+        list_id = int(self._assign(row)[0])
+        self.lists[list_id].add(student_id, row[0])
+
+        # 未训练的索引在人脸库达到训练规模时自动训练一次；已训练的索引增长过多时由调用方整体重建
+        if not self.is_trained and self.needs_retrain:
+            inv_list = self.lists[0]
+            self._build_from_matrix(inv_list.matrix.copy(), list(inv_list.student_ids))
+
+    def search(self, query: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """查找与查询编码最接近的k个学生，只扫描最近的n_probe个簇"""
+        if k <= 0:
+            return []
+
+        query = np.asarray(query, dtype=np.float32).reshape(1, self.dim)
+        lists, centroids = self.lists, self.centroids
+        if centroids is not None and len(centroids) == len(lists) and self.n_probe < len(lists):
+            centroid_dists = _pairwise_sq_distances(query, centroids)[0]
+            probe = np.argpartition(centroid_dists, self.n_probe - 1)[:self.n_probe]
+        else:
+            probe = range(len(lists))
+
+        # 合并各簇的结果，同一学生只保留最近的距离
+        best: Dict[str, float] = {}
+        for list_id in probe:
+            for student_id, distance in lists[list_id].search(query[0], k):
+                if distance < best.get(student_id, np.inf):
+                    best[student_id] = distance
+        return sorted(best.items(), key=lambda item: item[1])[:k]
+
+    def search_batch(self, queries: np.ndarray, k: int = 1) -> List[List[Tuple[str, float]]]:
+        """逐个查询多个编码（每个查询探测的簇不同，无法合并为一次矩阵运算）"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return [self.search(query, k) for query in queries]
+
+    def save(self, path: str) -> None:
+        """保存索引到npz文件（先写临时文件再替换）"""
+        matrices = [inv_list.matrix for inv_list in self.lists]
+        student_ids = [sid for inv_list in self.lists for sid in inv_list.student_ids]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=self.FILE_VERSION,
+                centroids=self.centroids if self.is_trained else np.empty((0, self.dim), np.float32),
+                trained_size=self.trained_size,
+                list_sizes=np.array([len(m) for m in matrices], dtype=np.int64),
+                matrix=np.concatenate(matrices) if matrices else np.empty((0, self.dim), np.float32),
+                student_ids=np.array(student_ids, dtype=str)
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'IVFGalleryIndex':
+        """从npz文件加载索引"""
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != cls.FILE_VERSION:
+                raise ValueError(f"不支持的索引文件版本: {int(data['version'])}")
+            index = cls(dim=data['matrix'].shape[1], **kwargs)
+            centroids = data['centroids']
+            index.centroids = centroids if len(centroids) else None
+            index.trained_size = int(data['trained_size'])
+            matrix = data['matrix']
+            student_ids = data['student_ids'].tolist()
+
+            index.lists = []
+            offset = 0
+            for size in data['list_sizes'].tolist():
+                inv_list = ExactGalleryIndex(dim=index.dim)
+                inv_list.build_from_matrix(matrix[offset:offset + size], student_ids[offset:offset + size])
+                index.lists.append(inv_list)
+                offset += size
+        return index
+
+
+def _pairwise_sq_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """计算两组向量之间的平方欧氏距离 (len(a), len(b))"""
+    sq = np.einsum('ij,ij->i', a, a)[:, None] - 2.0 * (a @ b.T) + np.einsum('ij,ij->i', b, b)[None, :]
+    return np.maximum(sq, 0.0)
+
+
+def create_gallery_index(index_type: str = "exact", dim: int = 128, **kwargs):
+    """
+    按类型创建人脸库索引
+
+    Args:
+        index_type: 'exact'(精确线性扫描) 或 'ivf'(倒排近似索引)
+        dim: 人脸编码维度
+        **kwargs: 传给索引构造函数的参数
+    """
+    if index_type == "exact":
+        return ExactGalleryIndex(dim=dim)
+    if index_type == "ivf":
+        return IVFGalleryIndex(dim=dim, **kwargs)
+    raise ValueError(f"不支持的索引类型: {index_type}")
+
+
+def evaluate_recall(index, exact_index: ExactGalleryIndex, queries: np.ndarray, k: int = 1) -> float:
+    """
+    以精确匹配结果为基准评估近似索引的召回率
+
+    Args:
+        index: 待评估的索引
+        exact_index: 同一人脸库上的精确索引
+        queries: 查询编码矩阵 (Q, dim)
+        k: 比较前k个学生
+
+    Returns:
+        recall@k，取值0~1
+    """
+    hits = 0
+    total = 0
+    for query in queries:
+        expected = {sid for sid, _ in exact_index.search(query, k)}
+        found = {sid for sid, _ in index.search(query, k)}
+        hits += len(expected & found)
+        total += len(expected)
+    return hits / total if total else 1.0
@@ -0,0 +1,222 @@
+import numpy as np
+import os
+import glob
+import struct
+import threading
+import time
+import zlib
+from typing import List, Tuple, Optional, Iterator
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('gallery_journal')
+
+# 文件头：魔数、格式版本、纪元号（epoch）
+FILE_HEADER = struct.Struct('<4sHQ')
+JOURNAL_MAGIC = b'FGJL'
+JOURNAL_VERSION = 1
+
+# 记录格式：[长度 u32][CRC32 u32][记录体]
+# 记录体：时间戳 f64、图像mtime_ns i64、图像大小 i64、学生ID长度 u16、图像路径长度 u16、编码维度 u32，
+#         随后是学生ID、图像路径（UTF-8）和float32编码
+RECORD_PREFIX = struct.Struct('<II')
+RECORD_HEADER = struct.Struct('<dqqHHI')
+
+
+class JournalRecord:
+    """一条追加日志记录"""
+
+    __slots__ = ('student_id', 'encoding', 'timestamp', 'image_path', 'signature')
+
+    def __init__(self, student_id: str, encoding: np.ndarray, timestamp: float,
+                 image_path: str = "", signature: Optional[Tuple[int, int]] = None):
+        self.student_id = student_id
+        self.encoding = encoding
+        self.timestamp = timestamp
+        self.image_path = image_path
+        self.signature = signature
+
+
+class GalleryJournal:
+    """
+    人脸编码追加日志
+
+    新注册的人脸编码以定长头+CRC校验的记录追加到日志文件末尾，不再重写整个人脸库文件。
+    fsync按批进行：累计fsync_batch_size条记录或距上次fsync超过fsync_interval秒时落盘。
+
+    日志文件按纪元（epoch）轮换，文件名为 <base_path>.<epoch>。压缩时先切换到新纪元的日志，
+    再把内存中的完整人脸库写成快照（快照中记录已合并到的纪元号），最后删除旧纪元的日志；
+    任一步骤中途崩溃，重启时都只会重放快照尚未包含的日志，不会丢失或重复记录。
+    """
+
+    def __init__(self, base_path: str, fsync_batch_size: int = 32, fsync_interval: float = 0.5):
+        """
+        初始化追加日志
+
+        Args:
+            base_path: 日志文件路径前缀
+            fsync_batch_size: 每累计多少条记录执行一次fsync
+            fsync_interval: 未满一批时，最迟多少秒后执行fsync
+        """
+        self.base_path = base_path
+        self.fsync_batch_size = fsync_batch_size
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pending_sync = 0
+        self._sync_timer = None
+        self.epoch = self._latest_epoch()
+        self.record_count = 0  # 当前纪元日志中的记录数
+
+    def _path(self, epoch: int) -> str:
+        return f"{self.base_path}.{epoch}"
+
+    def _epochs(self) -> List[int]:
+        """磁盘上所有日志文件的纪元号（升序）"""
+        epochs = []
+        for path in glob.glob(glob.escape(self.base_path) + ".*"):
+            suffix = path[len(self.base_path) + 1:]
+            if suffix.isdigit():
+                epochs.append(int(suffix))
+        return sorted(epochs)
+
+    def _latest_epoch(self) -> int:
+        epochs = self._epochs()
+        return epochs[-1] if epochs else 0
+
+    def _open(self) -> None:
+        """打开当前纪元的日志文件（不存在时写入文件头）"""
+        path = self._path(self.epoch)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, FILE_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, self.epoch))
+            os.fsync(self._fd)
+
+    def append(self, student_id: str, encoding: np.ndarray, image_path: str = "",
+               signature: Optional[Tuple[int, int]] = None, timestamp: Optional[float] = None) -> None:
+        """追加一条记录（单次write写入完整记录）"""
+        encoding = np.ascontiguousarray(encoding, dtype=np.float32)
+        sid_bytes = student_id.encode('utf-8')
+        path_bytes = image_path.encode('utf-8')
+        mtime_ns, size = signature if signature is not None else (-1, -1)
+        body = (RECORD_HEADER.pack(time.time() if timestamp is None else timestamp, mtime_ns, size,
+                                   len(sid_bytes), len(path_bytes), encoding.size)
+                + sid_bytes + path_bytes + encoding.tobytes())
+        record = RECORD_PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            os.write(self._fd, record)
+            self.record_count += 1
+            self._pending_sync += 1
+            if self._pending_sync >= self.fsync_batch_size:
+                self._sync_locked()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(self.fsync_interval, self.flush)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+    def flush(self) -> None:
+        """立即将已写入的记录fsync到磁盘"""
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self) -> None:
+        if self._sync_timer is not None:
+            self._sync_timer.cancel()
+            self._sync_timer = None
+        if self._fd is not None and self._pending_sync:
+            os.fsync(self._fd)
+        self._pending_sync = 0
+
+    def rotate(self) -> int:
+        """
+        切换到新纪元的日志文件，之后的追加写入新文件
+
+        Returns:
+            新的纪元号；快照保存该值，表示此前纪元的记录已全部合并
+        """
+        with self._lock:
+            self._sync_locked()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self.epoch += 1
+            self.record_count = 0
+            self._open()
+            return self.epoch
+
+    def discard_before(self, epoch: int) -> None:
+        """删除早于指定纪元的日志文件（其记录已合并到快照）"""
+        for old_epoch in self._epochs():
+            if old_epoch < epoch:
+                try:
+                    os.remove(self._path(old_epoch))
+                except OSError as e:
+                    logger.error(f"删除旧日志文件出错: {str(e)}")
+
+    def replay(self, since_epoch: int = 0) -> Iterator[JournalRecord]:
+        """
+        按写入顺序读取纪元号不小于since_epoch的所有记录
+
+        遇到不完整或校验失败的记录（写入中途崩溃）时停止读取该文件。
+        """
+        # 快照已合并到since_epoch之前的记录，之后的追加必须写入不早于since_epoch的纪元
+        with self._lock:
+            if self.epoch < since_epoch:
+                self.epoch = since_epoch
+        for epoch in self._epochs():
+            if epoch < since_epoch:
+                continue
+            path = self._path(epoch)
+            records, valid_end, file_size = self._read_file(path)
+            if epoch == self.epoch:
+                self.record_count = len(records)
+                # 截掉当前日志末尾的残缺记录，保证之后追加的记录可以被读取
+                if valid_end < file_size:
+                    with open(path, 'r+b') as f:
+                        f.truncate(valid_end)
+            yield from records
+
+    def _read_file(self, path: str) -> Tuple[List[JournalRecord], int, int]:
+        """读取一个日志文件，返回 (有效记录, 最后一条有效记录的结束偏移, 文件大小)"""
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        records = []
+        if len(data) < FILE_HEADER.size or FILE_HEADER.unpack_from(data)[0] != JOURNAL_MAGIC:
+            logger.warning(f"日志文件头无效，已跳过: {path}")
+            return records, len(data), len(data)
+
+        offset = FILE_HEADER.size
+        while offset + RECORD_PREFIX.size <= len(data):
+            length, crc = RECORD_PREFIX.unpack_from(data, offset)
+            body = data[offset + RECORD_PREFIX.size:offset + RECORD_PREFIX.size + length]
+            if len(body) != length or zlib.crc32(body) != crc:
+                break
+            offset += RECORD_PREFIX.size + length
+
+            timestamp, mtime_ns, size, sid_len, path_len, dim = RECORD_HEADER.unpack_from(body)
+            pos = RECORD_HEADER.size
+            student_id = body[pos:pos + sid_len].decode('utf-8')
+            pos += sid_len
+            image_path = body[pos:pos + path_len].decode('utf-8')
+            pos += path_len
+            encoding = np.frombuffer(body, dtype=np.float32, count=dim, offset=pos)
+            signature = (mtime_ns, size) if mtime_ns >= 0 else None
+            records.append(JournalRecord(student_id, encoding, timestamp, image_path, signature))
+
+        if offset < len(data):
+            logger.warning(f"日志文件 {path} 在偏移 {offset} 处的记录不完整，忽略其后的内容")
+        return records, offset, len(data)
+
+    def close(self) -> None:
+        """fsync并关闭日志文件"""
+        with self._lock:
+            self._sync_locked()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
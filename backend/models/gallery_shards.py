@@ -0,0 +1,436 @@
+import numpy as np
+import os
+import sys
+import zlib
+import time
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client, Connection
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple, Optional, Any, Callable, Iterable, Mapping, Union
+import logging
+
+from models.gallery_index import ExactGalleryIndex
+from models.gallery_store import read_gallery
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('gallery_shards')
+
+Address = Union[str, Tuple[str, int]]
+
+AUTHKEY_ENV = "FACE_SHARD_AUTHKEY"
+
+
+def shard_for(student_id: str, n_shards: int) -> int:
+    """学生所在的分片编号（按学生ID的crc32取模，各进程、各主机结果一致）"""
+    return zlib.crc32(student_id.encode('utf-8')) % n_shards
+
+
+def parse_address(address: str) -> Address:
+    """解析分片地址：'host:port' 为TCP地址，其他视为Unix域套接字路径"""
+    host, sep, port = address.rpartition(':')
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def gallery_checksum(student_ids: Iterable[str], matrix: np.ndarray) -> int:
+    """
+    编码内容的校验和，与行的顺序无关（各行的crc32之和）
+
+    协调进程的source按学生分组，分片按替换和追加的顺序保存，行的顺序不同但内容相同时校验和一致。
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    total = 0
+    for student_id, row in zip(student_ids, matrix):
+        total += zlib.crc32(row.tobytes(), zlib.crc32(student_id.encode('utf-8')))
+    return total & 0xFFFFFFFFFFFFFFFF
+
+
+def merge_results(shard_results: Iterable[List[Tuple[str, float]]], k: int) -> List[Tuple[str, float]]:
+    """合并各分片的 [(学生ID, 距离), ...]（学生按ID划分，各分片之间没有重复）取距离最小的k个"""
+    merged = [match for matches in shard_results for match in matches]
+    merged.sort(key=lambda match: match[1])
+    return merged[:k]
+
+
+class GalleryShardServer:
+    """
+    人脸库分片的匹配服务
+
+    只保存 shard_for(学生ID) == shard_id 的编码，通过multiprocessing.connection接收协调进程的请求
+    （每个连接一个线程）：
+        ("search", 查询矩阵, k)            -> ("ok", 每个查询的 [(学生ID, 距离), ...])
+        ("replace", 学生ID列表, 编码矩阵)   -> ("ok", 行数)   整体替换本分片的编码
+        ("add", 学生ID列表, 编码矩阵)       -> ("ok", 行数)   追加编码
+        ("stats",)                        -> ("ok", {...})   其中checksum为编码内容的校验和
+    出错时返回 ("error", 错误信息)。查询读取索引的只读视图，写入在锁内完成后替换视图，互不阻塞。
+    """
+
+    def __init__(self, address: Address, shard_id: int, n_shards: int, authkey: bytes, dim: int = 128,
+                 gallery_file: Optional[str] = None):
+        """
+        Args:
+            address: 监听地址，(host, port) 或Unix域套接字路径
+            shard_id: 本分片编号
+            n_shards: 分片总数
+            authkey: 连接认证密钥（协调进程与各分片相同）
+            dim: 编码维度
+            gallery_file: 启动时从该人脸库文件加载属于本分片的编码（可选，协调进程连接后也会补齐）
+        """
+        self.address = address
+        self.shard_id = shard_id
+        self.n_shards = n_shards
+        self.authkey = authkey
+        self.dim = dim
+        self._index = ExactGalleryIndex(dim=dim)
+        self._view = self._index.snapshot()
+        self._write_lock = threading.Lock()
+        self._listener = None
+        self._stop = threading.Event()
+        self.started_at = time.time()
+        self.queries_served = 0
+
+        if gallery_file and os.path.exists(gallery_file):
+            self._load_gallery_file(gallery_file)
+
+    def _load_gallery_file(self, gallery_file: str) -> None:
+        stored = read_gallery(gallery_file)
+        rows = [row for row, student_id in enumerate(stored.student_ids)
+                if shard_for(student_id, self.n_shards) == self.shard_id]
+        self.replace([stored.student_ids[row] for row in rows], stored.matrix[rows])
+        logger.info(f"分片 {self.shard_id} 已从人脸库文件加载 {len(rows)} 条编码")
+
+    def replace(self, student_ids: List[str], matrix: np.ndarray) -> int:
+        """整体替换本分片的编码"""
+        index = ExactGalleryIndex.from_matrix(np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim), student_ids)
+        with self._write_lock:
+            self._index = index
+            self._view = index.snapshot()
+        return len(index)
+
+    def add(self, student_ids: List[str], matrix: np.ndarray) -> int:
+        """追加编码"""
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        with self._write_lock:
+            for student_id, encoding in zip(student_ids, matrix):
+                self._index.add(student_id, encoding)
+            self._view = self._index.snapshot()
+            return len(self._view)
+
+    def search_batch(self, queries: np.ndarray, k: int) -> List[List[Tuple[str, float]]]:
+        self.queries_served += 1
+        return self._view.search_batch(queries, k=k)
+
+    def stats(self) -> Dict[str, Any]:
+        view = self._view
+        return {
+            "shard_id": self.shard_id,
+            "n_shards": self.n_shards,
+            "count": len(view),
+            "checksum": gallery_checksum(view.student_ids, view.matrix),
+            "queries_served": self.queries_served,
+            "uptime": time.time() - self.started_at
+        }
+
+    def handle(self, message: tuple) -> tuple:
+        """处理一条请求，返回应答"""
+        command = message[0]
+        if command == "search":
+            return "ok", self.search_batch(message[1], message[2])
+        if command == "replace":
+            return "ok", self.replace(message[1], message[2])
+        if command == "add":
+            return "ok", self.add(message[1], message[2])
+        if command == "stats":
+            return "ok", self.stats()
+        return "error", f"未知请求: {command}"
+
+    def _serve_connection(self, conn: Connection) -> None:
+        try:
+            while not self._stop.is_set():
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    reply = self.handle(message)
+                except Exception as e:
+                    logger.error(f"分片 {self.shard_id} 处理请求出错: {str(e)}")
+                    reply = ("error", str(e))
+                try:
+                    conn.send(reply)
+                except OSError:
+                    # 客户端已超时断开
+                    break
+        finally:
+            conn.close()
+
+    def serve_forever(self) -> None:
+        """监听并处理连接，直到stop()"""
+        self._listener = Listener(self.address, authkey=self.authkey)
+        logger.info(f"分片 {self.shard_id}/{self.n_shards} 开始监听 {self.address}，包含 {len(self._view)} 条编码")
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = self._listener.accept()
+                except Exception as e:
+                    if self._stop.is_set():
+                        break
+                    logger.error(f"分片 {self.shard_id} 接受连接出错: {str(e)}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,),
+                                 name=f"gallery-shard-{self.shard_id}", daemon=True).start()
+        finally:
+            self._listener.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.close()
+
+
+class _ShardConnection:
+    """到一个分片的连接（连接不是线程安全的，同一时间只有一个请求在途）"""
+
+    def __init__(self, shard_id: int, address: Address):
+        self.shard_id = shard_id
+        self.address = address
+        self.lock = threading.Lock()
+        self.conn: Optional[Connection] = None
+
+    def close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+
+
+class ShardedGallery:
+    """
+    分片人脸库的客户端（协调进程使用）
+
+    查询并行发送到所有分片，各自返回最近的k个学生后在本地合并；超时或出错的分片本次不参与合并，
+    并断开其连接（迟到的应答不会被误认为下一次请求的结果），下次请求时重新连接。
+    查询结果同时返回未应答的分片编号，由调用方在本地补查这些分片的学生；
+    所有分片都失败时抛出异常，由调用方回退到本地人脸库。
+    连接（或重新连接）分片时，若分片编码内容的校验和与source中属于该分片的编码不一致，先推送该分片的全部编码。
+    """
+
+    def __init__(self, addresses: List[Address], authkey: bytes, timeout: float = 0.5,
+                 source: Optional[Callable[[], Mapping[str, Iterable[np.ndarray]]]] = None, dim: int = 128):
+        """
+        Args:
+            addresses: 各分片地址，下标即分片编号
+            authkey: 连接认证密钥
+            timeout: 每次请求等待分片应答的最长时间（秒）
+            source: 返回完整的 学生ID -> 编码 映射，用于补齐（重新）连接的分片
+            dim: 编码维度
+        """
+        if not addresses:
+            raise ValueError("至少需要一个分片地址")
+        self.n_shards = len(addresses)
+        self.authkey = authkey
+        self.timeout = timeout
+        self.source = source
+        self.dim = dim
+        self._shards = [_ShardConnection(shard_id, address) for shard_id, address in enumerate(addresses)]
+        self._executor = ThreadPoolExecutor(max_workers=self.n_shards, thread_name_prefix="gallery-shard-client")
+
+    def partition(self, student_ids: List[str], matrix: np.ndarray) -> Dict[int, Tuple[List[str], np.ndarray]]:
+        """把平行的学生ID和编码按分片分组"""
+        rows_by_shard: Dict[int, List[int]] = {}
+        for row, student_id in enumerate(student_ids):
+            rows_by_shard.setdefault(shard_for(student_id, self.n_shards), []).append(row)
+        return {shard_id: ([student_ids[row] for row in rows], matrix[rows])
+                for shard_id, rows in rows_by_shard.items()}
+
+    def _source_rows(self, shard_id: int) -> Tuple[List[str], np.ndarray]:
+        """source中属于某个分片的编码"""
+        student_ids, rows = [], []
+        for student_id, encodings in (self.source() if self.source else {}).items():
+            if shard_for(student_id, self.n_shards) != shard_id:
+                continue
+            for encoding in encodings:
+                student_ids.append(student_id)
+                rows.append(encoding)
+        return student_ids, np.asarray(rows, dtype=np.float32).reshape(-1, self.dim)
+
+    def _request(self, shard: _ShardConnection, message: tuple) -> Any:
+        """在已连接的分片上发送一条请求并等待应答（调用方持有shard.lock）"""
+        shard.conn.send(message)
+        if not shard.conn.poll(self.timeout):
+            raise TimeoutError(f"分片 {shard.shard_id} 应答超时")
+        status, payload = shard.conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"分片 {shard.shard_id} 返回错误: {payload}")
+        return payload
+
+    def _connect(self, shard: _ShardConnection) -> None:
+        """连接分片，编码内容不一致时推送该分片的全部编码（调用方持有shard.lock）"""
+        shard.conn = Client(shard.address, authkey=self.authkey)
+        if self.source is None:
+            return
+        student_ids, matrix = self._source_rows(shard.shard_id)
+        # 只比较行数会漏掉行数相同而内容不同的情况（如分片重启后加载了旧的人脸库文件）
+        stats = self._request(shard, ("stats",))
+        if stats["count"] != len(student_ids) or stats.get("checksum") != gallery_checksum(student_ids, matrix):
+            self._request(shard, ("replace", student_ids, matrix))
+            logger.info(f"已向分片 {shard.shard_id} 推送 {len(student_ids)} 条编码")
+
+    def _call(self, shard_id: int, message: tuple) -> Any:
+        """向一个分片发送请求，出错或超时时断开连接后抛出异常"""
+        shard = self._shards[shard_id]
+        # 上一个请求仍卡在该分片上时不排队等待
+        if not shard.lock.acquire(timeout=self.timeout):
+            raise TimeoutError(f"分片 {shard_id} 忙")
+        try:
+            if shard.conn is None:
+                self._connect(shard)
+            return self._request(shard, message)
+        except Exception:
+            shard.close()
+            raise
+        finally:
+            shard.lock.release()
+
+    def _scatter(self, messages: Dict[int, tuple]) -> Dict[int, Any]:
+        """并行发送请求，返回在超时前成功应答的 分片编号 -> 结果"""
+        futures = {self._executor.submit(self._call, shard_id, message): shard_id
+                   for shard_id, message in messages.items()}
+        # 连接和推送也计入超时，再留出一个timeout的余量
+        done, _ = wait(futures, timeout=self.timeout * 2)
+        results = {}
+        for future, shard_id in futures.items():
+            if future not in done:
+                logger.warning(f"分片 {shard_id} 超时")
+                continue
+            try:
+                results[shard_id] = future.result()
+            except Exception as e:
+                logger.warning(f"分片 {shard_id} 请求失败: {str(e)}")
+        return results
+
+    def search_batch(self, queries: np.ndarray, k: int = 1) -> Tuple[List[List[Tuple[str, float]]], List[int]]:
+        """
+        在所有分片上查找每个查询最接近的k个学生并合并
+
+        Returns:
+            (每个查询一个 [(学生ID, 距离), ...] 列表，按距离升序排列；未应答的分片编号列表)
+            未应答分片中的学生不在结果中，调用方需要自行补查或视为匹配失败
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        results = self._scatter({shard_id: ("search", queries, k) for shard_id in range(self.n_shards)})
+        if not results:
+            raise RuntimeError("所有分片均未应答")
+        missing = [shard_id for shard_id in range(self.n_shards) if shard_id not in results]
+        return [merge_results((shard_results[query] for shard_results in results.values()), k)
+                for query in range(len(queries))], missing
+
+    def search(self, query: np.ndarray, k: int = 1) -> Tuple[List[Tuple[str, float]], List[int]]:
+        """查找与单个查询编码最接近的k个学生，返回 (结果, 未应答的分片编号列表)"""
+        results, missing = self.search_batch(query, k)
+        return results[0], missing
+
+    def replace(self, student_ids: List[str], matrix: np.ndarray) -> None:
+        """用完整的人脸库替换各分片的编码（未应答的分片在重新连接时由source补齐）"""
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        groups = self.partition(student_ids, matrix)
+        empty = ([], np.empty((0, self.dim), dtype=np.float32))
+        self._scatter({shard_id: ("replace", *groups.get(shard_id, empty)) for shard_id in range(self.n_shards)})
+
+    def add(self, student_ids: List[str], matrix: np.ndarray) -> None:
+        """把新编码追加到各自的分片"""
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        self._scatter({shard_id: ("add", *group) for shard_id, group in self.partition(student_ids, matrix).items()})
+
+    def stats(self) -> List[Optional[Dict[str, Any]]]:
+        """各分片的状态，未应答的分片为None"""
+        results = self._scatter({shard_id: ("stats",) for shard_id in range(self.n_shards)})
+        return [results.get(shard_id) for shard_id in range(self.n_shards)]
+
+    def close(self) -> None:
+        for shard in self._shards:
+            with shard.lock:
+                shard.close()
+        self._executor.shutdown(wait=False)
+
+
+def run_shard_server(address: Address, shard_id: int, n_shards: int, authkey: bytes, dim: int = 128,
+                     gallery_file: Optional[str] = None) -> None:
+    """在当前进程中运行一个分片服务（阻塞）"""
+    GalleryShardServer(address, shard_id, n_shards, authkey, dim, gallery_file).serve_forever()
+
+
+def start_local_shards(n_shards: int, directory: str, authkey: bytes, dim: int = 128,
+                       gallery_file: Optional[str] = None) -> Tuple[List[str], List[multiprocessing.Process]]:
+    """
+    在本机启动n_shards个分片进程（Unix域套接字），用于单机部署和测试
+
+    Returns:
+        (各分片的套接字路径, 进程列表)
+    """
+    os.makedirs(directory, exist_ok=True)
+    addresses, processes = [], []
+    for shard_id in range(n_shards):
+        address = os.path.join(directory, f"gallery-shard-{shard_id}.sock")
+        if os.path.exists(address):
+            os.remove(address)
+        process = multiprocessing.Process(target=run_shard_server, name=f"gallery-shard-{shard_id}",
+                                          args=(address, shard_id, n_shards, authkey, dim, gallery_file), daemon=True)
+        process.start()
+        addresses.append(address)
+        processes.append(process)
+    # 等待所有分片开始监听
+    deadline = time.time() + 10
+    while not all(os.path.exists(address) for address in addresses) and time.time() < deadline:
+        time.sleep(0.01)
+    return addresses, processes
+
+
+def _authkey_from(value: Optional[str]) -> bytes:
+    value = value or os.environ.get(AUTHKEY_ENV)
+    if not value:
+        raise SystemExit(f"需要通过 --authkey 或环境变量 {AUTHKEY_ENV} 提供认证密钥")
+    return value.encode('utf-8')
+
+
+def parse_arguments(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='人脸库分片匹配服务')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='运行一个分片')
+    serve.add_argument('--address', type=str, required=True, help='监听地址，host:port 或Unix域套接字路径')
+    serve.add_argument('--shard-id', type=int, required=True, help='分片编号')
+    serve.add_argument('--n-shards', type=int, required=True, help='分片总数')
+    serve.add_argument('--gallery-file', type=str, help='启动时从该人脸库文件加载本分片的编码')
+    serve.add_argument('--dim', type=int, default=128, help='编码维度')
+    serve.add_argument('--authkey', type=str, help=f'认证密钥（默认读取环境变量 {AUTHKEY_ENV}）')
+
+    local = subparsers.add_parser('local', help='在本机启动多个分片（Unix域套接字）')
+    local.add_argument('--n-shards', type=int, required=True, help='分片数量')
+    local.add_argument('--directory', type=str, default='/tmp/face-gallery-shards', help='套接字所在目录')
+    local.add_argument('--gallery-file', type=str, help='启动时从该人脸库文件加载各分片的编码')
+    local.add_argument('--dim', type=int, default=128, help='编码维度')
+    local.add_argument('--authkey', type=str, help=f'认证密钥（默认读取环境变量 {AUTHKEY_ENV}）')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    authkey = _authkey_from(args.authkey)
+    if args.command == 'serve':
+        run_shard_server(parse_address(args.address), args.shard_id, args.n_shards, authkey, args.dim, args.gallery_file)
+    else:
+        addresses, processes = start_local_shards(args.n_shards, args.directory, authkey, args.dim, args.gallery_file)
+        print(f"FACE_GALLERY_SHARDS={','.join(addresses)}")
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            sys.exit(0)
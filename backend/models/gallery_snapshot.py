@@ -0,0 +1,76 @@
+import numpy as np
+import threading
+from types import MappingProxyType
+from typing import Dict, List, Tuple, Optional, Any, Mapping, Iterable
+
+from models.gallery_index import ExactGalleryIndex
+
+
+class GallerySnapshot:
+    """
+    人脸库的一个不可变版本
+
+    包含版本号、索引视图、学生ID -> 编码元组的只读映射以及只读的图像清单。识别请求读取
+    FaceRecognitionUtils的当前快照（一次属性读取）后只使用这个快照，无需加锁；注册和刷新
+    构建新的快照后整体替换，正在进行的识别继续使用旧快照，不会看到构建到一半的状态。
+    """
+
+    __slots__ = ('version', 'index', 'encodings', 'manifest', '_exact_index', '_exact_lock')
+
+    def __init__(self, version: int, index, encodings: Mapping[str, Tuple[np.ndarray, ...]],
+                 manifest: Optional[Mapping[str, Dict[str, Any]]] = None):
+        """
+        Args:
+            version: 版本号，每次发布新快照时递增
+            index: 索引视图（ExactGalleryIndex/IVFGalleryIndex.snapshot()的返回值，之后不再修改）
+            encodings: 学生ID -> 面部编码元组
+            manifest: 图像路径 -> {student_id, signature, encoding}，None表示尚未建立
+        """
+        self.version = version
+        self.index = index
+        self.encodings = encodings if isinstance(encodings, MappingProxyType) else MappingProxyType(encodings)
+        if manifest is not None and not isinstance(manifest, MappingProxyType):
+            manifest = MappingProxyType(manifest)
+        self.manifest = manifest
+        self._exact_index = None
+        self._exact_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, version: int, index, encodings_cache: Mapping[str, Iterable[np.ndarray]],
+               manifest: Optional[Mapping[str, Dict[str, Any]]] = None) -> 'GallerySnapshot':
+        """由可变的 学生ID -> 编码列表 构建快照（复制为元组，之后修改原字典不影响快照）"""
+        encodings = {student_id: tuple(encodings) for student_id, encodings in encodings_cache.items()}
+        return cls(version, index, encodings, dict(manifest) if manifest is not None else None)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def exact_index(self) -> ExactGalleryIndex:
+        """本版本的精确匹配索引（索引本身是精确索引时直接返回，否则首次使用时构建）"""
+        if type(self.index) is ExactGalleryIndex:
+            return self.index
+        if self._exact_index is None:
+            with self._exact_lock:
+                if self._exact_index is None:
+                    self._exact_index = ExactGalleryIndex.from_encodings(self.encodings)
+        return self._exact_index
+
+    def with_encodings(self, index, records: List[Tuple[str, np.ndarray, str, Optional[Tuple[int, int]]]]) -> 'GallerySnapshot':
+        """
+        返回追加了若干编码的新快照（本快照不变）
+
+        Args:
+            index: 已追加这些编码的新索引视图
+            records: [(学生ID, 编码, 图像路径, 图像签名), ...]
+        """
+        encodings = dict(self.encodings)
+        manifest = dict(self.manifest) if self.manifest is not None else None
+        for student_id, encoding, image_path, signature in records:
+            encodings[student_id] = encodings.get(student_id, ()) + (encoding,)
+            if manifest is not None and image_path and signature is not None:
+                manifest[image_path] = {
+                    "student_id": student_id,
+                    "signature": signature,
+                    "encoding": encoding
+                }
+        return GallerySnapshot(self.version + 1, index, encodings, manifest)
@@ -0,0 +1,164 @@
+import numpy as np
+import os
+import json
+import struct
+import time
+from typing import Dict, List, Tuple, Optional, Any
+
+# 文件布局（小端序）：
+#   [文件头 128 字节]
+#   [编码矩阵   float32 (count, dim)]
+#   [学生ID表   S{id_width} (count,)]
+#   [行元数据   ROW_META_DTYPE (count,)]
+#   [附加信息   UTF-8 JSON：每行图像路径、无法编码的图像清单等]
+# 各数据段按64字节对齐，前三段通过 np.memmap 只读映射，多个进程共享同一份物理内存页。
+MAGIC = b'FGAL'
+FORMAT_VERSION = 1
+HEADER_SIZE = 128
+HEADER_STRUCT = struct.Struct('<4sHHIIQdQQQQQ')
+ALIGNMENT = 64
+
+# Windows上文件仍被内存映射时不能用os.replace覆盖（PermissionError）；POSIX上替换的是目录项，
+# 已有的映射继续引用旧文件。不能覆盖时，写入前需先让内存中的数据不再引用映射，见mapped_from
+REPLACE_MAPPED_FILES = os.name != 'nt'
+# 目标文件仍被其他句柄短暂占用时os.replace的重试次数
+REPLACE_RETRIES = 5
+
+# 每行的元数据：图像文件的修改时间、大小（与图像清单的签名一致）以及写入时间
+ROW_META_DTYPE = np.dtype([('mtime_ns', '<i8'), ('size', '<i8'), ('added_at', '<f8')])
+
+
+class StoredGallery:
+    """从二进制人脸库文件中读出的数据（矩阵、ID表、行元数据均为只读内存映射）"""
+
+    def __init__(self, matrix: np.ndarray, student_ids: List[str], row_meta: np.ndarray,
+                 image_paths: List[str], extra: Dict[str, Any], timestamp: float):
+        self.matrix = matrix
+        self.student_ids = student_ids
+        self.row_meta = row_meta
+        self.image_paths = image_paths
+        self.extra = extra
+        self.timestamp = timestamp
+
+    def __len__(self) -> int:
+        return len(self.student_ids)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def mapped_from(array: Any, path: str) -> bool:
+    """数组是否（直接或通过视图）引用了path文件的内存映射"""
+    path = os.path.abspath(path)
+    while array is not None:
+        filename = getattr(array, 'filename', None) if isinstance(array, np.memmap) else None
+        if filename is not None and os.path.abspath(filename) == path:
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def write_gallery(path: str, matrix: np.ndarray, student_ids: List[str], image_paths: List[str],
+                  signatures: List[Optional[Tuple[int, int]]], extra: Optional[Dict[str, Any]] = None,
+                  timestamp: Optional[float] = None) -> None:
+    """
+    写入二进制人脸库文件
+
+    先写入同目录下的临时文件并fsync，再用os.replace原子替换，写入中途崩溃不会损坏已有文件。
+    Windows上目标文件仍被打开（如尚未结束的识别请求持有旧快照的内存映射）时替换会失败，短暂等待后重试。
+
+    Args:
+        path: 目标文件路径
+        matrix: 编码矩阵 (count, dim)
+        student_ids: 与矩阵行平行的学生ID
+        image_paths: 每行对应的图像路径，没有对应图像时为空字符串
+        signatures: 每行图像的 (mtime_ns, size)，没有时为None
+        extra: 其他需要保存的信息（JSON可序列化）
+        timestamp: 缓存时间戳，默认为当前时间
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2 or len(matrix) != len(student_ids):
+        raise ValueError("编码矩阵与学生ID表的行数不一致")
+    count, dim = matrix.shape
+    timestamp = time.time() if timestamp is None else timestamp
+
+    encoded_ids = [sid.encode('utf-8') for sid in student_ids]
+    id_width = max([len(sid) for sid in encoded_ids] + [1])
+    id_table = np.array(encoded_ids, dtype=f'S{id_width}')
+
+    row_meta = np.zeros(count, dtype=ROW_META_DTYPE)
+    for i, signature in enumerate(signatures):
+        if signature is not None:
+            row_meta[i]['mtime_ns'], row_meta[i]['size'] = signature
+    row_meta['added_at'] = timestamp
+
+    extra_bytes = json.dumps(dict(extra or {}, image_paths=image_paths), ensure_ascii=False).encode('utf-8')
+
+    matrix_offset = _align(HEADER_SIZE)
+    ids_offset = _align(matrix_offset + matrix.nbytes)
+    meta_offset = _align(ids_offset + id_table.nbytes)
+    extra_offset = _align(meta_offset + row_meta.nbytes)
+
+    header = HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, 0, dim, id_width, count, timestamp,
+                                matrix_offset, ids_offset, meta_offset, extra_offset, len(extra_bytes))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            for offset, data in ((0, header), (matrix_offset, matrix.tobytes()), (ids_offset, id_table.tobytes()),
+                                 (meta_offset, row_meta.tobytes()), (extra_offset, extra_bytes)):
+                f.seek(offset)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        for attempt in range(REPLACE_RETRIES):
+            try:
+                os.replace(tmp_path, path)
+                break
+            except PermissionError:
+                if attempt == REPLACE_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_gallery(path: str) -> StoredGallery:
+    """
+    以内存映射方式打开二进制人脸库文件
+
+    Raises:
+        ValueError: 文件格式或版本不正确
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_STRUCT.size:
+            raise ValueError("人脸库文件头不完整")
+        (magic, version, _flags, dim, id_width, count, timestamp,
+         matrix_offset, ids_offset, meta_offset, extra_offset, extra_length) = HEADER_STRUCT.unpack_from(header)
+        if magic != MAGIC:
+            raise ValueError("不是有效的人脸库文件")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"不支持的人脸库文件版本: {version}")
+
+        f.seek(extra_offset)
+        extra_bytes = f.read(extra_length)
+        if len(extra_bytes) != extra_length:
+            raise ValueError("人脸库文件已截断")
+        extra = json.loads(extra_bytes.decode('utf-8'))
+
+    if count == 0:
+        matrix = np.empty((0, dim), dtype=np.float32)
+        id_table = np.empty(0, dtype=f'S{id_width}')
+        row_meta = np.empty(0, dtype=ROW_META_DTYPE)
+    else:
+        matrix = np.memmap(path, dtype=np.float32, mode='r', offset=matrix_offset, shape=(count, dim))
+        id_table = np.memmap(path, dtype=f'S{id_width}', mode='r', offset=ids_offset, shape=(count,))
+        row_meta = np.memmap(path, dtype=ROW_META_DTYPE, mode='r', offset=meta_offset, shape=(count,))
+
+    student_ids = [sid.decode('utf-8') for sid in id_table.tolist()]
+    image_paths = extra.pop('image_paths', [''] * count)
+    return StoredGallery(matrix, student_ids, row_meta, image_paths, extra, timestamp)
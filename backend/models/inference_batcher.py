@@ -0,0 +1,146 @@
+import numpy as np
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, Any, Callable, Optional, List, Tuple
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('inference_batcher')
+
+
+class BatchingPredictor:
+    """
+    进程内的微批推理队列
+
+    请求线程提交单个样本（不含批次维度）后得到一个Future；工作线程取到第一个样本后最多再等待
+    max_wait_ms毫秒或凑满max_batch_size个样本，把它们叠成一批做一次前向计算，再把每行结果交给
+    对应的Future。并发请求因此合并为一次模型调用，模型也只在工作线程中被调用，不会并发执行。
+    """
+
+    def __init__(self, predict_fn: Callable[[np.ndarray], np.ndarray], max_batch_size: int = 8,
+                 max_wait_ms: float = 5.0, name: str = "inference"):
+        """
+        Args:
+            predict_fn: 批量推理函数，输入 (B, ...) 的数组，返回第一维为B的结果
+            max_batch_size: 每批最多的样本数（1表示不合并）
+            max_wait_ms: 取到第一个样本后等待更多样本的最长时间（毫秒）
+            name: 工作线程名称，也用于日志
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self.name = name
+        self._queue: 'queue.Queue[Optional[Tuple[np.ndarray, Future, float]]]' = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._closed = False
+
+        # 统计信息
+        self._metrics_lock = threading.Lock()
+        self._batches = 0
+        self._samples = 0
+        self._errors = 0
+        self._batch_size_counts = [0] * (self.max_batch_size + 1)
+        self._queue_wait_total = 0.0
+        self._inference_total = 0.0
+        self._max_queue_depth = 0
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, sample: np.ndarray) -> Future:
+        """提交一个样本，返回其推理结果的Future"""
+        if self._closed:
+            raise RuntimeError(f"{self.name} 推理队列已关闭")
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((np.asarray(sample), future, time.perf_counter()))
+        depth = self._queue.qsize()
+        if depth > self._max_queue_depth:
+            self._max_queue_depth = depth
+        return future
+
+    def predict(self, sample: np.ndarray, timeout: Optional[float] = None) -> np.ndarray:
+        """提交一个样本并等待结果（该样本对应的一行输出）"""
+        return self.submit(sample).result(timeout)
+
+    def _collect(self, first) -> List[Tuple[np.ndarray, Future, float]]:
+        """从第一个样本开始，凑满一批或等待超时"""
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 关闭信号：处理完当前这批后退出
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [item for item in self._collect(first) if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                outputs = self.predict_fn(np.stack([sample for sample, _, _ in batch]))
+                elapsed = time.perf_counter() - started
+                for row, (_, future, _) in enumerate(batch):
+                    future.set_result(outputs[row])
+                errors = 0
+            except Exception as e:
+                elapsed = time.perf_counter() - started
+                logger.error(f"{self.name} 批量推理出错: {str(e)}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                errors = len(batch)
+
+            with self._metrics_lock:
+                self._batches += 1
+                self._samples += len(batch)
+                self._errors += errors
+                self._batch_size_counts[len(batch)] += 1
+                self._queue_wait_total += sum(started - enqueued for _, _, enqueued in batch)
+                self._inference_total += elapsed
+
+    def metrics(self) -> Dict[str, Any]:
+        """批大小、等待时间和推理耗时等统计"""
+        with self._metrics_lock:
+            batches, samples = self._batches, self._samples
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_ms,
+                "batches": batches,
+                "samples": samples,
+                "errors": self._errors,
+                "avg_batch_size": samples / batches if batches else 0.0,
+                "batch_size_histogram": {str(size): count for size, count in enumerate(self._batch_size_counts) if count},
+                "avg_queue_wait_ms": self._queue_wait_total * 1000.0 / samples if samples else 0.0,
+                "avg_inference_ms": self._inference_total * 1000.0 / batches if batches else 0.0,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth
+            }
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        """停止工作线程（已提交的样本仍会处理完）"""
+        self._closed = True
+        self._queue.put(None)
+        if self._worker is not None:
+            self._worker.join(timeout)
@@ -4,58 +4,73 @@ import numpy as np
 import dlib
 import time
 import logging
-from typing import Dict, Any, List, Tuple, Optional
-import tensorflow as tf
-from tensorflow.keras.models import load_model, Model
-from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Dropout, GlobalAveragePooling2D
+from collections import deque
+from typing import Dict, Any, List, Optional
+from models.texture_features import high_frequency_ratio
+from models.frame_analysis import FrameAnalysis, get_default_face_detector
+from models.session_store import SessionState
+from models.model_registry import get_shape_predictor, get_liveness_model
+from models.overlay import Overlay
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('liveness_detection')
 
+class ImprovedLivenessState:
+    """一个会话的综合活体检测状态：眨眼计数和结果平滑缓冲区"""
+    
+    def __init__(self, buffer_size: int = 5):
+        self.blink_counter = 0
+        self.blink_total = 0
+        self.last_blink_time = 0
+        self.history_buffer: deque = deque(maxlen=buffer_size)
+
+
 class ImprovedLivenessDetection:
     """改进的活体检测类，集成多种检测方法"""
     
-    def __init__(self, models_dir: str = "models"):
+    def __init__(self, models_dir: str = "models", batch_size: int = 8, batch_wait_ms: float = 5.0,
+                 runtime: str = "auto"):
         """
         初始化活体检测器
         
         Args:
             models_dir: 模型目录
+            batch_size: 并发请求合并推理时每批最多的人脸数
+            batch_wait_ms: 凑批时最长等待时间（毫秒）
+            runtime: 推理运行时，'auto'(有导出的.tflite时使用TFLite)、'tflite' 或 'keras'
         """
         self.models_dir = models_dir
         os.makedirs(models_dir, exist_ok=True)
         
         # 人脸检测器
-        self.face_detector = dlib.get_frontal_face_detector()
+        self.face_detector = get_default_face_detector()
         
         # 面部特征点检测器
         landmarks_model_path = os.path.join(models_dir, "shape_predictor_68_face_landmarks.dat")
         if os.path.exists(landmarks_model_path):
-            self.landmarks_detector = dlib.shape_predictor(landmarks_model_path)
+            # 与眨眼检测器共用同一个特征点模型
+            self.landmarks_detector = get_shape_predictor(landmarks_model_path)
         else:
             logger.warning(f"面部特征点检测模型文件不存在: {landmarks_model_path}")
             self.landmarks_detector = None
         
         # 深度学习模型
         self.dl_model_path = os.path.join(models_dir, "liveness_model.h5")
-        if os.path.exists(self.dl_model_path):
-            try:
-                self.dl_model = load_model(self.dl_model_path)
-                logger.info("已加载活体检测深度学习模型")
-            except Exception as e:
-                logger.error(f"加载深度学习模型失败: {str(e)}")
-                self.dl_model = self._create_improved_model()
-        else:
-            logger.info("未找到预训练的活体检测模型，创建新模型")
-            self.dl_model = self._create_improved_model()
+        try:
+            # 优先使用导出的TFLite模型，都不存在时创建新模型。模型和批推理队列在进程内与深度学习检测器共享：
+            # 并发请求的人脸区域合并为一批推理，模型只在批处理线程中调用
+            shared = get_liveness_model(self.dl_model_path, runtime, self._create_improved_model,
+                                        batch_size=batch_size, batch_wait_ms=batch_wait_ms)
+            self.dl_model, self.runtime, self.batcher = shared.model, shared.runtime, shared.batcher
+        except Exception as e:
+            # 加载失败时不覆盖已有的模型文件，只禁用深度学习检测
+            logger.error(f"加载深度学习模型失败: {str(e)}")
+            self.dl_model, self.runtime, self.batcher = None, None, None
         
         # 活体检测参数
         self.EYE_AR_THRESH = 0.2  # 眨眼检测阈值
         self.EYE_AR_CONSEC_FRAMES = 2  # 眨眼连续帧数
-        self.blink_counter = 0
-        self.blink_total = 0
-        self.last_blink_time = 0
         
         # 眼睛关键点索引
         self.LEFT_EYE_INDICES = [36, 37, 38, 39, 40, 41]
@@ -67,11 +82,16 @@ class ImprovedLivenessDetection:
         self.std = np.array([0.229, 0.224, 0.225])
         
         # 历史数据（用于防抖动）
-        self.history_buffer = []
         self.buffer_size = 5
+        
+        # 眨眼计数和平滑缓冲区按会话保存（见ImprovedLivenessState），未指定会话的请求共用默认会话
+        self.default_session = SessionState("default")
     
-    def _create_improved_model(self) -> Model:
-        """创建改进的活体检测模型"""
+    def _create_improved_model(self):
+        """创建改进的活体检测模型（需要TensorFlow，只在没有可用模型时导入）"""
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Dropout, GlobalAveragePooling2D
+        
         try:
             # 使用MobileNetV2的架构设计
             from tensorflow.keras.applications import MobileNetV2
@@ -130,41 +150,17 @@ class ImprovedLivenessDetection:
             
             return model
     
-    def detect_faces(self, frame: np.ndarray) -> List[dlib.rectangle]:
-        """检测图像中的人脸"""
-        # 转为灰度图
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # 使用dlib检测器
-        faces = self.face_detector(gray, 0)
-        
-        return faces
+    def detect_faces(self, frame: np.ndarray, analysis: Optional[FrameAnalysis] = None) -> List[dlib.rectangle]:
+        """检测图像中的人脸（传入analysis时复用其中的检测结果）"""
+        return FrameAnalysis.of(frame, analysis).dlib_faces()
     
-    def get_landmarks(self, frame: np.ndarray) -> List[np.ndarray]:
-        """获取图像中所有人脸的特征点"""
+    def get_landmarks(self, frame: np.ndarray, analysis: Optional[FrameAnalysis] = None) -> List[np.ndarray]:
+        """获取图像中所有人脸的特征点（传入analysis时复用其中的人脸框和特征点）"""
         if self.landmarks_detector is None:
             logger.warning("面部特征点检测器未初始化")
             return []
-            
-        # 转为灰度图
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # 检测人脸
-        faces = self.face_detector(gray, 0)
         
-        landmarks = []
-        for face in faces:
-            # 检测面部特征点
-            shape = self.landmarks_detector(gray, face)
-            
-            # 将特征点坐标转换为numpy数组
-            coords = np.zeros((68, 2), dtype=int)
-            for i in range(0, 68):
-                coords[i] = (shape.part(i).x, shape.part(i).y)
-            
-            landmarks.append(coords)
-        
-        return landmarks
+        return FrameAnalysis.of(frame, analysis).landmarks(self.landmarks_detector)
     
     def eye_aspect_ratio(self, eye: np.ndarray) -> float:
         """计算眼睛纵横比（EAR）"""
@@ -216,27 +212,8 @@ class ImprovedLivenessDetection:
         # 转换为灰度图
         gray = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
         
-        # 计算局部二值模式(LBP)特征
-        lbp = np.zeros_like(gray)
-        for i in range(1, gray.shape[0] - 1):
-            for j in range(1, gray.shape[1] - 1):
-                center = gray[i, j]
-                neighbors = [gray[i-1, j-1], gray[i-1, j], gray[i-1, j+1],
-                            gray[i, j+1], gray[i+1, j+1], gray[i+1, j],
-                            gray[i+1, j-1], gray[i, j-1]]
-                binary = [1 if n >= center else 0 for n in neighbors]
-                lbp[i, j] = sum([b * (2 ** idx) for idx, b in enumerate(binary)])
-        
-        # 计算LBP直方图
-        hist, _ = np.histogram(lbp, bins=256, range=(0, 256))
-        
-        # 归一化直方图
-        hist = hist.astype(np.float32) / (lbp.shape[0] * lbp.shape[1])
-        
-        # 使用高频纹理比例作为评分
-        high_freq_ratio = np.sum(hist[128:]) / np.sum(hist)
-        
-        return high_freq_ratio
+        # 使用高频纹理比例作为评分（LBP按整幅图数组运算计算）
+        return high_frequency_ratio(gray)
     
     def analyze_image_quality(self, face_img: np.ndarray) -> Dict[str, float]:
         """分析图像质量"""
@@ -258,8 +235,14 @@ class ImprovedLivenessDetection:
             "contrast": float(contrast)
         }
     
-    def check_blink(self, landmarks: np.ndarray) -> Dict[str, Any]:
-        """检查是否眨眼"""
+    def _state(self, session: Optional[SessionState]) -> ImprovedLivenessState:
+        """会话中本检测器的状态"""
+        session = session or self.default_session
+        return session.get("improved", lambda: ImprovedLivenessState(self.buffer_size))
+    
+    def check_blink(self, landmarks: np.ndarray, state: Optional[ImprovedLivenessState] = None) -> Dict[str, Any]:
+        """检查是否眨眼（state为会话状态，默认使用默认会话）"""
+        state = state or self._state(None)
         # 提取左右眼的特征点
         left_eye = landmarks[self.LEFT_EYE_INDICES]
         right_eye = landmarks[self.RIGHT_EYE_INDICES]
@@ -273,26 +256,26 @@ class ImprovedLivenessDetection:
         is_blinking = ear < self.EYE_AR_THRESH
         
         if is_blinking:
-            self.blink_counter += 1
+            state.blink_counter += 1
         else:
             # 如果连续几帧检测到眼睛闭合，则认为是眨眼
-            if self.blink_counter >= self.EYE_AR_CONSEC_FRAMES:
-                self.blink_total += 1
-                self.last_blink_time = time.time()
+            if state.blink_counter >= self.EYE_AR_CONSEC_FRAMES:
+                state.blink_total += 1
+                state.last_blink_time = time.time()
             
-            self.blink_counter = 0
+            state.blink_counter = 0
         
         # 判断是否为活体（检测到眨眼且时间间隔合理）
         current_time = time.time()
-        time_since_last_blink = current_time - self.last_blink_time
+        time_since_last_blink = current_time - state.last_blink_time
         
         # 如果5秒内有眨眼，就认为是活体
-        is_live_blink = self.blink_total > 0 and time_since_last_blink < 5.0
+        is_live_blink = state.blink_total > 0 and time_since_last_blink < 5.0
         
         return {
             "is_blinking": is_blinking,
             "ear": ear,
-            "blink_count": self.blink_total,
+            "blink_count": state.blink_total,
             "is_live": is_live_blink,
             "time_since_last_blink": time_since_last_blink,
             "confidence": 1.0 - time_since_last_blink / 5.0 if is_live_blink else 0.0
@@ -307,8 +290,8 @@ class ImprovedLivenessDetection:
             # 预处理图像
             processed_img = self.preprocess_image(face_img)
             
-            # 使用模型进行预测
-            prediction = self.dl_model.predict(processed_img)[0][0]
+            # 使用模型进行预测（与其他请求合并为一批）
+            prediction = self.batcher.predict(processed_img[0])[0]
             
             # 纹理分析作为辅助特征
             texture_score = self.analyze_texture(face_img)
@@ -330,35 +313,52 @@ class ImprovedLivenessDetection:
             logger.error(f"深度学习模型预测出错: {str(e)}")
             return {"is_live": False, "confidence": 0.0, "error": str(e)}
     
-    def apply_smoothing(self, current_result: Dict[str, Any]) -> Dict[str, Any]:
-        """应用平滑处理，防止结果抖动"""
-        # 添加当前结果到历史缓冲区
-        self.history_buffer.append(current_result)
-        
-        # 保持缓冲区大小
-        if len(self.history_buffer) > self.buffer_size:
-            self.history_buffer.pop(0)
+    def apply_smoothing(self, current_result: Dict[str, Any],
+                        state: Optional[ImprovedLivenessState] = None) -> Dict[str, Any]:
+        """应用平滑处理，防止结果抖动（state为会话状态，默认使用默认会话）"""
+        state = state or self._state(None)
+        history_buffer = state.history_buffer
+        # 添加当前结果到历史缓冲区（超出buffer_size时自动丢弃最旧的结果）
+        history_buffer.append(current_result)
         
         # 如果缓冲区为空，直接返回当前结果
-        if len(self.history_buffer) <= 1:
+        if len(history_buffer) <= 1:
             return current_result
         
         # 计算平滑后的结果
         smoothed_result = current_result.copy()
         
         # 计算平均置信度
-        confidences = [r["confidence"] for r in self.history_buffer if "confidence" in r]
+        confidences = [r["confidence"] for r in history_buffer if "confidence" in r]
         if confidences:
             smoothed_result["confidence"] = sum(confidences) / len(confidences)
         
         # 多数投票决定是否为活体
-        live_votes = sum(1 for r in self.history_buffer if r.get("is_live", False))
-        smoothed_result["is_live"] = live_votes > len(self.history_buffer) / 2
+        live_votes = sum(1 for r in history_buffer if r.get("is_live", False))
+        smoothed_result["is_live"] = live_votes > len(history_buffer) / 2
         
         return smoothed_result
     
-    def detect(self, frame: np.ndarray) -> Dict[str, Any]:
-        """综合多种方法进行活体检测"""
+    def warm_up(self, frame: np.ndarray) -> None:
+        """对合成帧做一次检测（使用临时会话），并直接对整帧做一次模型推理"""
+        self.detect(frame, session=SessionState("warmup"))
+        if self.batcher is not None:
+            self.batcher.predict(self.preprocess_image(frame)[0])
+    
+    def detect(self, frame: np.ndarray, analysis: Optional[FrameAnalysis] = None,
+               session: Optional[SessionState] = None, overlay: Optional[Overlay] = None) -> Dict[str, Any]:
+        """
+        综合多种方法进行活体检测
+        
+        Args:
+            frame: BGR图像
+            analysis: 同一帧的分析对象，与其他检测器/人脸识别共用灰度图、人脸框和特征点
+            session: 客户端会话，眨眼计数和平滑缓冲区按会话保存；None时使用默认会话
+            overlay: 调试叠加层，传入时记录人脸框、结果标签和眼部特征点，None时不做任何可视化
+        """
+        analysis = FrameAnalysis.of(frame, analysis)
+        session = session or self.default_session
+        state = self._state(session)
         result = {
             "is_live": False,
             "message": "活体检测失败",
@@ -368,7 +368,7 @@ class ImprovedLivenessDetection:
         }
         
         # 检测人脸
-        faces = self.detect_faces(frame)
+        faces = self.detect_faces(frame, analysis)
         
         if len(faces) == 0:
             result["message"] = "未检测到人脸"
@@ -379,7 +379,7 @@ class ImprovedLivenessDetection:
         face_img = self.extract_face(frame, face)
         
         # 获取面部特征点
-        landmarks = self.get_landmarks(frame)
+        landmarks = self.get_landmarks(frame, analysis)
         
         # 图像质量分析
         quality_metrics = self.analyze_image_quality(face_img)
@@ -388,7 +388,8 @@ class ImprovedLivenessDetection:
         # 眨眼检测
         blink_result = None
         if landmarks and len(landmarks) > 0:
-            blink_result = self.check_blink(landmarks[0])
+            with session.lock:
+                blink_result = self.check_blink(landmarks[0], state)
             result["details"]["blink"] = blink_result
         
         # 深度学习检测
@@ -425,7 +426,8 @@ class ImprovedLivenessDetection:
             combined_result["confidence"] = confidence_combined
         
         # 应用平滑处理
-        smoothed_result = self.apply_smoothing(combined_result)
+        with session.lock:
+            smoothed_result = self.apply_smoothing(combined_result, state)
         
         # 设置最终结果
         result["is_live"] = smoothed_result["is_live"]
@@ -436,30 +438,14 @@ class ImprovedLivenessDetection:
         else:
             result["message"] = "检测为欺骗攻击"
         
-        # 添加可视化结果
-        visualized_frame = frame.copy()
-        x, y, w, h = face.left(), face.top(), face.width(), face.height()
-        color = (0, 255, 0) if result["is_live"] else (0, 0, 255)
-        cv2.rectangle(visualized_frame, (x, y), (x+w, y+h), color, 2)
-        
-        # 添加结果标签
-        label = f"Live: {result['is_live']}, Conf: {result['confidence']:.2f}"
-        cv2.putText(
-            visualized_frame, 
-            label, 
-            (x, y-10), 
-            cv2.FONT_HERSHEY_SIMPLEX, 
-            0.5, 
-            color, 
-            2
-        )
-        
-        # 如果有眨眼检测结果，在图像上标注
-        if landmarks and len(landmarks) > 0:
-            for eye_points in [self.LEFT_EYE_INDICES, self.RIGHT_EYE_INDICES]:
-                for i in eye_points:
-                    cv2.circle(visualized_frame, tuple(landmarks[0][i]), 2, (0, 255, 255), -1)
-        
-        result["visualized_frame"] = visualized_frame
+        # 添加可视化结果（按请求记录人脸框和结果标签）
+        if overlay is not None:
+            color = (0, 255, 0) if result["is_live"] else (0, 0, 255)
+            label = f"Live: {result['is_live']}, Conf: {result['confidence']:.2f}"
+            overlay.box(face.left(), face.top(), face.width(), face.height(), color, label)
+            
+            # 如果有眨眼检测结果，标注眼部特征点
+            if landmarks and len(landmarks) > 0:
+                overlay.points([landmarks[0][i] for i in self.LEFT_EYE_INDICES + self.RIGHT_EYE_INDICES], (0, 255, 255))
         
         return result 
\ No newline at end of file
@@ -0,0 +1,263 @@
+"""
+活体检测模型的轻量推理运行时
+
+训练/导出仍使用Keras（.h5），线上推理优先使用导出的TFLite模型：
+只需要tflite_runtime（或TensorFlow自带的tf.lite解释器），导入快、单次推理开销小，
+也可选择int8量化进一步减小模型和延迟。
+
+导出示例（在backend目录下运行）:
+    python -m models.liveness_runtime export models/liveness_model.h5
+    python -m models.liveness_runtime export models/liveness_model.h5 --quantize int8 --calibration-dir faces/
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+from typing import Any, Iterator, Optional, Tuple
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('liveness_runtime')
+
+# 推理运行时：auto（存在同名.tflite时使用TFLite，否则Keras）、tflite、keras
+RUNTIMES = ("auto", "tflite", "keras")
+QUANTIZE_MODES = ("none", "dynamic", "int8")
+
+# 与两个深度学习检测器的预处理一致（用于int8量化的校准数据）
+INPUT_SIZE = (96, 96)
+MEAN = np.array([0.485, 0.456, 0.406])
+STD = np.array([0.229, 0.224, 0.225])
+
+
+def tflite_path_for(h5_path: str) -> str:
+    """Keras模型对应的TFLite模型路径（同目录同名，扩展名为.tflite）"""
+    return os.path.splitext(h5_path)[0] + ".tflite"
+
+
+def _interpreter_class():
+    """优先使用独立的tflite_runtime包，没有时使用TensorFlow自带的解释器"""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+
+
+class TFLiteLivenessModel:
+    """
+    TFLite活体检测模型，接口与Keras模型的predict_on_batch相同
+
+    解释器不是线程安全的，调用方需保证同一时刻只有一个线程调用（检测器通过BatchingPredictor的
+    工作线程调用，满足这一点）。int8量化模型的输入输出在这里完成量化/反量化，调用方始终使用float32。
+    """
+
+    def __init__(self, model_path: str, num_threads: Optional[int] = None):
+        """
+        Args:
+            model_path: .tflite模型文件
+            num_threads: 解释器使用的CPU线程数（None时由运行时决定）
+        """
+        self.model_path = model_path
+        self.interpreter = _interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._refresh_details()
+        # 部分模型不支持修改批大小，此时逐个样本推理
+        self._resizable = True
+
+    def _refresh_details(self) -> None:
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+
+    @property
+    def input_shape(self) -> Tuple[int, ...]:
+        """单个样本的输入形状（不含批次维度）"""
+        return tuple(int(dim) for dim in self.input_details['shape'][1:])
+
+    @property
+    def quantized(self) -> bool:
+        return self.input_details['dtype'] in (np.int8, np.uint8)
+
+    def _resize(self, batch_size: int) -> bool:
+        """把输入张量的批大小改为batch_size，不支持时返回False"""
+        if int(self.input_details['shape'][0]) == batch_size:
+            return True
+        if not self._resizable:
+            return False
+        try:
+            self.interpreter.resize_tensor_input(self.input_details['index'],
+                                                 [batch_size] + list(self.input_shape))
+            self.interpreter.allocate_tensors()
+            self._refresh_details()
+            return True
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"TFLite模型不支持批大小 {batch_size}，改为逐个样本推理: {str(e)}")
+            self._resizable = False
+            return False
+
+    def _invoke(self, batch: np.ndarray) -> np.ndarray:
+        details = self.input_details
+        if self.quantized:
+            scale, zero_point = details['quantization']
+            info = np.iinfo(details['dtype'])
+            batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(details['index'], batch.astype(details['dtype']))
+        self.interpreter.invoke()
+
+        output = self.interpreter.get_tensor(self.output_details['index'])
+        if self.output_details['dtype'] in (np.int8, np.uint8):
+            scale, zero_point = self.output_details['quantization']
+            return (output.astype(np.float32) - zero_point) * scale
+        return output.astype(np.float32)
+
+    def predict_on_batch(self, batch: np.ndarray) -> np.ndarray:
+        """批量推理，输入 (B, H, W, C) 的预处理后图像，返回 (B, 1) 的活体概率"""
+        batch = np.asarray(batch, dtype=np.float32)
+        if self._resize(len(batch)):
+            return self._invoke(batch)
+        self._resize(1)
+        return np.concatenate([self._invoke(sample[np.newaxis]) for sample in batch])
+
+
+def load_keras_model(model_path: str) -> Any:
+    """加载Keras模型（只在需要时导入TensorFlow）"""
+    from tensorflow.keras.models import load_model
+    return load_model(model_path, compile=False)
+
+
+def load_liveness_model(h5_path: str, runtime: str = "auto",
+                        num_threads: Optional[int] = None) -> Tuple[Optional[Any], Optional[str]]:
+    """
+    按运行时设置加载活体检测模型
+
+    auto: 存在同名.tflite文件且不早于.h5时使用TFLite，否则加载.h5；
+    tflite: 只使用.tflite（不存在时返回None）；keras: 只使用.h5。
+
+    Returns:
+        (带predict_on_batch方法的模型, 实际使用的运行时名称)，没有可用的模型文件时为 (None, None)
+    """
+    if runtime not in RUNTIMES:
+        raise ValueError(f"不支持的推理运行时: {runtime}")
+
+    tflite_path = tflite_path_for(h5_path)
+    if runtime in ("auto", "tflite") and os.path.exists(tflite_path):
+        if runtime == "auto" and os.path.exists(h5_path) and os.path.getmtime(tflite_path) < os.path.getmtime(h5_path):
+            logger.warning(f"{tflite_path} 早于 {h5_path}，请重新导出；本次使用Keras模型")
+        else:
+            try:
+                start = time.perf_counter()
+                model = TFLiteLivenessModel(tflite_path, num_threads)
+                logger.info(f"已加载TFLite活体检测模型 {tflite_path}（{(time.perf_counter() - start) * 1000:.0f} ms）")
+                return model, "tflite"
+            except Exception as e:
+                if runtime == "tflite":
+                    raise
+                logger.error(f"加载TFLite模型失败，改用Keras模型: {str(e)}")
+
+    if runtime in ("auto", "keras") and os.path.exists(h5_path):
+        start = time.perf_counter()
+        model = load_keras_model(h5_path)
+        logger.info(f"已加载Keras活体检测模型 {h5_path}（{(time.perf_counter() - start) * 1000:.0f} ms）")
+        return model, "keras"
+    return None, None
+
+
+def preprocess(image: np.ndarray) -> np.ndarray:
+    """与检测器相同的预处理：缩放、归一化、标准化（不含批次维度）"""
+    image = cv2.resize(image, INPUT_SIZE).astype(np.float32) / 255.0
+    return ((image - MEAN) / STD).astype(np.float32)
+
+
+def calibration_samples(calibration_dir: Optional[str] = None, count: int = 100,
+                        seed: int = 0) -> Iterator[np.ndarray]:
+    """
+    int8量化的校准样本（预处理后的人脸图像）
+
+    应提供真实人脸截图目录；未提供时使用随机图像，量化范围会不准确。
+    """
+    produced = 0
+    if calibration_dir:
+        paths = sorted(path for pattern in ("*.jpg", "*.jpeg", "*.png")
+                       for path in glob.glob(os.path.join(calibration_dir, pattern)))
+        for path in paths[:count]:
+            image = cv2.imread(path)
+            if image is not None:
+                produced += 1
+                yield preprocess(image)
+    if produced == 0:
+        logger.warning("没有可用的人脸图像，改用随机图像（用于int8校准时量化精度会下降）")
+        rng = np.random.default_rng(seed)
+        for _ in range(count):
+            yield preprocess(rng.integers(0, 256, INPUT_SIZE + (3,), dtype=np.uint8))
+
+
+def export_tflite(h5_path: str, output_path: Optional[str] = None, quantize: str = "none",
+                  calibration_dir: Optional[str] = None, calibration_count: int = 100) -> str:
+    """
+    把Keras活体检测模型导出为TFLite模型
+
+    Args:
+        h5_path: Keras模型文件
+        output_path: 输出路径（默认为同名.tflite，检测器在auto模式下会自动使用）
+        quantize: 'none'(float32)、'dynamic'(权重int8)、'int8'(权重和激活全部int8，需要校准数据)
+        calibration_dir: int8量化的校准人脸图像目录
+        calibration_count: 校准图像数量
+
+    Returns:
+        输出文件路径
+    """
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f"不支持的量化方式: {quantize}")
+    import tensorflow as tf
+
+    model = load_keras_model(h5_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize in ("dynamic", "int8"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == "int8":
+        def representative_dataset() -> Iterator[list]:
+            for sample in calibration_samples(calibration_dir, calibration_count):
+                yield [sample[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    content = converter.convert()
+    output_path = output_path or tflite_path_for(h5_path)
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, output_path)
+    logger.info(f"已导出TFLite模型 {output_path}（{quantize}，{len(content) / 1024:.0f} KB，"
+                f"原模型 {os.path.getsize(h5_path) / 1024:.0f} KB）")
+    return output_path
+
+
+def parse_arguments(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='活体检测模型导出')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='把Keras模型导出为TFLite模型')
+    export.add_argument('h5_path', type=str, help='Keras模型文件（.h5）')
+    export.add_argument('--output', type=str, default=None, help='输出文件，默认为同名.tflite')
+    export.add_argument('--quantize', type=str, default='none', choices=QUANTIZE_MODES, help='量化方式')
+    export.add_argument('--calibration-dir', type=str, default=None, help='int8量化的校准人脸图像目录')
+    export.add_argument('--calibration-count', type=int, default=100, help='校准图像数量')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.command == 'export':
+        try:
+            print(export_tflite(args.h5_path, args.output, args.quantize, args.calibration_dir, args.calibration_count))
+        except Exception as e:
+            logger.error(f"导出失败: {str(e)}")
+            sys.exit(1)
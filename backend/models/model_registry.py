@@ -0,0 +1,255 @@
+import os
+import time
+import numpy as np
+import threading
+from typing import Dict, Any, Callable, Iterable, List, Optional
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('model_registry')
+
+
+class ModelRegistry:
+    """
+    进程内的模型注册表
+
+    按名称登记加载函数，第一次get时才加载，之后所有使用者共享同一个对象（dlib特征点模型、
+    活体检测CNN、各活体检测器都只加载一次）。不同名称的模型各自加锁，可以并行加载；
+    同一名称的并发get只有一个线程执行加载，其余等待其结果。加载失败不缓存，下次get会重试；
+    加载或预热失败的模型可由retry_failed按指数退避在后台重新预热（如模型文件稍后才可读），无需重启进程。
+    """
+
+    def __init__(self, retry_backoff_s: float = 5.0, max_retry_backoff_s: float = 300.0):
+        """
+        Args:
+            retry_backoff_s: 加载或预热失败后第一次重试前的等待时间（秒），之后每次失败翻倍
+            max_retry_backoff_s: 重试等待时间的上限（秒）
+        """
+        self.retry_backoff_s = retry_backoff_s
+        self.max_retry_backoff_s = max_retry_backoff_s
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # 每个模型的状态：registered / loading / loaded / warming / ready / error，以及加载、预热耗时和错误信息
+        self._status: Dict[str, Dict[str, Any]] = {}
+        # 各模型连续失败的次数（成功后清零）和正在后台重试的模型
+        self._failures: Dict[str, int] = {}
+        self._retrying: set = set()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """登记加载函数（已加载的模型不受影响）"""
+        with self._lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+            self._status.setdefault(name, {"state": "registered"})
+
+    def get(self, name: str) -> Any:
+        """获取模型，尚未加载时在当前线程加载"""
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            if name not in self._factories:
+                raise KeyError(f"未登记的模型: {name}")
+            lock = self._locks[name]
+        with lock:
+            instance = self._instances.get(name)
+            if instance is not None:
+                return instance
+            self._status[name] = {"state": "loading", "started_at": time.time()}
+            start = time.perf_counter()
+            try:
+                instance = self._factories[name]()
+            except Exception as e:
+                self._status[name] = {"state": "error", "error": str(e),
+                                      "load_time_s": time.perf_counter() - start}
+                self._record_failure(name)
+                logger.error(f"加载模型 {name} 失败: {str(e)}")
+                raise
+            load_time = time.perf_counter() - start
+            self._instances[name] = instance
+            self._status[name] = {"state": "loaded", "load_time_s": load_time}
+            logger.info(f"已加载模型 {name}（{load_time:.2f} s）")
+            return instance
+
+    def get_or_load(self, name: str, factory: Callable[[], Any]) -> Any:
+        """获取模型，未登记时先用factory登记（同名模型只加载一次，先登记的加载函数生效）"""
+        if name not in self._factories:
+            with self._lock:
+                if name not in self._factories:
+                    self._factories[name] = factory
+                    self._locks[name] = threading.Lock()
+                    self._status[name] = {"state": "registered"}
+        return self.get(name)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def warm_up(self, name: str, frame: Optional[np.ndarray] = None) -> None:
+        """
+        加载模型并调用其warm_up(frame)方法预热（如对合成帧做一次完整检测，完成图构建和首次推理的初始化），
+        记录预热耗时；没有warm_up方法的模型加载后即视为就绪
+        """
+        instance = self.get(name)
+        warm = getattr(instance, "warm_up", None)
+        status = self._status[name]
+        if warm is None:
+            status["state"] = "ready"
+            self._failures.pop(name, None)
+            return
+        status["state"] = "warming"
+        start = time.perf_counter()
+        try:
+            warm(warmup_frame() if frame is None else frame)
+        except Exception as e:
+            status.update(state="error", error=f"预热失败: {str(e)}", warmup_time_s=time.perf_counter() - start)
+            self._record_failure(name)
+            logger.error(f"预热模型 {name} 失败: {str(e)}")
+            raise
+        status.update(state="ready", warmup_time_s=time.perf_counter() - start)
+        self._failures.pop(name, None)
+        logger.info(f"模型 {name} 预热完成（{status['warmup_time_s']:.2f} s）")
+
+    def _record_failure(self, name: str) -> None:
+        """记录一次失败，按连续失败次数计算下次可以重试的时间"""
+        failures = self._failures.get(name, 0) + 1
+        self._failures[name] = failures
+        backoff = min(self.retry_backoff_s * 2 ** (failures - 1), self.max_retry_backoff_s)
+        self._status[name].update(failures=failures, retry_at=time.time() + backoff)
+
+    def retry_failed(self, names: Iterable[str], frame: Optional[np.ndarray] = None) -> List[str]:
+        """
+        在后台重新加载并预热失败且已过退避时间的模型（同一模型同时只有一个重试线程）
+
+        Returns:
+            本次开始重试的模型名称
+        """
+        now = time.time()
+        started = []
+        with self._lock:
+            for name in names:
+                status = self._status.get(name, {})
+                if status.get("state") != "error" or status.get("retry_at", 0) > now or name in self._retrying:
+                    continue
+                self._retrying.add(name)
+                status["retrying"] = True
+                started.append(name)
+
+        def retry(name: str) -> None:
+            try:
+                logger.info(f"重试预热模型 {name}（已连续失败 {self._failures.get(name, 0)} 次）")
+                self.warm_up(name, frame)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._retrying.discard(name)
+                    self._status.get(name, {}).pop("retrying", None)
+
+        for name in started:
+            threading.Thread(target=retry, args=(name,), name=f"model-retry-{name}", daemon=True).start()
+        return started
+
+    def is_ready(self, names: Iterable[str]) -> bool:
+        """给定的模型是否都已加载并完成预热"""
+        return all(self._status.get(name, {}).get("state") == "ready" for name in names)
+
+    def preload(self, names: Optional[Iterable[str]] = None, background: bool = True,
+                warm_up: bool = False) -> Optional[threading.Thread]:
+        """
+        预加载模型（默认为全部已登记的模型），warm_up为True时加载后再预热
+
+        background为True时在后台线程中依次加载并立即返回该线程；加载失败只记录日志，
+        请求到来时会再次尝试加载。
+        """
+        names = list(self._factories) if names is None else list(names)
+
+        def load_all():
+            frame = warmup_frame() if warm_up else None
+            for name in names:
+                try:
+                    if warm_up:
+                        self.warm_up(name, frame)
+                    else:
+                        self.get(name)
+                except Exception:
+                    pass
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name="model-preload", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """各模型的加载状态和耗时"""
+        with self._lock:
+            return {name: dict(status) for name, status in self._status.items()}
+
+
+# 进程内共享的注册表
+registry = ModelRegistry()
+
+
+def warmup_frame(width: int = 640, height: int = 480) -> np.ndarray:
+    """
+    预热用的合成帧：浅色背景上一个椭圆形"脸"和两只"眼睛"
+
+    不一定能被检测为人脸，各模型的warm_up方法需要自行保证推理路径被执行到。
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(150, 200, (height, width, 3), dtype=np.uint8)
+    center = (width // 2, height // 2)
+    axes = (width // 8, height // 5)
+    yy, xx = np.ogrid[:height, :width]
+    face = ((xx - center[0]) / axes[0]) ** 2 + ((yy - center[1]) / axes[1]) ** 2 <= 1
+    frame[face] = (120, 150, 190)
+    for dx in (-axes[0] // 2, axes[0] // 2):
+        eye = (xx - center[0] - dx) ** 2 + (yy - center[1] + axes[1] // 3) ** 2 <= (axes[0] // 6) ** 2
+        frame[eye] = (40, 40, 40)
+    return frame
+
+
+def get_shape_predictor(model_path: str) -> Any:
+    """dlib 68点特征点模型（约100MB），同一文件在进程内只加载一次"""
+    import dlib
+    return registry.get_or_load(f"shape_predictor:{os.path.abspath(model_path)}",
+                                lambda: dlib.shape_predictor(model_path))
+
+
+class SharedLivenessModel:
+    """共享的活体检测CNN：模型、实际使用的推理运行时，以及合并并发请求的批推理队列"""
+
+    def __init__(self, model: Any, runtime: str, batcher: Any):
+        self.model = model
+        self.runtime = runtime
+        self.batcher = batcher
+
+
+def get_liveness_model(h5_path: str, runtime: str = "auto", create_fn: Optional[Callable[[], Any]] = None,
+                       batch_size: int = 8, batch_wait_ms: float = 5.0) -> SharedLivenessModel:
+    """
+    活体检测CNN，同一模型文件和运行时在进程内只加载一次
+
+    两个深度学习检测器使用同一个模型文件和相同的预处理，因此共用模型和批推理队列：
+    模型只在一个批处理线程中调用（TFLite解释器不是线程安全的），两个检测器的请求也能合并成批。
+    模型文件都不存在时调用create_fn创建（需要TensorFlow）。
+    """
+    def load() -> SharedLivenessModel:
+        from models.liveness_runtime import load_liveness_model
+        from models.inference_batcher import BatchingPredictor
+
+        model, used_runtime = load_liveness_model(h5_path, runtime)
+        if model is None:
+            if create_fn is None:
+                raise FileNotFoundError(f"活体检测模型不存在: {h5_path}")
+            logger.info("未找到可用的活体检测模型，创建新模型")
+            model, used_runtime = create_fn(), "keras"
+        batcher = BatchingPredictor(model.predict_on_batch, max_batch_size=batch_size,
+                                    max_wait_ms=batch_wait_ms, name="liveness_model")
+        return SharedLivenessModel(model, used_runtime, batcher)
+
+    return registry.get_or_load(f"liveness_model:{os.path.abspath(h5_path)}:{runtime}", load)
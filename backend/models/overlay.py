@@ -0,0 +1,88 @@
+import cv2
+import base64
+import numpy as np
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+# 调试叠加层的返回方式：none(不返回)、jpeg(绘制后的JPEG，data URL)、primitives(绘制图元列表)
+OVERLAY_MODES = ("none", "jpeg", "primitives")
+
+Color = Tuple[int, int, int]
+
+
+def _hex_color(color: Color) -> str:
+    """BGR颜色 -> '#rrggbb'（前端使用的RGB十六进制）"""
+    b, g, r = (int(c) for c in color)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+class Overlay:
+    """
+    检测结果的调试叠加层
+
+    检测器只记录要绘制的图元（人脸框、标签、特征点、轮廓），不复制也不修改帧；请求需要时才由
+    render在帧的副本上一次绘制，或直接以图元列表返回，由前端自行绘制。
+    """
+
+    def __init__(self):
+        self.primitives: List[Dict[str, Any]] = []
+
+    def box(self, x: int, y: int, w: int, h: int, color: Color, label: Optional[str] = None) -> None:
+        """人脸框，label绘制在框的上方"""
+        self.primitives.append({"type": "box", "x": int(x), "y": int(y), "w": int(w), "h": int(h),
+                                "color": color, "label": label})
+
+    def points(self, points: Sequence[Sequence[int]], color: Color, radius: int = 2) -> None:
+        """特征点"""
+        self.primitives.append({"type": "points", "points": [[int(px), int(py)] for px, py in points],
+                                "color": color, "radius": int(radius)})
+
+    def polygon(self, points: Sequence[Sequence[int]], color: Color) -> None:
+        """闭合轮廓（如眼睛的凸包）"""
+        self.primitives.append({"type": "polygon", "points": [[int(px), int(py)] for px, py in np.reshape(points, (-1, 2))],
+                                "color": color})
+
+    def render(self, frame: np.ndarray) -> np.ndarray:
+        """在帧的副本上绘制全部图元"""
+        canvas = frame.copy()
+        for item in self.primitives:
+            color = item["color"]
+            if item["type"] == "box":
+                x, y, w, h = item["x"], item["y"], item["w"], item["h"]
+                cv2.rectangle(canvas, (x, y), (x + w, y + h), color, 2)
+                if item["label"]:
+                    cv2.putText(canvas, item["label"], (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+            elif item["type"] == "points":
+                for point in item["points"]:
+                    cv2.circle(canvas, tuple(point), item["radius"], color, -1)
+            elif item["type"] == "polygon":
+                cv2.drawContours(canvas, [np.array(item["points"], dtype=np.int32)], -1, color, 1)
+        return canvas
+
+    def to_jpeg(self, frame: np.ndarray, quality: int = 80) -> str:
+        """绘制后编码为JPEG，返回data URL"""
+        ok, buffer = cv2.imencode(".jpg", self.render(frame), [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if not ok:
+            raise ValueError("叠加层JPEG编码失败")
+        return "data:image/jpeg;base64," + base64.b64encode(buffer.tobytes()).decode("ascii")
+
+    def to_primitives(self) -> List[Dict[str, Any]]:
+        """可直接JSON序列化的图元列表（颜色为RGB十六进制）"""
+        return [dict(item, color=_hex_color(item["color"])) for item in self.primitives]
+
+
+def overlay_for(mode: Optional[str]) -> Optional[Overlay]:
+    """按请求的返回方式创建叠加层，none时返回None（检测器不记录任何图元）"""
+    mode = mode or "none"
+    if mode not in OVERLAY_MODES:
+        raise ValueError(f"不支持的叠加层方式: {mode}")
+    return None if mode == "none" else Overlay()
+
+
+def export_overlay(overlay: Optional[Overlay], mode: Optional[str], frame: np.ndarray,
+                   quality: int = 80) -> Optional[Any]:
+    """按返回方式输出叠加层：jpeg为data URL字符串，primitives为图元列表，none为None"""
+    if overlay is None:
+        return None
+    if mode == "jpeg":
+        return overlay.to_jpeg(frame, quality)
+    return overlay.to_primitives()
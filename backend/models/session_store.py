@@ -0,0 +1,116 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('session_store')
+
+
+class SessionState:
+    """
+    一个客户端会话的检测状态
+
+    每个检测器在其中保存自己的状态对象（眨眼计数、EAR历史、平滑缓冲区、API调用时间等），
+    按名称区分、首次使用时创建。同一会话的并发请求通过lock串行修改状态。
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.lock = threading.RLock()
+        self._states: Dict[str, Any] = {}
+
+    def get(self, name: str, factory: Callable[[], Any]) -> Any:
+        """获取名为name的状态对象，不存在时用factory创建"""
+        state = self._states.get(name)
+        if state is None:
+            with self.lock:
+                state = self._states.get(name)
+                if state is None:
+                    state = factory()
+                    self._states[name] = state
+        return state
+
+    def reset(self, name: Optional[str] = None) -> None:
+        """清除某个检测器的状态（name为None时清除全部）"""
+        with self.lock:
+            if name is None:
+                self._states.clear()
+            else:
+                self._states.pop(name, None)
+
+
+class SessionStore:
+    """
+    按会话ID保存检测状态，超过ttl未访问或超过max_sessions个时淘汰
+
+    会话按最近访问顺序保存在OrderedDict中，每次访问移到末尾；淘汰时只需从头部弹出，
+    成本与淘汰的会话数成正比，大量会话来来去去时内存占用也不超过max_sessions个会话。
+    """
+
+    def __init__(self, max_sessions: int = 10000, ttl: float = 300, max_id_length: int = 128):
+        """
+        Args:
+            max_sessions: 最多保存的会话数，超出时淘汰最久未访问的会话
+            ttl: 会话超过该时间（秒）未访问即过期
+            max_id_length: 会话ID的最大长度，更长的ID视为无效
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_id_length = max_id_length
+        self._sessions: 'OrderedDict[str, SessionState]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0  # 累计淘汰的会话数
+
+    def get(self, session_id: str) -> SessionState:
+        """获取会话状态，不存在或已过期时新建"""
+        if not session_id or len(session_id) > self.max_id_length:
+            raise ValueError("会话ID无效")
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.last_access > self.ttl:
+                del self._sessions[session_id]
+                self.evicted += 1
+                session = None
+            if session is None:
+                session = SessionState(session_id)
+                self._sessions[session_id] = session
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_access = now
+            self._evict(now)
+        return session
+
+    def _evict(self, now: float) -> None:
+        """从最久未访问的一端淘汰过期或超出数量的会话（调用方持有_lock）"""
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_access <= self.ttl:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
+
+    def discard(self, session_id: str) -> None:
+        """删除会话（如客户端结束签到）"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def purge_expired(self) -> None:
+        """淘汰所有过期会话"""
+        with self._lock:
+            self._evict(time.time())
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self._sessions), "max_sessions": self.max_sessions,
+                "ttl": self.ttl, "evicted": self.evicted}
@@ -0,0 +1,348 @@
+import numpy as np
+import os
+import mmap
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple, Optional, Iterator
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，共享人脸库不可用
+    fcntl = None
+
+from models.gallery_store import ROW_META_DTYPE
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('shared_gallery')
+
+# 控制文件：魔数、格式版本、编码维度、学生ID宽度、图像路径宽度、代数（generation）、
+#           有效行数、容量、数据段编号、人脸库来源标记
+CONTROL_STRUCT = struct.Struct('<4sHHHHQQQQq')
+CONTROL_MAGIC = b'FGSH'
+CONTROL_VERSION = 1
+CONTROL_SIZE = 64
+GENERATION_OFFSET = struct.calcsize('<4sHHHH')
+
+DEFAULT_SHM_DIR = "/dev/shm"
+
+
+class SharedGalleryView:
+    """某一代共享人脸库的只读视图（数组直接映射共享内存，不复制）"""
+
+    def __init__(self, generation: int, segment: int, stamp: int, matrix: np.ndarray, sq_norms: np.ndarray,
+                 student_ids: List[str], image_paths: List[str], row_meta: np.ndarray):
+        self.generation = generation
+        self.segment = segment
+        self.stamp = stamp
+        self.matrix = matrix
+        self.sq_norms = sq_norms
+        self.student_ids = student_ids
+        self.image_paths = image_paths
+        self.row_meta = row_meta
+
+    def __len__(self) -> int:
+        return len(self.student_ids)
+
+
+class SharedGallery:
+    """
+    多个工作进程共享的人脸库编码矩阵
+
+    编码矩阵、平方范数、学生ID、图像路径和行元数据放在共享内存目录（/dev/shm）下的数据段文件中，
+    各进程以内存映射方式读取，N个工作进程只占用一份物理内存。控制文件中的代数在每次写入后递增，
+    读取方每次查询前只需比较代数（一次内存读取），变化时重新映射即可看到其他进程注册的编码。
+
+    写入方通过fcntl文件锁互斥。追加只写入有效行数之后的位置，最后更新行数和代数；
+    容量不足或整体重新发布时写入新的数据段文件并切换段编号，旧段文件删除后已映射的进程仍可继续读取。
+    控制字段的更新按顺序锁（seqlock）方式进行：修改期间代数为奇数，读取方遇到奇数或前后代数不一致时重读。
+    """
+
+    def __init__(self, name: str, dim: int = 128, id_width: int = 64, path_width: int = 200,
+                 directory: Optional[str] = None):
+        """
+        Args:
+            name: 共享人脸库名称（同一台机器上的工作进程使用相同名称）
+            dim: 编码维度
+            id_width: 学生ID的最大字节数
+            path_width: 图像路径的最大字节数
+            directory: 共享文件所在目录，默认为 /dev/shm（不存在时使用系统临时目录）
+        """
+        if fcntl is None:
+            raise RuntimeError("当前平台不支持共享人脸库（需要fcntl）")
+        self.name = name
+        self.dim = dim
+        self.id_width = id_width
+        self.path_width = path_width
+        if directory is None:
+            directory = DEFAULT_SHM_DIR if os.path.isdir(DEFAULT_SHM_DIR) else tempfile.gettempdir()
+        self.directory = directory
+        self._control_path = os.path.join(directory, f"{name}.ctl")
+        self._lock_path = os.path.join(directory, f"{name}.lock")
+        # flock锁属于打开的文件描述，fork后的子进程需要重新打开锁文件；同一进程内的线程用RLock互斥
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock_pid = os.getpid()
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+
+        with self.lock():
+            fd = os.open(self._control_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < CONTROL_SIZE:
+                    os.ftruncate(fd, CONTROL_SIZE)
+                    os.pwrite(fd, CONTROL_STRUCT.pack(CONTROL_MAGIC, CONTROL_VERSION, dim, id_width, path_width,
+                                                      0, 0, 0, 0, 0), 0)
+                self._control = mmap.mmap(fd, CONTROL_SIZE)
+            finally:
+                os.close(fd)
+            magic, version, stored_dim, stored_id_width, stored_path_width = CONTROL_STRUCT.unpack_from(self._control)[:5]
+            if magic != CONTROL_MAGIC or version != CONTROL_VERSION:
+                raise ValueError(f"共享人脸库控制文件格式不正确: {self._control_path}")
+            if (stored_dim, stored_id_width, stored_path_width) != (dim, id_width, path_width):
+                raise ValueError("共享人脸库的维度或字段宽度与当前配置不一致")
+
+        # 读取方缓存：当前映射的数据段及已解码的学生ID和图像路径
+        self._segment = None
+        self._arrays = None
+        self._student_ids: List[str] = []
+        self._image_paths: List[str] = []
+
+    # ---- 控制字段 ----
+
+    def _read_control(self) -> Tuple[int, int, int, int, int]:
+        """返回 (代数, 有效行数, 容量, 数据段编号, 来源标记)"""
+        return CONTROL_STRUCT.unpack_from(self._control)[5:]
+
+    def _write_control(self, count: int, capacity: int, segment: int, stamp: int) -> int:
+        """按顺序锁更新控制字段（调用方需持有文件锁），返回新的代数"""
+        generation = self._read_control()[0]
+        header = CONTROL_STRUCT.pack(CONTROL_MAGIC, CONTROL_VERSION, self.dim, self.id_width, self.path_width,
+                                     generation + 1, count, capacity, segment, stamp)
+        # 先把代数改为奇数（修改中），再写其他字段，最后写入新的偶数代数
+        self._control[GENERATION_OFFSET:GENERATION_OFFSET + 8] = struct.pack('<Q', generation + 1)
+        self._control[:CONTROL_STRUCT.size] = header
+        self._control[GENERATION_OFFSET:GENERATION_OFFSET + 8] = struct.pack('<Q', generation + 2)
+        return generation + 2
+
+    @property
+    def generation(self) -> int:
+        """当前代数（每次写入后递增）"""
+        return struct.unpack_from('<Q', self._control, GENERATION_OFFSET)[0]
+
+    @property
+    def stamp(self) -> int:
+        """发布者记录的人脸库来源标记（如人脸库文件的修改时间），用于判断共享内容是否过期"""
+        return self._read_control()[4]
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """写入方互斥锁（跨进程，可重入）"""
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                if self._lock_pid != os.getpid():
+                    self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    self._lock_pid = os.getpid()
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # ---- 数据段 ----
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{self.name}.{segment}.seg")
+
+    def _layout(self, capacity: int) -> List[Tuple[str, np.dtype, tuple, int]]:
+        """数据段中各数组的 (名称, 类型, 形状, 偏移)"""
+        fields = [
+            ("matrix", np.dtype(np.float32), (capacity, self.dim)),
+            ("sq_norms", np.dtype(np.float32), (capacity,)),
+            ("student_ids", np.dtype(f'S{self.id_width}'), (capacity,)),
+            ("image_paths", np.dtype(f'S{self.path_width}'), (capacity,)),
+            ("row_meta", ROW_META_DTYPE, (capacity,)),
+        ]
+        layout = []
+        offset = 0
+        for name, dtype, shape in fields:
+            layout.append((name, dtype, shape, offset))
+            offset += (int(np.prod(shape)) * dtype.itemsize + 63) // 64 * 64
+        return layout
+
+    def _map_segment(self, segment: int, capacity: int, mode: str = 'r'):
+        """映射数据段，返回 名称 -> 数组"""
+        path = self._segment_path(segment)
+        return {name: np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=shape)
+                for name, dtype, shape, offset in self._layout(capacity)}
+
+    def _create_segment(self, segment: int, capacity: int):
+        """创建并映射一个新的数据段文件（可写）"""
+        name, dtype, shape, offset = self._layout(capacity)[-1]
+        size = offset + int(np.prod(shape)) * dtype.itemsize
+        with open(self._segment_path(segment), 'wb') as f:
+            f.truncate(size)
+        return self._map_segment(segment, capacity, mode='r+')
+
+    def _write_rows(self, arrays, start: int, matrix: np.ndarray, student_ids: List[str],
+                    image_paths: List[str], signatures: List[Optional[Tuple[int, int]]], added_at: float) -> None:
+        stop = start + len(matrix)
+        arrays["matrix"][start:stop] = matrix
+        arrays["sq_norms"][start:stop] = np.einsum('ij,ij->i', matrix, matrix)
+        arrays["student_ids"][start:stop] = [self._encode(sid, self.id_width, "学生ID") for sid in student_ids]
+        arrays["image_paths"][start:stop] = [self._encode(path, self.path_width, "图像路径") for path in image_paths]
+        meta = arrays["row_meta"][start:stop]
+        meta['mtime_ns'] = [signature[0] if signature else -1 for signature in signatures]
+        meta['size'] = [signature[1] if signature else -1 for signature in signatures]
+        meta['added_at'] = added_at
+
+    @staticmethod
+    def _encode(value: str, width: int, label: str) -> bytes:
+        data = value.encode('utf-8')
+        if len(data) > width:
+            raise ValueError(f"{label}超过共享人脸库的最大长度 {width} 字节: {value}")
+        return data
+
+    # ---- 写入 ----
+
+    def publish(self, matrix: np.ndarray, student_ids: List[str], image_paths: Optional[List[str]] = None,
+                signatures: Optional[List[Optional[Tuple[int, int]]]] = None, stamp: Optional[int] = None,
+                added_at: float = 0.0) -> int:
+        """
+        用完整的人脸库替换共享内容（写入新数据段后切换）
+
+        Args:
+            stamp: 新的来源标记，None表示保持不变
+
+        Returns:
+            新的代数
+        """
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, self.dim)
+        count = len(matrix)
+        image_paths = image_paths if image_paths is not None else [""] * count
+        signatures = signatures if signatures is not None else [None] * count
+        with self.lock():
+            _, _, _, old_segment, old_stamp = self._read_control()
+            stamp = old_stamp if stamp is None else stamp
+            segment = old_segment + 1
+            capacity = max(64, count * 2)
+            arrays = self._create_segment(segment, capacity)
+            self._write_rows(arrays, 0, matrix, student_ids, image_paths, signatures, added_at)
+            for array in arrays.values():
+                array.flush()
+            generation = self._write_control(count, capacity, segment, stamp)
+            self._remove_segment(old_segment)
+        return generation
+
+    def append(self, records: List[Tuple[str, np.ndarray, str, Optional[Tuple[int, int]]]],
+               added_at: float = 0.0) -> int:
+        """
+        追加若干编码
+
+        Args:
+            records: [(学生ID, 编码, 图像路径, 图像签名), ...]
+
+        Returns:
+            新的代数
+        """
+        if not records:
+            return self.generation
+        matrix = np.asarray([record[1] for record in records], dtype=np.float32).reshape(-1, self.dim)
+        with self.lock():
+            _, count, capacity, segment, stamp = self._read_control()
+            if count + len(records) > capacity:
+                # 容量不足：复制到两倍容量的新数据段
+                old_segment = segment
+                old = self._map_segment(old_segment, capacity)
+                segment = old_segment + 1
+                capacity = max(64, (count + len(records)) * 2)
+                arrays = self._create_segment(segment, capacity)
+                for name in arrays:
+                    arrays[name][:count] = old[name][:count]
+            else:
+                old_segment = None
+                arrays = self._map_segment(segment, capacity, mode='r+')
+
+            self._write_rows(arrays, count, matrix, [record[0] for record in records],
+                             [record[2] for record in records], [record[3] for record in records], added_at)
+            for array in arrays.values():
+                array.flush()
+            generation = self._write_control(count + len(records), capacity, segment, stamp)
+            if old_segment is not None:
+                self._remove_segment(old_segment)
+        return generation
+
+    def set_stamp(self, stamp: int) -> int:
+        """更新来源标记（内容不变），返回新的代数"""
+        with self.lock():
+            _, count, capacity, segment, _ = self._read_control()
+            return self._write_control(count, capacity, segment, stamp)
+
+    def _remove_segment(self, segment: int) -> None:
+        """删除旧数据段文件（已映射该段的进程不受影响）"""
+        if segment <= 0:
+            return
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"删除共享人脸库旧数据段出错: {str(e)}")
+
+    # ---- 读取 ----
+
+    def view(self) -> SharedGalleryView:
+        """读取当前一代的共享人脸库（数据段未变化时只解码新增行的学生ID和图像路径）"""
+        while True:
+            generation = self.generation
+            if generation % 2:
+                continue
+            _, count, capacity, segment, stamp = self._read_control()
+            if self.generation != generation:
+                continue
+            if segment == 0:
+                empty = np.empty((0, self.dim), dtype=np.float32)
+                return SharedGalleryView(generation, 0, stamp, empty, np.empty(0, dtype=np.float32), [], [],
+                                         np.empty(0, dtype=ROW_META_DTYPE))
+            if self._segment == segment:
+                break
+            try:
+                self._arrays = self._map_segment(segment, capacity)
+            except FileNotFoundError:
+                # 读取控制字段后该段已被新段替换并删除，重读控制字段
+                continue
+            self._segment = segment
+            self._student_ids = []
+            self._image_paths = []
+            break
+        arrays = self._arrays
+
+        # 有效行数之前的行不会再被修改，只需解码新增的行
+        known = len(self._student_ids)
+        if count > known:
+            self._student_ids.extend(sid.decode('utf-8') for sid in arrays["student_ids"][known:count].tolist())
+            self._image_paths.extend(path.decode('utf-8') for path in arrays["image_paths"][known:count].tolist())
+        return SharedGalleryView(generation, segment, stamp, arrays["matrix"][:count], arrays["sq_norms"][:count],
+                                 self._student_ids[:count], self._image_paths[:count], arrays["row_meta"][:count])
+
+    def close(self) -> None:
+        """关闭映射和锁文件（不删除共享文件，其他进程仍在使用）"""
+        self._arrays = None
+        self._segment = None
+        self._control.close()
+        os.close(self._lock_fd)
+
+    def unlink(self) -> None:
+        """删除所有共享文件（所有工作进程退出后调用）"""
+        _, _, _, segment, _ = self._read_control()
+        self._remove_segment(segment)
+        for path in (self._control_path, self._lock_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,111 @@
+import numpy as np
+from typing import Dict, Tuple, Sequence
+
+# 8个邻域点相对中心的方向（行, 列），下标即LBP编码中的位序号：
+# 左上=bit0、上=bit1、右上=bit2、右=bit3、右下=bit4、下=bit5、左下=bit6、左=bit7
+NEIGHBOR_DIRECTIONS: Tuple[Tuple[int, int], ...] = (
+    (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)
+)
+
+LBP_METHODS = ("default", "ror", "uniform", "nri_uniform")
+
+
+def _rotate(code: int, shift: int) -> int:
+    """8位编码循环右移"""
+    return ((code >> shift) | (code << (8 - shift))) & 0xFF
+
+
+def _transitions(code: int) -> int:
+    """8位编码循环一周时0/1跳变的次数"""
+    return bin(code ^ _rotate(code, 1)).count('1')
+
+
+def _build_lookup_tables() -> Dict[str, np.ndarray]:
+    """各编码方式的 原始编码 -> 直方图区间 查找表"""
+    codes = range(256)
+    tables = {"default": np.arange(256, dtype=np.uint8)}
+
+    # 旋转不变：取8种循环移位中的最小值，再压缩为连续的区间编号（共36个）
+    ror_codes = [min(_rotate(code, shift) for shift in range(8)) for code in codes]
+    ror_bins = {value: index for index, value in enumerate(sorted(set(ror_codes)))}
+    tables["ror"] = np.array([ror_bins[value] for value in ror_codes], dtype=np.uint8)
+
+    # 旋转不变的均匀模式（riu2）：跳变不超过2次的编码按1的个数分为0~8，其余为9
+    tables["uniform"] = np.array([bin(code).count('1') if _transitions(code) <= 2 else 9 for code in codes],
+                                 dtype=np.uint8)
+
+    # 非旋转不变的均匀模式：58个均匀编码各占一个区间，其余编码共用最后一个区间
+    uniform_codes = [code for code in codes if _transitions(code) <= 2]
+    nri_bins = {code: index for index, code in enumerate(uniform_codes)}
+    tables["nri_uniform"] = np.array([nri_bins.get(code, len(uniform_codes)) for code in codes], dtype=np.uint8)
+    return tables
+
+
+LOOKUP_TABLES = _build_lookup_tables()
+METHOD_BINS = {method: int(table.max()) + 1 for method, table in LOOKUP_TABLES.items()}
+
+
+def lbp_image(gray: np.ndarray, radius: int = 1, method: str = "default") -> np.ndarray:
+    """
+    计算整幅图的局部二值模式（LBP）编码
+
+    每个方向的邻域整体平移后与中心做一次数组比较（邻域 >= 中心 记为1），不逐像素循环。
+    radius为邻域点到中心的距离：8个邻域点取边长为 2*radius+1 的正方形的四角和四边中点（整数坐标，不插值），
+    radius=1时即3x3邻域。距边缘不足radius的像素没有完整邻域，编码为0。
+
+    Args:
+        gray: 灰度图 (H, W)
+        radius: 邻域半径
+        method: 'default'(原始8位编码)、'ror'(旋转不变)、'uniform'(旋转不变均匀模式)、'nri_uniform'(均匀模式)
+
+    Returns:
+        与gray同尺寸的uint8编码图（非default方式为直方图区间编号）
+    """
+    if method not in LOOKUP_TABLES:
+        raise ValueError(f"不支持的LBP方式: {method}")
+    height, width = gray.shape[:2]
+    codes = np.zeros((height, width), dtype=np.uint8)
+    if height <= 2 * radius or width <= 2 * radius:
+        return codes
+
+    center = gray[radius:height - radius, radius:width - radius]
+    interior = codes[radius:height - radius, radius:width - radius]
+    for bit, (dy, dx) in enumerate(NEIGHBOR_DIRECTIONS):
+        top = radius + dy * radius
+        left = radius + dx * radius
+        neighbor = gray[top:top + center.shape[0], left:left + center.shape[1]]
+        interior |= (neighbor >= center).view(np.uint8) << np.uint8(bit)
+
+    if method != "default":
+        codes = LOOKUP_TABLES[method][codes]
+    return codes
+
+
+def lbp_histogram(gray: np.ndarray, radius: int = 1, method: str = "default", normalize: bool = True) -> np.ndarray:
+    """
+    LBP编码直方图（边缘像素按编码0计入，与原逐像素实现一致）
+
+    Returns:
+        长度为METHOD_BINS[method]的直方图，normalize为True时除以像素总数
+    """
+    codes = lbp_image(gray, radius, method)
+    hist = np.bincount(codes.ravel(), minlength=METHOD_BINS[method])
+    if normalize:
+        return hist.astype(np.float32) / max(codes.size, 1)
+    return hist
+
+
+def multi_radius_histogram(gray: np.ndarray, radii: Sequence[int] = (1, 2, 3),
+                           method: str = "uniform") -> np.ndarray:
+    """多个半径的归一化LBP直方图依次拼接成的特征向量"""
+    return np.concatenate([lbp_histogram(gray, radius, method) for radius in radii])
+
+
+def high_frequency_ratio(gray: np.ndarray) -> float:
+    """
+    高频纹理比例：3x3 LBP编码 >= 128（最高位，即左侧邻域不小于中心）的像素占比
+
+    与两个活体检测器原来的评分相同（直方图后半部分之和 / 直方图总和）。
+    """
+    codes = lbp_image(gray)
+    return float(np.count_nonzero(codes >= 128)) / max(codes.size, 1)
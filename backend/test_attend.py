@@ -0,0 +1,115 @@
+import sys
+import os
+import base64
+import cv2
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+for module in ("flask", "flask_cors", "sqlalchemy", "pandas", "openpyxl", "dlib", "face_recognition"):
+    pytest.importorskip(module)
+
+# 测试中不在后台预热模型
+os.environ["WARMUP_MODELS"] = ""
+
+import dlib
+import app as app_module
+from test_blink_detection import FakePredictor, make_detector
+
+
+def encode_frame(frame):
+    ok, buffer = cv2.imencode(".jpg", frame)
+    assert ok
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.tobytes()).decode("ascii")
+
+
+@pytest.fixture
+def client():
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def blink(monkeypatch):
+    """眨眼检测器使用替身特征点预测器，人脸检测固定返回一张人脸"""
+    predictor = FakePredictor()
+    detector = make_detector(monkeypatch, predictor, [dlib.rectangle(10, 10, 130, 130)])
+    monkeypatch.setattr(app_module, "get_liveness_detector",
+                        lambda method: detector if method == "blink" else pytest.fail(f"unexpected method {method}"))
+    return predictor
+
+
+@pytest.fixture
+def recognition(monkeypatch):
+    """识别固定返回学生s001，考勤写入替换为记录调用"""
+    calls = {"recognize": [], "attendance": []}
+
+    def recognize_face(img, **kwargs):
+        calls["recognize"].append(kwargs)
+        return {"success": True, "student_id": "s001", "similarity": 0.9, "scope": "global"}
+
+    def record_recognized_attendance(student_id, similarity, liveness_method, liveness_confidence):
+        calls["attendance"].append((student_id, liveness_method))
+        return "张三", True
+
+    monkeypatch.setattr(app_module.face_recognition_utils, "recognize_face", recognize_face)
+    monkeypatch.setattr(app_module, "record_recognized_attendance", record_recognized_attendance)
+    return calls
+
+
+def test_attend_blink_not_live(client, blink, recognition):
+    """眨眼方法（前端默认）首帧未检测到眨眼：返回活体检测失败，不记录考勤"""
+    frame = np.full((160, 160, 3), 128, dtype=np.uint8)
+    response = client.post("/api/attend", json={"image": encode_frame(frame), "method": "blink",
+                                                 "session_id": "attend-not-live"})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["success"] is False
+    assert body["recognition_cancelled"] is True
+    assert body["liveness_result"]["faces_detected"] == 1
+    assert recognition["attendance"] == []
+
+
+def test_attend_blink_with_overlay(client, blink, recognition):
+    """眨眼方法请求调试叠加层时返回图元列表"""
+    frame = np.full((160, 160, 3), 128, dtype=np.uint8)
+    response = client.post("/api/attend", json={"image": encode_frame(frame), "method": "blink",
+                                                 "session_id": "attend-overlay", "overlay": "primitives"})
+    assert response.status_code == 200
+    overlay = response.get_json()["liveness_result"]["overlay"]
+    assert [item["type"] for item in overlay] == ["polygon", "polygon"]
+
+
+def test_attend_blink_records_attendance(client, blink, recognition):
+    """同一会话睁眼几帧后闭眼：活体检测通过，识别结果被记录为考勤"""
+    frame = encode_frame(np.full((160, 160, 3), 128, dtype=np.uint8))
+    payload = {"image": frame, "method": "blink", "session_id": "attend-live"}
+    for _ in range(3):
+        assert client.post("/api/attend", json=payload).get_json()["success"] is False
+    blink.eye_height = 1
+    response = client.post("/api/attend", json=payload)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["liveness_result"]["is_live"] is True
+    assert body["success"] is True
+    assert body["student_id"] == "s001"
+    assert body["student_name"] == "张三"
+    assert body["attendance_recorded"] is True
+    assert recognition["attendance"] == [("s001", "blink")]
+    assert "recognition" in body["timings_ms"]
+
+
+def test_detect_liveness_sessions_are_separate(client, blink):
+    """两个客户端（session_id不同）的眨眼历史互不影响"""
+    frame = encode_frame(np.full((160, 160, 3), 128, dtype=np.uint8))
+    for _ in range(3):
+        client.post("/api/detect_liveness", json={"image": frame, "method": "blink", "session_id": "tab-a"})
+    blink.eye_height = 1
+    # tab-b第一次请求：没有历史，闭眼帧不计为眨眼
+    response = client.post("/api/detect_liveness", json={"image": frame, "method": "blink", "session_id": "tab-b"})
+    assert response.get_json()["is_live"] is False
+    response = client.post("/api/detect_liveness", json={"image": frame, "method": "blink"},
+                           headers={"X-Session-Id": "tab-a"})
+    assert response.get_json()["is_live"] is True
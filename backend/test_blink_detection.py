@@ -0,0 +1,123 @@
+import sys
+import os
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+dlib = pytest.importorskip("dlib")
+pytest.importorskip("face_recognition")
+
+from models import blink_detection, frame_analysis
+from models.frame_analysis import FrameAnalysis
+from models.overlay import Overlay
+from models.session_store import SessionState
+
+
+class FakePoint:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class FakeShape:
+    def __init__(self, points):
+        self._points = points
+
+    def parts(self):
+        return self._points
+
+
+class FakePredictor:
+    """68点特征点预测器的替身：眼睛张开高度由eye_height控制（EAR = eye_height / 15）"""
+
+    def __init__(self, eye_height=5):
+        self.eye_height = eye_height
+
+    def __call__(self, gray, face):
+        points = [(face.left() + i, face.top() + i) for i in range(68)]
+        for start, x in ((36, face.left() + 20), (42, face.left() + 60)):
+            y, h = face.top() + 40, self.eye_height
+            points[start:start + 6] = [(x, y), (x + 10, y - h), (x + 20, y - h),
+                                       (x + 30, y), (x + 20, y + h), (x + 10, y + h)]
+        return FakeShape([FakePoint(px, py) for px, py in points])
+
+
+def make_detector(monkeypatch, predictor, faces):
+    """不加载dlib模型文件的眨眼检测器，人脸检测固定返回faces"""
+    monkeypatch.setattr(blink_detection, "get_shape_predictor", lambda path: predictor)
+    monkeypatch.setattr(frame_analysis, "get_default_face_detector", lambda: lambda gray, upsample: faces)
+    return blink_detection.BlinkDetector()
+
+
+@pytest.fixture
+def frame():
+    return np.full((160, 160, 3), 128, dtype=np.uint8)
+
+
+@pytest.fixture
+def face():
+    return dlib.rectangle(10, 10, 130, 130)
+
+
+def test_detect_without_overlay(monkeypatch, frame, face):
+    """不传叠加层时正常返回EAR（不做任何可视化）"""
+    detector = make_detector(monkeypatch, FakePredictor(), [face])
+    result = detector.detect(frame, analysis=FrameAnalysis(frame), session=SessionState("test"))
+    assert result["faces_detected"] == 1
+    assert result["ear"] == pytest.approx(5 / 15)
+    assert result["is_live"] is False
+    assert "overlay" not in result
+
+
+def test_detect_with_overlay(monkeypatch, frame, face):
+    """传入叠加层时记录两只眼睛的轮廓"""
+    detector = make_detector(monkeypatch, FakePredictor(), [face])
+    overlay = Overlay()
+    result = detector.detect(frame, analysis=FrameAnalysis(frame), session=SessionState("test"), overlay=overlay)
+    assert result["faces_detected"] == 1
+    polygons = [item for item in overlay.primitives if item["type"] == "polygon"]
+    assert len(polygons) == 2
+    assert overlay.render(frame).shape == frame.shape
+
+
+def test_detect_no_face_with_overlay(monkeypatch, frame):
+    """未检测到人脸时不记录图元"""
+    detector = make_detector(monkeypatch, FakePredictor(), [])
+    overlay = Overlay()
+    result = detector.detect(frame, analysis=FrameAnalysis(frame), session=SessionState("test"), overlay=overlay)
+    assert result["faces_detected"] == 0
+    assert result["message"] == "未检测到人脸"
+    assert overlay.primitives == []
+
+
+def test_blink_detected_across_frames(monkeypatch, frame, face):
+    """同一会话中睁眼若干帧后闭眼，判定为活体"""
+    predictor = FakePredictor()
+    detector = make_detector(monkeypatch, predictor, [face])
+    session = SessionState("test")
+    for _ in range(3):
+        assert detector.detect(frame, analysis=FrameAnalysis(frame), session=session)["is_live"] is False
+    predictor.eye_height = 1
+    result = detector.detect(frame, analysis=FrameAnalysis(frame), session=session, overlay=Overlay())
+    assert result["is_live"] is True
+    assert result["confidence"] > 0.5
+
+
+def test_sessions_keep_separate_blink_counts(monkeypatch, frame, face):
+    """两个会话的EAR历史和眨眼计数互不影响：一个会话眨眼不会让另一个会话通过"""
+    predictor = FakePredictor()
+    detector = make_detector(monkeypatch, predictor, [face])
+    first, second = SessionState("tab-1"), SessionState("tab-2")
+    for _ in range(3):
+        detector.detect(frame, analysis=FrameAnalysis(frame), session=first)
+    detector.detect(frame, analysis=FrameAnalysis(frame), session=second)
+
+    predictor.eye_height = 1
+    assert detector.detect(frame, analysis=FrameAnalysis(frame), session=first)["is_live"] is True
+    # 第二个会话只有两帧历史，闭眼帧只用于初始化，不计为眨眼
+    assert detector.detect(frame, analysis=FrameAnalysis(frame), session=second)["is_live"] is False
+    assert first.get("blink", blink_detection.BlinkState).blink_total == 1
+    assert second.get("blink", blink_detection.BlinkState).blink_total == 0
+    assert len(second.get("blink", blink_detection.BlinkState).ear_history) == 2
@@ -0,0 +1,106 @@
+import sys
+import os
+from collections import Counter
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models.gallery_compression import (QuantizedGalleryIndex, build_compressed_index, evaluate_compression,
+                                        select_prototypes)
+from models.gallery_index import ExactGalleryIndex
+
+# 压缩后阈值准确率允许的最大下降
+ACCURACY_TOLERANCE = 0.02
+
+
+def synthetic_gallery(n_students=200, per_student=8, noise=0.025, seed=0):
+    """合成人脸库：每个学生一个中心编码（长度约为真实编码的典型值），各张图像为中心加高斯噪声"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_students, 128)).astype(np.float32)
+    centers *= 1.2 / np.linalg.norm(centers, axis=1, keepdims=True)
+    return {
+        f"s{i:04d}": [(center + rng.normal(scale=noise, size=128)).astype(np.float32) for _ in range(per_student)]
+        for i, center in enumerate(centers)
+    }
+
+
+def rows_per_student(index):
+    return Counter(index.student_ids)
+
+
+def test_select_prototypes_bounded():
+    """原型数量不超过 n_medoids + 1，编码较少时原样保留"""
+    encodings = np.random.default_rng(1).normal(size=(20, 128)).astype(np.float32)
+    assert select_prototypes(encodings, n_medoids=3).shape == (4, 128)
+    assert select_prototypes(encodings[:3], n_medoids=3).shape == (3, 128)
+    assert select_prototypes(encodings, n_medoids=0).shape == (1, 128)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_index_matches_exact(dtype):
+    """量化索引的距离与float32精确索引接近，最近邻一致"""
+    gallery = synthetic_gallery(n_students=50, per_student=3)
+    exact = ExactGalleryIndex.from_encodings(gallery)
+    quantized = QuantizedGalleryIndex.from_encodings(gallery, dtype=dtype)
+    queries = np.asarray([encodings[0] for encodings in gallery.values()])
+    assert np.allclose(quantized.distances(queries), exact.distances(queries), atol=0.02)
+    assert [result[0][0] for result in quantized.search_batch(queries)] == list(gallery)
+
+    # 追加的编码同样量化保存
+    quantized.add("new", queries[0] + 0.5)
+    assert len(quantized) == len(exact) + 1
+    assert quantized.search(queries[0] + 0.5)[0][0] == "new"
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_compressed_index_rows_and_accuracy(dtype):
+    """每个学生最多 n_medoids + 1 行，准确率下降不超过容差"""
+    gallery = synthetic_gallery()
+    index = build_compressed_index(gallery, n_medoids=2, dtype=dtype)
+    assert max(rows_per_student(index).values()) <= 3
+    assert len(index) <= 3 * len(gallery)
+
+    report = evaluate_compression(gallery, n_medoids=2, dtype=dtype)
+    assert report["queries"] == len(gallery)
+    assert report["compressed_rows"] < report["full_rows"]
+    assert report["compressed_bytes"] < report["full_bytes"]
+    assert report["accuracy_delta"] >= -ACCURACY_TOLERANCE
+    assert report["top1_accuracy_delta"] >= -ACCURACY_TOLERANCE
+
+
+def test_registrations_are_recompressed_on_refresh(tmp_path, monkeypatch):
+    """压缩模式下注册追加的原始编码在下次刷新时重新压缩，每个学生的行数保持有界"""
+    pytest.importorskip("dlib")
+    pytest.importorskip("face_recognition")
+    from models.face_recognition_utils import FaceRecognitionUtils
+
+    face_db_dir = tmp_path / "face_db"
+    face_db_dir.mkdir()
+    utils = FaceRecognitionUtils(face_db_dir=str(face_db_dir), gallery_compression="int8", prototype_medoids=2,
+                                 encoding_cache_file=str(tmp_path / "face_encodings_cache.pkl"))
+    utils.update_encodings_cache(force=True)
+
+    gallery = synthetic_gallery(n_students=3, per_student=8, seed=2)
+    pending = [encoding for encodings in gallery.values() for encoding in encodings]
+    monkeypatch.setattr(utils, "compute_face_encoding_from_image", lambda image: pending.pop(0))
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    for student_id, encodings in gallery.items():
+        for _ in encodings:
+            assert utils.add_face_encoding(student_id, image)["success"]
+
+    # 追加时原样保存，立即可识别
+    assert len(utils.gallery_index) == 24
+    utils.update_encodings_cache(force=True)
+    assert max(rows_per_student(utils.gallery_index).values()) <= 3
+
+    # 再注册若干次后刷新，行数仍然有界，编码本身都保留在缓存中
+    more = synthetic_gallery(n_students=3, per_student=5, seed=3)
+    pending.extend(encoding for encodings in more.values() for encoding in encodings)
+    for student_id in list(gallery) * 5:
+        utils.add_face_encoding(student_id, image)
+    utils.update_encodings_cache(force=True)
+    assert max(rows_per_student(utils.gallery_index).values()) <= 3
+    assert sum(len(encodings) for encodings in utils.encodings_cache.values()) == 39
+    utils.stop_background_refresh()
@@ -0,0 +1,178 @@
+import sys
+import os
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models.gallery_index import ExactGalleryIndex, IVFGalleryIndex, create_gallery_index, evaluate_recall
+
+# 默认n_probe下recall@1的下限（合成人脸库上实测约0.98）
+RECALL_AT_1_FLOOR = 0.9
+
+
+def synthetic_gallery(n_students=1000, per_student=3, n_queries=200, noise=0.08, seed=0):
+    """
+    合成人脸库：每个学生一个单位长度的中心编码，各张图像和查询为中心加高斯噪声
+
+    3000条编码超过IVF索引的默认训练规模（2048），会训练聚类中心。
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_students, 128)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    encodings_cache = {
+        f"s{i:04d}": [(center + rng.normal(scale=noise, size=128)).astype(np.float32) for _ in range(per_student)]
+        for i, center in enumerate(centers)
+    }
+    queries = (centers[rng.choice(n_students, n_queries, replace=False)]
+               + rng.normal(scale=noise, size=(n_queries, 128))).astype(np.float32)
+    return encodings_cache, queries
+
+
+@pytest.fixture(scope="module")
+def gallery():
+    encodings_cache, queries = synthetic_gallery()
+    return encodings_cache, queries, ExactGalleryIndex.from_encodings(encodings_cache)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_default_n_probe_recall_floor(seed):
+    """默认n_probe下recall@1不低于下限"""
+    encodings_cache, queries = synthetic_gallery(seed=seed)
+    exact = ExactGalleryIndex.from_encodings(encodings_cache)
+    ivf = IVFGalleryIndex(seed=seed)
+    ivf.build(encodings_cache)
+    assert ivf.is_trained and ivf.n_probe < len(ivf.lists)
+    assert evaluate_recall(ivf, exact, queries, k=1) >= RECALL_AT_1_FLOOR
+
+
+@pytest.mark.parametrize("k", [1, 5])
+def test_full_probe_matches_exact(gallery, k):
+    """n_probe等于簇数量时与精确匹配结果完全一致"""
+    encodings_cache, queries, exact = gallery
+    ivf = IVFGalleryIndex()
+    ivf.build(encodings_cache)
+    ivf.n_probe = len(ivf.lists)
+    assert evaluate_recall(ivf, exact, queries, k=k) == 1.0
+    for query in queries[:50]:
+        expected = exact.search(query, k)
+        found = ivf.search(query, k)
+        assert [sid for sid, _ in found] == [sid for sid, _ in expected]
+        assert np.allclose([d for _, d in found], [d for _, d in expected], atol=1e-5)
+
+
+def test_recall_grows_with_n_probe(gallery):
+    """扫描的簇越多召回率越高"""
+    encodings_cache, queries, exact = gallery
+    ivf = IVFGalleryIndex(n_probe=1)
+    ivf.build(encodings_cache)
+    recalls = []
+    for n_probe in (1, 8, len(ivf.lists)):
+        ivf.n_probe = n_probe
+        recalls.append(evaluate_recall(ivf, exact, queries, k=5))
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+
+
+def test_untrained_index_matches_exact():
+    """人脸库小于训练规模时不训练，结果与精确匹配相同"""
+    encodings_cache, queries = synthetic_gallery(n_students=100, n_queries=30, seed=3)
+    exact = ExactGalleryIndex.from_encodings(encodings_cache)
+    ivf = IVFGalleryIndex()
+    ivf.build(encodings_cache)
+    assert not ivf.is_trained
+    assert evaluate_recall(ivf, exact, queries, k=3) == 1.0
+
+
+def gallery_rows(encodings_cache):
+    return [(student_id, encoding) for student_id, encodings in encodings_cache.items() for encoding in encodings]
+
+
+def test_add_trains_when_reaching_train_size():
+    """增量插入到训练规模时自动训练一次，之后的插入分配到已有的簇"""
+    encodings_cache, queries = synthetic_gallery(n_students=100, n_queries=30, seed=4)
+    rows = gallery_rows(encodings_cache)
+    ivf = IVFGalleryIndex(min_train_size=200)
+    for student_id, encoding in rows[:199]:
+        ivf.add(student_id, encoding)
+    assert not ivf.is_trained
+    ivf.add(*rows[199])
+    assert ivf.is_trained and ivf.trained_size == 200 and not ivf.needs_retrain
+
+    for student_id, encoding in rows[200:]:
+        ivf.add(student_id, encoding)
+    assert len(ivf) == len(rows) and ivf.trained_size == 200
+    ivf.n_probe = len(ivf.lists)
+    exact = ExactGalleryIndex.from_encodings(encodings_cache)
+    assert evaluate_recall(ivf, exact, queries, k=3) == 1.0
+
+
+def test_needs_retrain_after_incremental_growth():
+    """增量插入使人脸库超过训练规模的4倍时needs_retrain，插入本身不重新训练，重建时重新训练"""
+    encodings_cache, _ = synthetic_gallery(n_students=300, per_student=3, n_queries=1, seed=5)
+    rows = gallery_rows(encodings_cache)
+    ivf = IVFGalleryIndex(min_train_size=200)
+    ivf.build(dict(list(encodings_cache.items())[:70]))
+    assert ivf.is_trained and ivf.trained_size == 210
+    centroids = ivf.centroids
+
+    for student_id, encoding in rows[210:840]:
+        ivf.add(student_id, encoding)
+    assert len(ivf) == 840 and not ivf.needs_retrain
+    ivf.add(*rows[840])
+    assert ivf.needs_retrain
+    assert ivf.centroids is centroids
+
+    ivf.build(encodings_cache)
+    assert ivf.trained_size == len(rows) and not ivf.needs_retrain
+
+
+def test_save_load_round_trip(gallery, tmp_path):
+    """保存为npz后加载，查询结果（学生和距离）与保存前相同"""
+    encodings_cache, queries, _ = gallery
+    ivf = IVFGalleryIndex(n_probe=4)
+    ivf.build(encodings_cache)
+    path = str(tmp_path / "face_encodings_ivf.npz")
+    ivf.save(path)
+    loaded = IVFGalleryIndex.load(path, n_probe=4)
+    assert len(loaded) == len(ivf) and loaded.trained_size == ivf.trained_size
+    assert np.array_equal(loaded.centroids, ivf.centroids)
+    for found, expected in zip(loaded.search_batch(queries, k=5), ivf.search_batch(queries, k=5)):
+        assert [sid for sid, _ in found] == [sid for sid, _ in expected]
+        assert np.allclose([d for _, d in found], [d for _, d in expected], atol=1e-6)
+
+
+def test_registrations_retrain_ivf_on_refresh(tmp_path, monkeypatch):
+    """IVF模式下注册使人脸库增长到needs_retrain后，下次刷新时重新训练聚类中心"""
+    pytest.importorskip("dlib")
+    pytest.importorskip("face_recognition")
+    from models import face_recognition_utils as fr_utils
+    from models.face_recognition_utils import FaceRecognitionUtils
+
+    def small_train_size(index_type, **kwargs):
+        return create_gallery_index(index_type, **dict(kwargs, min_train_size=32) if index_type == "ivf" else kwargs)
+
+    monkeypatch.setattr(fr_utils, "create_gallery_index", small_train_size)
+    face_db_dir = tmp_path / "face_db"
+    face_db_dir.mkdir()
+    utils = FaceRecognitionUtils(face_db_dir=str(face_db_dir), index_type="ivf",
+                                 encoding_cache_file=str(tmp_path / "face_encodings_cache.pkl"))
+    utils.update_encodings_cache(force=True)
+
+    encodings_cache, _ = synthetic_gallery(n_students=45, per_student=3, n_queries=1, seed=6)
+    rows = gallery_rows(encodings_cache)
+    pending = [encoding for _, encoding in rows]
+    monkeypatch.setattr(utils, "compute_face_encoding_from_image", lambda image: pending.pop(0))
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    for student_id, _ in rows[:32]:
+        assert utils.add_face_encoding(student_id, image)["success"]
+    assert utils.gallery_index.trained_size == 32
+
+    for student_id, _ in rows[32:]:
+        assert utils.add_face_encoding(student_id, image)["success"]
+    assert utils.gallery_index.needs_retrain
+    utils.update_encodings_cache(force=True)
+    assert utils.gallery_index.trained_size == len(rows)
+    assert not utils.gallery_index.needs_retrain
+    utils.stop_background_refresh()
@@ -0,0 +1,194 @@
+import sys
+import os
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models.gallery_index import ExactGalleryIndex
+from models.gallery_shards import (GalleryShardServer, ShardedGallery, gallery_checksum, shard_for,
+                                   start_local_shards)
+
+N_SHARDS = 3
+# 测试中等待分片应答的时间，慢分片的延迟远大于该值
+TIMEOUT = 0.5
+
+
+def synthetic_gallery(n_students=60, per_student=2, noise=0.05, seed=0):
+    """合成人脸库：每个学生一个单位长度的中心编码，各张图像为中心加高斯噪声"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_students, 128)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    return {
+        f"s{i:04d}": [(center + rng.normal(scale=noise, size=128)).astype(np.float32) for _ in range(per_student)]
+        for i, center in enumerate(centers)
+    }
+
+
+def gallery_rows(encodings_cache):
+    student_ids = [student_id for student_id, encodings in encodings_cache.items() for _ in encodings]
+    return student_ids, np.asarray([encoding for encodings in encodings_cache.values() for encoding in encodings])
+
+
+class SlowShardServer(GalleryShardServer):
+    """查询应答远慢于客户端超时的分片"""
+
+    def search_batch(self, queries, k):
+        time.sleep(TIMEOUT * 3)
+        return super().search_batch(queries, k)
+
+
+@pytest.fixture
+def local_shards():
+    """本机的分片进程；套接字放在短路径的临时目录中（Unix域套接字路径有长度限制）"""
+    directory = tempfile.mkdtemp(prefix="shards-")
+    authkey = os.urandom(16)
+    addresses, processes = start_local_shards(N_SHARDS, directory, authkey)
+    servers = []
+
+    def restart_in_thread(shard_id, server_class=GalleryShardServer, content=None):
+        """结束某个分片进程，在同一地址上以本进程内的线程重新启动该分片"""
+        processes[shard_id].terminate()
+        processes[shard_id].join()
+        os.remove(addresses[shard_id])
+        server = server_class(addresses[shard_id], shard_id, N_SHARDS, authkey)
+        if content is not None:
+            server.replace(*content)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        deadline = time.time() + 10
+        while not os.path.exists(addresses[shard_id]) and time.time() < deadline:
+            time.sleep(0.01)
+        return server
+
+    yield addresses, processes, authkey, restart_in_thread
+    for server in servers:
+        server.stop()
+    for process in processes:
+        process.terminate()
+        process.join()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def shard_rows(encodings_cache, shard_id):
+    student_ids, matrix = gallery_rows(encodings_cache)
+    rows = [row for row, student_id in enumerate(student_ids) if shard_for(student_id, N_SHARDS) == shard_id]
+    return [student_ids[row] for row in rows], matrix[rows]
+
+
+def test_checksum_ignores_row_order():
+    """校验和与行的顺序无关，内容不同（行数相同）时不一致"""
+    student_ids, matrix = gallery_rows(synthetic_gallery(n_students=5))
+    order = np.random.default_rng(0).permutation(len(student_ids))
+    shuffled = gallery_checksum([student_ids[row] for row in order], matrix[order])
+    assert shuffled == gallery_checksum(student_ids, matrix)
+    assert gallery_checksum(student_ids, matrix + 1e-3) != gallery_checksum(student_ids, matrix)
+
+
+def test_sharded_search_matches_exact(local_shards):
+    """所有分片都应答时，合并结果与整库精确匹配相同"""
+    addresses, _, authkey, _ = local_shards
+    encodings_cache = synthetic_gallery()
+    gallery = ShardedGallery(addresses, authkey, timeout=TIMEOUT)
+    try:
+        gallery.replace(*gallery_rows(encodings_cache))
+        queries = np.asarray([encodings[0] for encodings in encodings_cache.values()])
+        results, missing = gallery.search_batch(queries, k=3)
+        assert missing == []
+        expected = ExactGalleryIndex.from_encodings(encodings_cache).search_batch(queries, k=3)
+        assert [[student_id for student_id, _ in matches] for matches in results] == \
+               [[student_id for student_id, _ in matches] for matches in expected]
+    finally:
+        gallery.close()
+
+
+def test_killed_shard_reported_missing(local_shards):
+    """分片进程退出后，查询返回其余分片的结果并报告未应答的分片"""
+    addresses, processes, authkey, _ = local_shards
+    encodings_cache = synthetic_gallery()
+    gallery = ShardedGallery(addresses, authkey, timeout=TIMEOUT)
+    try:
+        gallery.replace(*gallery_rows(encodings_cache))
+        processes[1].terminate()
+        processes[1].join()
+        queries = np.asarray([encodings[0] for encodings in encodings_cache.values()])
+        results, missing = gallery.search_batch(queries, k=1)
+        assert missing == [1]
+        assert all(shard_for(matches[0][0], N_SHARDS) != 1 for matches in results)
+    finally:
+        gallery.close()
+
+
+def test_slow_shard_reported_missing(local_shards):
+    """应答超时的分片不阻塞查询；连接仍被占用时下一次查询也不排队等待"""
+    addresses, _, authkey, restart_in_thread = local_shards
+    encodings_cache = synthetic_gallery()
+    restart_in_thread(2, SlowShardServer)
+    gallery = ShardedGallery(addresses, authkey, timeout=TIMEOUT)
+    try:
+        gallery.replace(*gallery_rows(encodings_cache))
+        query = next(iter(encodings_cache.values()))[0]
+        for _ in range(2):
+            started = time.time()
+            _, missing = gallery.search(query, k=1)
+            assert missing == [2]
+            assert time.time() - started < TIMEOUT * 2.5
+    finally:
+        gallery.close()
+
+
+def test_reconnect_resyncs_same_count_different_content(local_shards):
+    """分片的编码数与source一致但内容不同时，连接后推送source中的编码"""
+    addresses, _, authkey, restart_in_thread = local_shards
+    encodings_cache = synthetic_gallery()
+    student_ids, matrix = shard_rows(encodings_cache, 0)
+    server = restart_in_thread(0, content=(student_ids, matrix + 0.5))
+
+    gallery = ShardedGallery(addresses, authkey, timeout=TIMEOUT, source=lambda: encodings_cache)
+    try:
+        query = encodings_cache[student_ids[0]][0]
+        matches, missing = gallery.search(query, k=1)
+        assert missing == []
+        assert matches[0][0] == student_ids[0]
+        assert matches[0][1] < 0.2
+        assert server.stats()["checksum"] == gallery_checksum(student_ids, matrix)
+    finally:
+        gallery.close()
+
+
+def test_match_encodings_searches_missing_shards_locally(local_shards, tmp_path, monkeypatch):
+    """分片未应答时，其学生在本地快照中补查，仍能识别"""
+    pytest.importorskip("dlib")
+    pytest.importorskip("face_recognition")
+    from models.face_recognition_utils import FaceRecognitionUtils
+
+    addresses, processes, authkey, _ = local_shards
+    face_db_dir = tmp_path / "face_db"
+    face_db_dir.mkdir()
+    utils = FaceRecognitionUtils(face_db_dir=str(face_db_dir),
+                                 encoding_cache_file=str(tmp_path / "face_encodings_cache.pkl"))
+    utils.update_encodings_cache(force=True)
+    encodings_cache = synthetic_gallery(n_students=12, per_student=1)
+    pending = [encodings[0] for encodings in encodings_cache.values()]
+    monkeypatch.setattr(utils, "compute_face_encoding_from_image", lambda image: pending.pop(0))
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    for student_id in encodings_cache:
+        assert utils.add_face_encoding(student_id, image)["success"]
+
+    utils.attach_shards(ShardedGallery(addresses, authkey, timeout=TIMEOUT))
+    try:
+        processes[0].terminate()
+        processes[0].join()
+        queries = np.asarray([encodings[0] for encodings in encodings_cache.values()])
+        results = utils.match_encodings(queries, top_k=1)
+        assert [matches[0][0] for matches in results] == list(encodings_cache)
+        assert any(shard_for(student_id, N_SHARDS) == 0 for student_id in encodings_cache)
+        assert utils.match_encoding(queries[0], top_k=1)[0][0] == list(encodings_cache)[0]
+    finally:
+        utils.shards.close()
+        utils.stop_background_refresh()
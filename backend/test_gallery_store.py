@@ -0,0 +1,112 @@
+import sys
+import os
+import gc
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models import gallery_store
+from models.gallery_store import mapped_from, read_gallery, write_gallery
+
+
+def write_sample(path, count=4):
+    matrix = np.random.default_rng(0).normal(size=(count, 128)).astype(np.float32)
+    student_ids = [f"s{i % 2}" for i in range(count)]
+    write_gallery(path, matrix, student_ids, [""] * count, [None] * count)
+    return matrix, student_ids
+
+
+def test_round_trip_is_memory_mapped(tmp_path):
+    """读出的矩阵及其行视图引用文件的内存映射，复制后不再引用"""
+    path = str(tmp_path / "face_gallery.bin")
+    matrix, student_ids = write_sample(path)
+    stored = read_gallery(path)
+    assert stored.student_ids == student_ids
+    assert np.array_equal(stored.matrix, matrix)
+    assert mapped_from(stored.matrix, path)
+    assert mapped_from(stored.matrix[1], path)
+    assert not mapped_from(np.array(stored.matrix[1]), path)
+    assert not mapped_from(stored.matrix, str(tmp_path / "other.bin"))
+
+
+def test_replace_retries_permission_error(tmp_path, monkeypatch):
+    """目标文件被短暂占用时重试替换，一直失败时抛出异常且不留下临时文件"""
+    path = str(tmp_path / "face_gallery.bin")
+    replace = os.replace
+    failures = []
+
+    def busy_twice(src, dst):
+        if len(failures) < 2:
+            failures.append(dst)
+            raise PermissionError(13, "file is in use", dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(gallery_store.os, "replace", busy_twice)
+    matrix, _ = write_sample(path)
+    assert len(failures) == 2
+    assert np.array_equal(read_gallery(path).matrix, matrix)
+
+    def always_busy(src, dst):
+        raise PermissionError(13, "file is in use", dst)
+
+    monkeypatch.setattr(gallery_store.os, "replace", always_busy)
+    monkeypatch.setattr(gallery_store.time, "sleep", lambda seconds: None)
+    with pytest.raises(PermissionError):
+        write_sample(path)
+    assert os.listdir(tmp_path) == ["face_gallery.bin"]
+
+
+def test_save_over_mapped_gallery_file(tmp_path, monkeypatch):
+    """
+    不能覆盖仍被映射的文件时（Windows），保存前把快照中的编码复制出映射
+
+    用检查存活内存映射的os.replace模拟Windows的行为。
+    """
+    pytest.importorskip("dlib")
+    pytest.importorskip("face_recognition")
+    from models import face_recognition_utils as fr_utils
+    from models.face_recognition_utils import FaceRecognitionUtils
+
+    face_db_dir = tmp_path / "face_db"
+    face_db_dir.mkdir()
+    cache_file = str(tmp_path / "face_encodings_cache.pkl")
+    encodings = list(np.random.default_rng(1).normal(size=(6, 128)).astype(np.float32))
+    utils = FaceRecognitionUtils(face_db_dir=str(face_db_dir), encoding_cache_file=cache_file)
+    utils.update_encodings_cache(force=True)
+    monkeypatch.setattr(utils, "compute_face_encoding_from_image", lambda image: encodings.pop(0))
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    for student_id in ("s1", "s2", "s1"):
+        assert utils.add_face_encoding(student_id, image)["success"]
+    utils.save_encoding_cache()
+    utils.stop_background_refresh()
+
+    # 重新启动：快照中的编码和索引直接引用人脸库文件的内存映射
+    utils = FaceRecognitionUtils(face_db_dir=str(face_db_dir), encoding_cache_file=cache_file)
+    gallery_file = utils.gallery_file
+    assert mapped_from(utils.encodings_cache["s1"][0], gallery_file)
+
+    replace = os.replace
+
+    def windows_replace(src, dst):
+        gc.collect()
+        if any(isinstance(obj, np.memmap) and mapped_from(obj, dst) for obj in gc.get_objects()):
+            raise PermissionError(13, "file is mapped", dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(gallery_store.os, "replace", windows_replace)
+    monkeypatch.setattr(gallery_store.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(fr_utils, "REPLACE_MAPPED_FILES", False)
+    assert utils.add_face_encoding("s2", image)["success"]
+    utils.save_encoding_cache()
+    utils.stop_background_refresh()
+
+    snapshot = utils._snapshot
+    assert not any(mapped_from(encoding, gallery_file)
+                   for student_encodings in snapshot.encodings.values() for encoding in student_encodings)
+    assert not mapped_from(snapshot.index.matrix, gallery_file)
+    # 文件已被替换为包含新注册编码的版本
+    stored = read_gallery(gallery_file)
+    assert sorted(stored.student_ids) == ["s1", "s1", "s2", "s2"]
+    assert utils.match_encoding(np.asarray(stored.matrix[0]), top_k=1)[0][0] == stored.student_ids[0]
@@ -0,0 +1,146 @@
+import sys
+import os
+import base64
+import cv2
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+for module in ("flask", "flask_cors", "sqlalchemy", "pandas", "openpyxl", "dlib", "face_recognition"):
+    pytest.importorskip(module)
+
+# 测试中不在后台预热模型
+os.environ["WARMUP_MODELS"] = ""
+
+import app as app_module
+
+
+def encode_frame(frame):
+    ok, buffer = cv2.imencode(".jpg", frame)
+    assert ok
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.tobytes()).decode("ascii")
+
+
+class FakeStudent:
+    def __init__(self, student_id, name):
+        self.id = student_id
+        self.name = name
+
+
+class FakeRecord:
+    def __init__(self, student_id):
+        self.student_id = student_id
+
+
+class FakeDB:
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client():
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """数据库中只有s001和s002，s002今天已考勤；s999只存在于人脸库（学生记录已删除）"""
+    state = {"students": {"s001": FakeStudent("s001", "张三"), "s002": FakeStudent("s002", "李四")},
+             "attended": {"s002"}, "bulk_calls": []}
+
+    def get_students_by_ids(db, student_ids):
+        return {sid: state["students"][sid] for sid in student_ids if sid in state["students"]}
+
+    def record_attendance_bulk(db, records):
+        state["bulk_calls"].append([record["student_id"] for record in records])
+        # 与数据库一致：任何一个学生ID不存在都会因外键约束使整批失败
+        if any(record["student_id"] not in state["students"] for record in records):
+            raise RuntimeError("foreign key constraint fails")
+        return [FakeRecord(record["student_id"]) for record in records
+                if record["student_id"] not in state["attended"]]
+
+    monkeypatch.setattr(app_module, "get_db", lambda: FakeDB())
+    monkeypatch.setattr(app_module.db_utils, "get_students_by_ids", get_students_by_ids)
+    monkeypatch.setattr(app_module.db_utils, "record_attendance_bulk", record_attendance_bulk)
+    return state
+
+
+def fake_face(student_id, similarity):
+    return {"student_id": student_id, "similarity": similarity, "face_location": (0, 10, 10, 0),
+            "matched": student_id is not None}
+
+
+def test_record_matched_attendance_skips_orphaned_ids(database):
+    """人脸库中残留的学生ID不写入考勤，其余学生照常记录"""
+    students, recorded, unrecorded = app_module.record_matched_attendance({"s001": 0.9, "s002": 0.8, "s999": 0.7})
+    assert database["bulk_calls"] == [["s001", "s002"]]
+    assert set(students) == {"s001", "s002"}
+    assert recorded == {"s001"}
+    assert {item["student_id"]: item["reason"] for item in unrecorded} == {
+        "s002": "今天已考勤", "s999": "数据库中不存在该学生"}
+
+
+def test_recognize_group_reports_unrecorded(client, database, monkeypatch):
+    """合影中包含孤立ID时其他学生仍被记录，未记录的匹配在响应中列出"""
+    faces = [fake_face("s001", 0.9), fake_face("s999", 0.8), fake_face(None, 0.1)]
+    monkeypatch.setattr(app_module.face_recognition_utils, "recognize_faces", lambda img, **kwargs: {
+        "success": True, "message": "ok", "face_count": 3, "matched_count": 2, "scope": "global", "faces": faces})
+    response = client.post("/api/recognize_group",
+                           json={"image": encode_frame(np.zeros((40, 40, 3), dtype=np.uint8))})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [face["attendance_recorded"] for face in body["faces"]] == [True, False, False]
+    assert body["faces"][0]["student_name"] == "张三"
+    assert body["unrecorded"] == [{"student_id": "s999", "reason": "数据库中不存在该学生"}]
+
+
+def test_recognize_batch_skips_orphaned_ids(client, database, monkeypatch):
+    """批量识别中包含孤立ID时其他学生仍被记录"""
+    frame_results = [
+        {"success": True, "student_id": "s999", "similarity": 0.95, "message": "ok"},
+        {"success": True, "student_id": "s001", "similarity": 0.9, "message": "ok"},
+        {"success": True, "student_id": "s001", "similarity": 0.7, "message": "ok"},
+    ]
+    monkeypatch.setattr(app_module.face_recognition_utils, "recognize_frames", lambda frames, **kwargs: frame_results)
+    image = encode_frame(np.zeros((40, 40, 3), dtype=np.uint8))
+    response = client.post("/api/recognize_batch", json={"images": [image] * 3})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert database["bulk_calls"] == [["s001"]]
+    assert [result["attendance_recorded"] for result in body["results"]] == [False, True, True]
+    assert body["unrecorded"] == [{"student_id": "s999", "reason": "数据库中不存在该学生"}]
+
+
+@pytest.mark.parametrize("image", ["bare", "data_url"])
+def test_recognize_group_accepts_bare_base64(client, database, monkeypatch, image):
+    """data URL和不带前缀的BASE64都可以解码"""
+    monkeypatch.setattr(app_module.face_recognition_utils, "recognize_faces", lambda img, **kwargs: {
+        "success": False, "message": "未检测到人脸", "face_count": 0, "matched_count": 0, "scope": "global",
+        "faces": []})
+    data_url = encode_frame(np.zeros((40, 40, 3), dtype=np.uint8))
+    payload = data_url.split(",", 1)[1] if image == "bare" else data_url
+    response = client.post("/api/recognize_group", json={"image": payload})
+    assert response.status_code == 200
+    assert response.get_json()["face_count"] == 0
+
+
+@pytest.mark.parametrize("payload", [{}, {"image": "not-an-image"}, {"upsample": "two"}, {"upsample": None}])
+def test_recognize_group_rejects_bad_requests(client, payload):
+    """缺少图像、无法解码或upsample不是整数时返回400"""
+    if "upsample" in payload:
+        payload = dict(payload, image=encode_frame(np.zeros((40, 40, 3), dtype=np.uint8)))
+    response = client.post("/api/recognize_group", json=payload)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_recognize_group_without_json_body(client):
+    """没有JSON请求体时返回400而不是500"""
+    response = client.post("/api/recognize_group", data=b"", content_type="text/plain")
+    assert response.status_code == 400
@@ -0,0 +1,87 @@
+import sys
+import os
+import time
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models.model_registry import ModelRegistry
+
+
+class FlakyModel:
+    """前fail_times次预热失败的模型"""
+
+    def __init__(self, fail_times):
+        self.fail_times = fail_times
+        self.calls = 0
+
+    def warm_up(self, frame):
+        self.calls += 1
+        if self.calls <= self.fail_times:
+            raise OSError("模型文件不可读")
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_warm_up_failure_reports_reason_and_backoff():
+    """预热失败时记录原因、失败次数和下次重试时间，退避时间内不重试"""
+    registry = ModelRegistry(retry_backoff_s=60)
+    model = FlakyModel(fail_times=1)
+    registry.register("flaky", lambda: model)
+    with pytest.raises(OSError):
+        registry.warm_up("flaky")
+    status = registry.status()["flaky"]
+    assert status["state"] == "error"
+    assert "模型文件不可读" in status["error"]
+    assert status["failures"] == 1
+    assert status["retry_at"] > time.time() + 30
+    assert registry.retry_failed(["flaky"]) == []
+    assert not registry.is_ready(["flaky"])
+
+
+def test_failed_warm_up_recovers_after_retry():
+    """退避时间过后重试成功，模型恢复就绪，失败次数清零"""
+    registry = ModelRegistry(retry_backoff_s=0.05)
+    model = FlakyModel(fail_times=2)
+    registry.register("flaky", lambda: model)
+    with pytest.raises(OSError):
+        registry.warm_up("flaky")
+
+    # 第一次重试仍失败，退避时间翻倍（0.1秒）
+    time.sleep(0.06)
+    assert registry.retry_failed(["flaky"]) == ["flaky"]
+    assert wait_until(lambda: registry.status()["flaky"].get("failures") == 2
+                      and not registry.status()["flaky"].get("retrying"))
+    assert registry.status()["flaky"]["retry_at"] - time.time() <= 0.1
+
+    assert wait_until(lambda: registry.retry_failed(["flaky"]) == ["flaky"])
+    assert wait_until(lambda: registry.is_ready(["flaky"]))
+    assert model.calls == 3
+    assert registry.retry_failed(["flaky"]) == []
+
+
+def test_failed_load_is_retried():
+    """加载失败（如模型文件暂不存在）的模型也会重试加载并预热"""
+    registry = ModelRegistry(retry_backoff_s=0.01)
+    attempts = []
+
+    def load():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise FileNotFoundError("models/liveness_model.h5")
+        return FlakyModel(fail_times=0)
+
+    registry.register("late", load)
+    registry.preload(["late"], background=False, warm_up=True)
+    assert registry.status()["late"]["state"] == "error"
+    assert wait_until(lambda: registry.retry_failed(["late"]) == ["late"])
+    assert wait_until(lambda: registry.is_ready(["late"]))
+    assert len(attempts) == 2
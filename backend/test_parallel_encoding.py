@@ -0,0 +1,53 @@
+import sys
+import os
+import cv2
+import numpy as np
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip("dlib")
+pytest.importorskip("face_recognition")
+
+from models import face_recognition_utils as fr_utils
+from models.face_recognition_utils import FaceRecognitionUtils
+
+
+@pytest.fixture
+def utils(tmp_path):
+    face_db_dir = tmp_path / "face_db"
+    face_db_dir.mkdir()
+    return FaceRecognitionUtils(face_db_dir=str(face_db_dir),
+                                encoding_cache_file=str(tmp_path / "face_encodings_cache.pkl"))
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(16):
+        path = str(tmp_path / f"image_{i:02d}.jpg")
+        cv2.imwrite(path, rng.integers(0, 256, (32, 32, 3), dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+
+def test_encode_images_in_spawned_pool(utils, image_paths):
+    """进程池（spawn）编码返回每张图像的结果"""
+    encodings = utils.encode_images(image_paths, workers=2)
+    assert set(encodings) == set(image_paths)
+    assert utils.last_encoding_report["total"] == len(image_paths)
+    assert utils.last_encoding_report["workers"] == 2
+
+
+def test_encode_images_falls_back_to_serial(utils, image_paths, monkeypatch):
+    """无法创建进程池（如平台不支持该启动方式）时改为串行计算"""
+    def unavailable(*args, **kwargs):
+        raise ValueError("cannot find context for 'spawn'")
+
+    monkeypatch.setattr(fr_utils, "ProcessPoolExecutor", unavailable)
+    encodings = utils.encode_images(image_paths, workers=4)
+    assert set(encodings) == set(image_paths)
+    assert utils.last_encoding_report["workers"] == 1
+    assert utils.last_encoding_report["total"] == len(image_paths)
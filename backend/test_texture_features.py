@@ -0,0 +1,117 @@
+import sys
+import os
+import time
+import numpy as np
+import cv2
+import pytest
+
+# 添加当前目录到sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models.texture_features import (lbp_image, lbp_histogram, multi_radius_histogram, high_frequency_ratio,
+                                     LOOKUP_TABLES, METHOD_BINS)
+
+
+def legacy_lbp(gray):
+    """活体检测器原来的逐像素LBP实现（作为对照）"""
+    lbp = np.zeros_like(gray)
+    for i in range(1, gray.shape[0] - 1):
+        for j in range(1, gray.shape[1] - 1):
+            center = gray[i, j]
+            neighbors = [gray[i-1, j-1], gray[i-1, j], gray[i-1, j+1],
+                        gray[i, j+1], gray[i+1, j+1], gray[i+1, j],
+                        gray[i+1, j-1], gray[i, j-1]]
+            binary = [1 if n >= center else 0 for n in neighbors]
+            lbp[i, j] = sum([b * (2 ** idx) for idx, b in enumerate(binary)])
+    return lbp
+
+
+def legacy_high_freq_ratio(gray):
+    """活体检测器原来的纹理评分"""
+    lbp = legacy_lbp(gray)
+    hist, _ = np.histogram(lbp, bins=256, range=(0, 256))
+    hist = hist.astype(np.float32) / (lbp.shape[0] * lbp.shape[1])
+    return np.sum(hist[128:]) / np.sum(hist)
+
+
+def _make_images():
+    """测试图像：随机噪声、平坦区域（大量相等像素）、极小尺寸以及仓库中的测试照片"""
+    rng = np.random.default_rng(0)
+    images = {
+        "noise_200x200": rng.integers(0, 256, (200, 200), dtype=np.uint8),
+        "flat_64x48": np.full((64, 48), 128, dtype=np.uint8),
+        "blocks_50x70": (rng.integers(0, 4, (50, 70)) * 60).astype(np.uint8),
+        "tiny_3x3": rng.integers(0, 256, (3, 3), dtype=np.uint8),
+        "line_1x10": rng.integers(0, 256, (1, 10), dtype=np.uint8),
+    }
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in ("test_face.jpg", "test_face_new.jpg"):
+        image = cv2.imread(os.path.join(base_dir, name))
+        if image is not None:
+            images[name] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return images
+
+
+@pytest.fixture(scope="module")
+def images():
+    return _make_images()
+
+
+def test_lbp_matches_legacy(images):
+    """向量化LBP编码与逐像素实现逐像素一致，纹理评分一致"""
+    assert {"noise_200x200", "flat_64x48", "tiny_3x3", "line_1x10"} <= set(images)
+    for name, gray in images.items():
+        expected = legacy_lbp(gray)
+        actual = lbp_image(gray)
+        assert actual.dtype == expected.dtype, name
+        assert actual.shape == gray.shape, name
+        assert np.array_equal(actual, expected), f"{name}: LBP编码不一致"
+        assert high_frequency_ratio(gray) == pytest.approx(float(legacy_high_freq_ratio(gray)), abs=1e-6), \
+            f"{name}: 纹理评分不一致"
+
+
+def test_variants():
+    """旋转不变/均匀模式的区间数和不变性"""
+    assert METHOD_BINS == {"default": 256, "ror": 36, "uniform": 10, "nri_uniform": 59}
+    # 旋转不变：同一编码的各个循环移位映射到同一区间
+    for code in (0b00000001, 0b00000011, 0b01010101):
+        rotations = {((code >> shift) | (code << (8 - shift))) & 0xFF for shift in range(8)}
+        assert len({int(LOOKUP_TABLES["ror"][rotation]) for rotation in rotations}) == 1
+        assert len({int(LOOKUP_TABLES["uniform"][rotation]) for rotation in rotations}) == 1
+
+    gray = np.random.default_rng(1).integers(0, 256, (80, 80), dtype=np.uint8)
+    for method, bins in METHOD_BINS.items():
+        hist = lbp_histogram(gray, method=method)
+        assert hist.shape == (bins,) and abs(float(hist.sum()) - 1.0) < 1e-5, method
+    # 图像旋转90度后，旋转不变均匀模式的直方图不变
+    rotated = np.rot90(gray).copy()
+    assert np.allclose(lbp_histogram(gray, method="uniform"), lbp_histogram(rotated, method="uniform"))
+
+    features = multi_radius_histogram(gray, radii=(1, 2, 3), method="uniform")
+    assert features.shape == (30,)
+    # 每个半径的直方图各自归一化
+    assert np.allclose(features.reshape(3, 10).sum(axis=1), 1.0, atol=1e-5)
+
+
+def test_speed():
+    """200x200人脸区域的耗时对比"""
+    gray = np.random.default_rng(2).integers(0, 256, (200, 200), dtype=np.uint8)
+    start = time.perf_counter()
+    legacy_high_freq_ratio(gray)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(100):
+        high_frequency_ratio(gray)
+    vectorized_time = (time.perf_counter() - start) / 100
+    # 向量化实现至少快一个数量级（实测快数百倍）
+    assert vectorized_time * 10 < legacy_time, \
+        f"200x200: 逐像素 {legacy_time * 1000:.1f} ms, 向量化 {vectorized_time * 1000:.3f} ms"
+
+
+if __name__ == "__main__":
+    print("开始测试LBP纹理特征...")
+    test_lbp_matches_legacy(_make_images())
+    test_variants()
+    test_speed()
+    print("LBP纹理特征测试通过")
@@ -1,6 +1,7 @@
 import Vue from 'vue'
 import Vuex from 'vuex'
 import axios from 'axios'
+import { getLivenessSessionId } from '@/utils/livenessSession'
 
 Vue.use(Vuex)
 
@@ -87,7 +88,9 @@ export default new Vuex.Store({
         
         const requestData = {
           image: payload.image,
-          method: payload.method || state.livenessMethod
+          method: payload.method || state.livenessMethod,
+          // 本标签页的会话ID，后端按会话保存眨眼计数等状态
+          session_id: getLivenessSessionId()
         }
         
         // 打印请求信息（不包含图像数据）
@@ -133,7 +136,8 @@ export default new Vuex.Store({
         console.log("发送人脸识别请求到 /api/recognize_face")
         const response = await axios.post('/api/recognize_face', {
           image: imageData,
-          method: state.livenessMethod
+          method: state.livenessMethod,
+          session_id: getLivenessSessionId()
         })
         
         console.log("人脸识别响应:", response.data)
@@ -172,6 +176,60 @@ export default new Vuex.Store({
         commit('SET_LOADING', false)
       }
     },
+    async attend({ commit, state }, imageData) {
+      // 一次性考勤：活体检测和人脸识别在服务端对同一帧并行执行，只上传、解码一次
+      commit('SET_LOADING', true)
+      console.log("开始执行考勤（/api/attend）")
+      
+      try {
+        if (!imageData) {
+          throw new Error('未提供图像数据')
+        }
+        
+        const response = await axios.post('/api/attend', {
+          image: imageData,
+          method: state.livenessMethod,
+          session_id: getLivenessSessionId()
+        })
+        
+        console.log("考勤响应:", response.data)
+        commit('SET_LAST_DETECTION_RESULT', response.data.liveness_result)
+        
+        if (response.data.success) {
+          console.log(`识别成功: ${response.data.student_name} (${response.data.student_id})`)
+          commit('ADD_ATTENDANCE_RECORD', {
+            student_id: response.data.student_id,
+            student_name: response.data.student_name,
+            timestamp: response.data.timestamp,
+            similarity: response.data.similarity
+          })
+        } else {
+          console.log("考勤失败:", response.data.message || "未找到匹配人脸")
+        }
+        
+        commit('SET_ERROR', null)
+        return response.data
+      } catch (error) {
+        const errorMsg = '考勤失败：' + (error.message || '未知错误')
+        console.error(errorMsg, error)
+        
+        // 如果有响应数据，输出更详细的错误信息
+        if (error.response) {
+          console.error('错误响应状态:', error.response.status)
+          console.error('错误响应数据:', error.response.data)
+        }
+        
+        commit('SET_ERROR', errorMsg)
+        return { 
+          success: false, 
+          message: errorMsg,
+          liveness_result: null,
+          error: true
+        }
+      } finally {
+        commit('SET_LOADING', false)
+      }
+    },
     async registerFace({ commit }, { imageData, studentId, studentName, classId }) {
       commit('SET_LOADING', true);
       try {
@@ -0,0 +1,36 @@
+/**
+ * 活体检测会话ID - 后端按会话保存眨眼计数、EAR历史和平滑状态
+ * 每个浏览器标签页一个ID（保存在sessionStorage中，刷新页面不变，新标签页重新生成），
+ * 随活体检测、人脸识别和考勤请求以session_id字段发送，不同终端的状态互不影响
+ */
+const STORAGE_KEY = 'livenessSessionId';
+
+let memorySessionId = null;
+
+function generateSessionId() {
+  if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+    return window.crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+/**
+ * 获取当前标签页的会话ID，不存在时生成
+ * @returns {string} 会话ID（远短于后端128个字符的上限）
+ */
+export function getLivenessSessionId() {
+  try {
+    let sessionId = window.sessionStorage.getItem(STORAGE_KEY);
+    if (!sessionId) {
+      sessionId = generateSessionId();
+      window.sessionStorage.setItem(STORAGE_KEY, sessionId);
+    }
+    return sessionId;
+  } catch (error) {
+    // sessionStorage不可用（如隐私模式限制）时在内存中保存，本页面内保持不变
+    if (!memorySessionId) {
+      memorySessionId = generateSessionId();
+    }
+    return memorySessionId;
+  }
+}